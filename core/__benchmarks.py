@@ -0,0 +1,272 @@
+'''
+Author: Bryan Bonvallet
+Purpose: This file contains benchmarks for core code. Run it as an
+executable; each benchmark prints its timings.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import time
+import logging
+import threading
+
+try:
+    from dogpile.readwrite_lock import ReadWriteMutex
+except ImportError:
+    ReadWriteMutex = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from gdci.core.state import State
+from gdci.core.state import StateSchema
+from gdci.core.rwlock import ReadWriteLock
+from gdci.core.action import CoreAction
+from gdci.core.future import wait_all
+from gdci.core.pipeline import action_pipeline
+from gdci.core.observable import CoreObservable
+from gdci.core.actionmanager import action_manager
+from gdci.core.registration import parse_state_pattern
+from gdci.core.registration import compile_registrations
+
+# ---
+
+class BenchmarkObservable(CoreObservable):
+    def get_observation(self):
+        return True
+
+class BenchmarkAction(CoreAction):
+    def perform_action(self):
+        pass
+
+def timed(function, *args, **kwargs):
+    begin = time.time()
+    function(*args, **kwargs)
+    return time.time() - begin
+
+def report(name, seconds, count):
+    print '  %-40s %8.3f s %12.0f /s' % (name, seconds, count / seconds)
+
+# ---
+
+def registration_benchmark(observable_count=5000):
+    '''
+    Time loading observable_count * 4 registrations at startup: one call to
+    register_action() each, associate_actions(), and a compiled config.
+    '''
+
+    observables = dict(('sensor%d' % index, BenchmarkObservable())
+                       for index in range(observable_count))
+    # A typical mix of exact and wildcard registrations.
+    patterns = [('*,F', '*,T'), ('*,T', '*,F'), ('T,*', 'F,*'), ('F,T', 'T,T')]
+    states = [(parse_state_pattern(initial), parse_state_pattern(final))
+              for initial, final in patterns]
+    count = observable_count * len(patterns)
+
+    def per_call():
+        for observable in observables.itervalues():
+            for initial, final in states:
+                observable.register_action(BenchmarkAction, initial, final)
+
+    def bulk():
+        action_manager.associate_actions(
+            (BenchmarkAction, observable, initial, final)
+            for observable in observables.itervalues()
+            for initial, final in states)
+
+    config = {'registrations': [
+        {'observable': sorted(observables), 'action': 'BenchmarkAction',
+         'initial': initial, 'final': final} for initial, final in patterns]}
+    def compiled():
+        staged = compile_registrations(config, observables, {'BenchmarkAction': BenchmarkAction})
+        action_manager.install_mapping(staged)
+
+    print 'Startup registration of %d actions:' % count
+    results = {}
+    for name, function in [('register_action() per registration', per_call),
+                           ('associate_actions()', bulk),
+                           ('compiled config', compiled)]:
+        action_manager.clear_mapping()
+        seconds = results[function] = timed(function)
+        report(name, seconds, count)
+    print '  %d transitions registered.' % len(action_manager.action_mapping)
+    print '  associate_actions() is %.1f times as fast as one call each.' % (results[per_call] / results[bulk])
+    action_manager.clear_mapping()
+
+def teardown_benchmark(observable_count=5000, retired=500):
+    '''
+    Time retiring some observables of a large fleet, each with one
+    registration over every state change, through unregister_action() with
+    the original states and through unregister_all().
+    '''
+
+    observables = [BenchmarkObservable() for index in range(observable_count)]
+    anything = parse_state_pattern('*,*')
+    registrations = [(BenchmarkAction, observable, anything, anything)
+                     for observable in observables]
+
+    def per_state():
+        for observable in observables[:retired]:
+            observable.unregister_action(BenchmarkAction, anything, anything)
+
+    def unregister_all():
+        for observable in observables[:retired]:
+            observable.unregister_all()
+
+    print 'Retiring %d of %d observables:' % (retired, observable_count)
+    for name, function in [('unregister_action() with states', per_state),
+                           ('unregister_all()', unregister_all)]:
+        action_manager.clear_mapping()
+        action_manager.associate_actions(registrations)
+        seconds = timed(function)
+        report(name, seconds, retired)
+    action_manager.clear_mapping()
+
+def pipeline_benchmark(transitions=300, stages=3):
+    '''
+    Time firing transitions state changes, each answered by stages actions:
+    registered separately, each in a thread of its own, and fused into one
+    pipeline.
+    '''
+
+    observable = BenchmarkObservable()
+    initial = State(True, False)
+    final = State(True, True)
+    stage_classes = [type('Stage%d' % index, (BenchmarkAction,), {}) for index in range(stages)]
+
+    def fire():
+        futures = []
+        for index in range(transitions):
+            futures.extend(action_manager.check_state_change(observable, initial, final))
+        wait_all(futures)
+
+    print 'Firing %d transitions of %d stages:' % (transitions, stages)
+    for name, actions in [('separate actions', stage_classes),
+                          ('action_pipeline()', action_pipeline(*stage_classes))]:
+        action_manager.clear_mapping()
+        observable.register_action(actions, initial, final)
+        seconds = timed(fire)
+        report(name, seconds, transitions)
+    action_manager.clear_mapping()
+
+def state_benchmark(attributes=6, lookups=100000):
+    '''
+    Time matching States against a pattern of a schema of many attributes,
+    as a StateCollection of its expansion and as a compiled StatePattern.
+    '''
+
+    class WideState(State):
+        schema = StateSchema(['attribute%d' % index for index in range(attributes)])
+
+    values = ['*', '[TF]'] * (attributes // 2) + ['*'] * (attributes % 2)
+    collection = WideState(*values)
+    pattern = WideState.pattern(*values)
+    probes = [WideState(*[(True, False, None)[(index + shift) % 3] for shift in range(attributes)])
+              for index in range(3)]
+    probes = probes * (lookups // len(probes))
+
+    def count(container):
+        return len([probe for probe in probes if probe in container])
+
+    print 'Matching %d States of %d attributes:' % (len(probes), attributes)
+    for name, container in [('StateCollection of %d States' % len(collection), collection),
+                            ('StatePattern', pattern)]:
+        seconds = timed(count, container)
+        report(name, seconds, len(probes))
+
+def rwlock_benchmark(operations=100000, threads=4, write_ratio=10):
+    '''
+    Time acquiring and releasing ReadWriteLock, fair or not, and dogpile's
+    ReadWriteMutex if it is installed: uncontended, then from threads threads
+    of which one in write_ratio operations writes. Also reports the longest
+    a writer waited under contention.
+    '''
+
+    locks = [('ReadWriteLock', ReadWriteLock), ('ReadWriteLock(fair=True)', lambda: ReadWriteLock(fair=True))]
+    if ReadWriteMutex is not None:
+        locks.append(('dogpile ReadWriteMutex', ReadWriteMutex))
+
+    def uncontended(lock, acquire, release):
+        for index in xrange(operations):
+            acquire()
+            release()
+
+    def contended(lock):
+        longest = [0.0]
+        def work():
+            for index in xrange(operations // threads):
+                if index % write_ratio:
+                    lock.acquire_read_lock()
+                    lock.release_read_lock()
+                else:
+                    begin = time.time()
+                    lock.acquire_write_lock()
+                    longest[0] = max(longest[0], time.time() - begin)
+                    lock.release_write_lock()
+        workers = [threading.Thread(target=work) for index in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return longest[0]
+
+    print 'Acquiring and releasing locks %d times:' % operations
+    for name, lock_class in locks:
+        lock = lock_class()
+        report('%s read' % name, timed(uncontended, lock, lock.acquire_read_lock, lock.release_read_lock), operations)
+        report('%s write' % name, timed(uncontended, lock, lock.acquire_write_lock, lock.release_write_lock), operations)
+        if isinstance(lock, ReadWriteLock):
+            report('%s with Read' % name, timed(uncontended, lock, lock.Read.__enter__, lock.Read.__exit__), operations)
+        longest = []
+        seconds = timed(lambda: longest.append(contended(lock)))
+        report('%s %d threads' % (name, threads), seconds, operations)
+        print '  %-40s %8.3f s' % ('  longest writer wait', longest[0])
+
+def payload_benchmark(copies=200, size=4 * 1024 * 1024):
+    '''
+    Time copying a State carrying a payload of size bytes, as actions are
+    given copies: as a secondary attribute, which is copied, and frozen by
+    set_payload(), which is shared.
+    '''
+
+    payloads = [('bytearray', None, bytearray(size)),
+                ('frozen bytearray', 'set_payload', bytearray(size))]
+    if numpy is not None:
+        payloads.extend([('NumPy array', None, numpy.zeros(size, dtype=numpy.uint8)),
+                         ('frozen NumPy array', 'set_payload', numpy.zeros(size, dtype=numpy.uint8))])
+
+    def copy_all(state):
+        for index in xrange(copies):
+            state.copy()
+
+    print 'Copying a State with a payload of %d bytes %d times:' % (size, copies)
+    for name, method, payload in payloads:
+        state = State(True, True)
+        if method:
+            state.set_payload('payload', payload)
+        else:
+            state.set_secondary('payload', payload)
+        report(name, timed(copy_all, state), copies)
+
+# ---
+
+# Run benchmarks if this file is called as an executable.
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+
+    registration_benchmark()
+    print ""
+    teardown_benchmark()
+    print ""
+    pipeline_benchmark()
+    print ""
+    state_benchmark()
+    print ""
+    rwlock_benchmark()
+    print ""
+    payload_benchmark()
+    print ""
+
+    action_manager.stop(blocking=True)
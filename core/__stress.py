@@ -0,0 +1,376 @@
+'''
+Author: Bryan Bonvallet
+Purpose: This file contains a stress test of the core: many threads at once
+registering and unregistering actions, polling observables, and so firing
+actions, with the operations of each thread chosen from a seeded random
+sequence. Each thread keeps a model of the registrations of its own
+observables, against which the actions fired and the final registry are
+checked, and a watchdog reports a deadlock if the threads stop making
+progress. Run it as an executable to report throughput, or call
+run_stress().
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import gc
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+import traceback
+
+from gdci.core.state import State
+from gdci.core.action import CoreAction
+from gdci.core.future import wait_all
+from gdci.core.observable import CoreObservable
+from gdci.core.actionmanager import state_codes
+from gdci.core.actionmanager import action_manager
+
+log = logging.getLogger('Stress')
+
+# The states registrations are made between; an observation is always
+# (True, result).
+STRESS_STATES = [State(True, True), State(True, False), State(True, '*')]
+
+# ---
+
+class StressObservable(CoreObservable):
+    '''
+    Observes whatever its worker decided it would next.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        CoreObservable.__init__(self, *args, **kwargs)
+        self.next_result = True
+
+    def get_observation(self):
+        return self.next_result
+
+class StressAction(CoreAction):
+    '''
+    Counts how many times the action of each future was started.
+    '''
+
+    # The StressResult being recorded into.
+    result_record = None
+
+    def perform_action(self):
+        self.result_record.record_start(self.future)
+
+# Distinct action classes, so that transitions fire several actions.
+stress_actions = [type('StressAction%d' % index, (StressAction,), {}) for index in range(3)]
+
+
+class StressResult(object):
+    '''
+    StressResult collects what a run did and any violations of the
+    invariants found.
+    '''
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.violations = []
+        self.operations = 0
+        self.actions = 0
+        self.elapsed = 0.0
+        self.deadlocked = False
+        # The stacks of all threads when a deadlock was detected.
+        self.stacks = None
+        # Every future fired, and the number of times the action of each
+        # was started, by id of the future.
+        self.futures = []
+        self.starts = {}
+        self.threads = []
+
+    def violation(self, msg):
+        log.error(msg)
+        with self.lock:
+            self.violations.append(msg)
+
+    def record_start(self, future):
+        with self.lock:
+            self.starts[id(future)] = self.starts.get(id(future), 0) + 1
+
+    def record_futures(self, futures):
+        with self.lock:
+            self.futures.extend(futures)
+            self.actions += len(futures)
+
+    def ok(self):
+        return not self.violations and not self.deadlocked
+
+    def join(self, timeout=None):
+        '''
+        Wait for the worker threads, which outlive a deadlocked run until
+        they are unblocked.
+        '''
+
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        lines = ['Seed %s: %d operations and %d actions in %.3f s; %.0f operations/s, %.0f actions/s.' %
+                 (self.seed, self.operations, self.actions, self.elapsed,
+                  self.operations / elapsed, self.actions / elapsed)]
+        if self.deadlocked:
+            lines.append('Deadlocked; stacks of all threads:')
+            lines.append(self.stacks)
+        for violation in self.violations:
+            lines.append('Violation: %s' % violation)
+        return '\n'.join(lines)
+
+
+class StressWorker(threading.Thread):
+    '''
+    StressWorker owns some observables: only it polls them and registers
+    actions with them, so that it can predict which actions each of their
+    state changes fires.
+    '''
+
+    def __init__(self, index, result, observable_count, operations, deadline, manager):
+        threading.Thread.__init__(self, name='StressWorker%d' % index)
+        self.daemon = True
+        self.random = random.Random('%s-%d' % (result.seed, index))
+        self.result = result
+        self.operations = operations
+        self.deadline = deadline
+        self.manager = manager
+        self.stopped = False
+        self.progress = 0
+        self.observables = [StressObservable() for count in range(observable_count)]
+        # Observable to {(initial code, final code): set of action classes}
+        self.model = dict((observable, {}) for observable in self.observables)
+
+    def run(self):
+        operations = [self.register, self.register, self.register_many, self.unregister,
+                      self.unregister_all, self.replace, self.poll, self.poll, self.poll, self.poll]
+        try:
+            while not self.stopped and self.progress < self.operations and time.time() < self.deadline:
+                self.random.choice(operations)()
+                self.progress += 1
+        except Exception, e:
+            self.result.violation('%s failed: %s' % (self.name, traceback.format_exc()))
+
+    def choose(self):
+        return self.random.choice(self.observables)
+
+    def expand(self, initial, final):
+        return [(i_code, f_code) for i_code in state_codes(initial) for f_code in state_codes(final)]
+
+    def register(self):
+        observable = self.choose()
+        action = self.random.choice(stress_actions)
+        initial, final = self.random.choice(STRESS_STATES), self.random.choice(STRESS_STATES)
+        observable.register_action(action, initial, final)
+        model = self.model[observable]
+        for codes in self.expand(initial, final):
+            model.setdefault(codes, set()).add(action)
+
+    def register_many(self):
+        registrations = []
+        for count in range(self.random.randint(1, 8)):
+            observable = self.choose()
+            action = self.random.choice(stress_actions)
+            initial, final = self.random.choice(STRESS_STATES), self.random.choice(STRESS_STATES)
+            registrations.append((action, observable, initial, final))
+        self.manager.associate_actions(registrations)
+        for action, observable, initial, final in registrations:
+            model = self.model[observable]
+            for codes in self.expand(initial, final):
+                model.setdefault(codes, set()).add(action)
+
+    def unregister(self):
+        # Only unregister what the model says is registered everywhere.
+        observable = self.choose()
+        action = self.random.choice(stress_actions)
+        initial, final = self.random.choice(STRESS_STATES), self.random.choice(STRESS_STATES)
+        model = self.model[observable]
+        expanded = self.expand(initial, final)
+        if not all(action in model.get(codes, ()) for codes in expanded):
+            return
+        observable.unregister_action(action, initial, final)
+        for codes in expanded:
+            model[codes].discard(action)
+            if not model[codes]:
+                del model[codes]
+
+    def unregister_all(self):
+        observable = self.choose()
+        expected = len(self.model[observable])
+        removed = observable.unregister_all()
+        if removed != expected:
+            self.result.violation('unregister_all() of %s removed %d transitions; %d were registered.' %
+                                  (observable, removed, expected))
+        self.model[observable] = {}
+
+    def replace(self):
+        # Drop an observable without unregistering it; the action manager
+        # must forget it once it is collected.
+        index = self.random.randrange(len(self.observables))
+        del self.model[self.observables[index]]
+        self.observables[index] = StressObservable()
+        self.model[self.observables[index]] = {}
+
+    def poll(self):
+        observable = self.choose()
+        observable.next_result = self.random.random() < 0.5
+        before = observable.get_state()
+        after = observable.check_observation()
+        if after is before:
+            return
+        futures = observable.action_futures
+        self.result.record_futures(futures)
+        expected = self.model[observable].get((before.get_code(), after.get_code()), set())
+        fired = set(future.action for future in futures)
+        if len(futures) != len(fired) or fired != expected:
+            self.result.violation('%s changing from %s to %s fired %s; %s are registered.' %
+                                  (observable, before, after, sorted(fired), sorted(expected)))
+
+
+def format_stacks():
+    '''
+    Return the current stack of every thread.
+    '''
+
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        stacks.append('Thread %s:\n%s' % (names.get(ident, ident), ''.join(traceback.format_stack(frame))))
+    return '\n'.join(stacks)
+
+def check_registry(manager, workers, result):
+    '''
+    Check that the registry of manager describes exactly the models of
+    workers, and that every stripe's reverse indexes describe its mapping.
+    '''
+
+    expected = {}
+    for worker in workers:
+        for observable, model in worker.model.iteritems():
+            for (i_code, f_code), actions in model.iteritems():
+                expected[(observable, i_code, f_code)] = set(actions)
+    registered = dict(((key[0](), key[1], key[2]), actions)
+                      for key, actions in manager.action_mapping.iteritems())
+    if registered != expected:
+        result.violation('The registry holds %d transitions which differ from the %d expected.' %
+                         (len(registered), len(expected)))
+
+    for stripe in manager.stripes:
+        observable_index = {}
+        action_index = {}
+        for key, actions in stripe.action_mapping.iteritems():
+            if manager.stripe(key[0]) is not stripe:
+                result.violation('%s is in stripe %d.' % (key, stripe.index))
+            observable_index.setdefault(key[0], set()).add(key)
+            for action in actions:
+                action_index.setdefault(action, set()).add(key)
+        if stripe.observable_index != observable_index or stripe.action_index != action_index:
+            result.violation('The reverse indexes of stripe %d do not match its mapping.' % stripe.index)
+        if set(stripe.observable_refs) != set(observable_index):
+            result.violation('The references of stripe %d do not match its mapping.' % stripe.index)
+
+def run_stress(seed=0, workers=8, observables=16, operations=2000, duration=None,
+               stall_timeout=10.0, settle_timeout=30.0, manager=None):
+    '''
+    Run workers threads, each owning observables observables, for
+    operations operations each or until duration seconds have passed. The
+    run is declared deadlocked if no thread completes an operation for
+    stall_timeout seconds. Once the threads are done, the actions fired are
+    given up to settle_timeout seconds to complete before the invariants are
+    checked. manager defaults to the action manager singleton, whose
+    registrations are cleared before and after. Returns a StressResult.
+    '''
+
+    if manager is None:
+        manager = action_manager
+    result = StressResult(seed)
+    StressAction.result_record = result
+    manager.clear_mapping()
+    manager.start()
+
+    deadline = time.time() + (duration if duration is not None else float('inf'))
+    threads = [StressWorker(index, result, observables, operations, deadline, manager)
+               for index in range(workers)]
+    result.threads = threads
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+
+    # Watch for progress until every thread is done.
+    progress = -1
+    progressed = time.time()
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(min(0.05, stall_timeout / 4.0))
+        total = sum(thread.progress for thread in threads)
+        if total != progress:
+            progress = total
+            progressed = time.time()
+        elif time.time() - progressed > stall_timeout:
+            result.deadlocked = True
+            result.stacks = format_stacks()
+            for thread in threads:
+                thread.stopped = True
+            break
+    result.elapsed = time.time() - begin
+    result.operations = sum(thread.progress for thread in threads)
+    if result.deadlocked:
+        log.error('No progress for %s seconds; deadlocked.', stall_timeout)
+        return result
+
+    # Every action fired must have been started exactly once, and complete.
+    done, not_done = wait_all(result.futures, settle_timeout)
+    if not_done:
+        result.violation('%d of %d actions did not complete.' % (len(not_done), len(result.futures)))
+    for future in done:
+        if future.exception() is not None:
+            result.violation('%s failed.' % future)
+    starts = result.starts
+    for future in result.futures:
+        if future.done() and starts.get(id(future)) != 1:
+            result.violation('%s was started %s times.' % (future, starts.get(id(future), 0)))
+
+    # Nothing is left running, queued, or registered to forgotten observables.
+    settle = time.time() + settle_timeout
+    while manager.thread_mapping and time.time() < settle:
+        time.sleep(0.01)
+    if manager.thread_mapping:
+        result.violation('%d actions are still tracked as running.' % len(manager.thread_mapping))
+    if not manager.action_queue.empty():
+        result.violation('%d actions remain queued.' % manager.action_queue.qsize())
+    # Futures refer to their observables; let the dropped ones go, down
+    # to the last one bound by the loops above.
+    del done, not_done
+    future = None
+    result.futures = []
+    gc.collect()
+    manager.purge_collected()
+    check_registry(manager, threads, result)
+
+    manager.clear_mapping()
+    return result
+
+# ---
+
+# Run the stress test if this file is called as an executable.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stress the core with concurrent registrations and observations.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--observables', type=int, default=16, help='observables per worker')
+    parser.add_argument('--operations', type=int, default=5000, help='operations per worker')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run at most')
+    parser.add_argument('--stall-timeout', type=float, default=10.0)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run_stress(seed=arguments.seed, workers=arguments.workers,
+                        observables=arguments.observables, operations=arguments.operations,
+                        duration=arguments.duration, stall_timeout=arguments.stall_timeout)
+    print result.summary()
+    action_manager.stop(blocking=True)
+    sys.exit(0 if result.ok() else 1)
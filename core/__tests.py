@@ -8,30 +8,100 @@ https://github.com/btbonval/Generic-Data-Collection-Infrastructure
 
 # TODO Encapsulate repetitive tests into functions to reduce copy/paste error
 
+import os
 import sys
 import time
+import signal
+import socket
+import struct
+import gc
+import json
+import tempfile
+import subprocess
+import multiprocessing
 import logging
+import urllib2
+import weakref
 import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from gdci.core.state import State
+from gdci.core.state import StateSchema
+from gdci.core.state import StatePattern
 from gdci.core.state import StateCollection
+from gdci.core.state import encode
+from gdci.core.state import decode
+from gdci.core.state import freeze_payload
 from gdci.core.action import CoreAction
 from gdci.core.rwlock import LockError
 from gdci.core.rwlock import ReadWriteLock
+from gdci.core.rwlock import ReadWriteState
 from gdci.core.thread import CoreThread
+from gdci.core.thread import spread_phases
+from gdci.core.thread import phase_from_key
 from gdci.core.observable import CoreObserver
 from gdci.core.observable import CoreObservable
 from gdci.core.actionmanager import action_manager
 from gdci.core.actionmanager import CoreActionManager
+from gdci.core.actionmanager import stop_action_manager
+from gdci.core.actionmanager import install_signal_handler
+from gdci.core.actionmanager import registry_key
+from gdci.core.actionmanager import state_codes
+from gdci.core.future import wait_all
+from gdci.core.future import ActionFuture
+from gdci.core.future import TimeoutError
+from gdci.core.metrics import metrics
+from gdci.core.derived import negate
+from gdci.core.derived import input_result
+from gdci.core.derived import all_true
+from gdci.core.derived import any_true
+from gdci.core.derived import DerivedObservable
+from gdci.core.pipeline import action_pipeline
+from gdci.core.pipeline import CoreActionPipeline
+from gdci.core.metrics import MetricsServer
+from gdci.core.profiler import SamplingProfiler
+from gdci.core.transport import encode_frame
+from gdci.core.transport import decode_frames
+from gdci.core.transport import RemoteObservable
+from gdci.core.transport import TransportSender
+from gdci.core.transport import TransportReceiver
+from gdci.core.ringbuffer import RingBuffer
+from gdci.core.ringbuffer import RingConsumer
+from gdci.core.ringbuffer import RingObservable
+from gdci.core.ringbuffer import RingBufferGroup
+from gdci.core.asynclog import AsyncHandler
+from gdci.core.asynclog import RateLimitFilter
+from gdci.core.asynclog import install_async_logging
+from gdci.core.asynclog import remove_async_logging
+from gdci.core.breaker import OPEN
+from gdci.core.breaker import CLOSED
+from gdci.core.breaker import HALF_OPEN
+from gdci.core.breaker import CircuitFleet
+from gdci.core.breaker import CircuitBreaker
+from gdci.core.breaker import circuit_fleet
+from gdci.core.group import ObserverPool
+from gdci.core.group import ObserverGroup
+from gdci.core.snapshot import save_snapshot
+from gdci.core.snapshot import restore_snapshot
+from gdci.core.registration import load_registrations
+from gdci.core.registration import parse_state_pattern
+from gdci.core.registration import compile_registrations
+from gdci.core.threshold import ThresholdBank
+from gdci.core.threshold import RangeObservable
+from gdci.core.threshold import ThresholdObservable
+from gdci.core.threshold import HysteresisObservable
+from gdci.core.threshold import RateOfChangeObservable
+from gdci.core.__stress import run_stress
 
 # ---
 
 # In testing, we like output!
 logging.basicConfig(level=logging.DEBUG)
 
-# Dogpile's logging is too verbose at DEBUG for these testing needs.
-logging.getLogger('dogpile.readwrite_lock').setLevel(logging.INFO)
-
 # Used to tell if a thread has done anything.
 flip_bit = False
 
@@ -346,9 +416,136 @@ def rwlock_tests():
         pass
     else:
         assert(False)
-    greedy_writing_thread.join()
+    greedy_reading_thread.join()
     assert(flip_bit)
 
+def rwlock_policy_tests():
+    # Timed acquisition gives up once the timeout passes.
+    rwlock = ReadWriteLock()
+    held = threading.Event()
+    release = threading.Event()
+    def hold(state):
+        with state:
+            held.set()
+            release.wait()
+    holder = threading.Thread(target=hold, args=(rwlock.Write,))
+    holder.start()
+    held.wait()
+    begin = time.time()
+    assert(not rwlock.acquire_read_lock(timeout=0.2))
+    assert(not rwlock.acquire_write_lock(timeout=0.2))
+    finish = time.time()
+    assert(0.35 < finish - begin < 1)
+    for state in [ReadWriteState(rwlock, 'read', timeout=0.05),
+                  rwlock.ReadWithin(0.05), rwlock.WriteWithin(0.05)]:
+        try:
+            with state:
+                assert(False)
+        except LockError:
+            pass
+        else:
+            assert(False)
+    release.set()
+    holder.join()
+    # Timing out leaves the lock usable.
+    assert(rwlock.acquire_read_lock(timeout=0.2))
+    rwlock.release_read_lock()
+    with rwlock.WriteOrNot:
+        pass
+    with rwlock.ReadWithin(0.05) as lock_response:
+        assert(lock_response is True)
+
+    # Acquiring again before releasing would deadlock, so it raises.
+    for outer, inner in [(rwlock.Read, rwlock.Read), (rwlock.Read, rwlock.Write),
+                         (rwlock.Write, rwlock.Read), (rwlock.Write, rwlock.Write)]:
+        with outer:
+            try:
+                with inner:
+                    assert(False)
+            except LockError:
+                pass
+            else:
+                assert(False)
+    # The outer locks were released.
+    with rwlock.WriteOrNot:
+        pass
+
+    # Only the holder may release.
+    try:
+        rwlock.release_read_lock()
+    except LockError:
+        pass
+    else:
+        assert(False)
+    try:
+        rwlock.release_write_lock()
+    except LockError:
+        pass
+    else:
+        assert(False)
+
+    # Order in which a writer and a reader arriving while readers hold the
+    # lock get it: the writer first with writer preference, otherwise in
+    # order of arrival.
+    def arrival_order(rwlock):
+        order = []
+        held = threading.Event()
+        release = threading.Event()
+        def reader():
+            with rwlock.Read:
+                held.set()
+                release.wait()
+        def record(state, name):
+            with state:
+                order.append(name)
+        threads = [threading.Thread(target=reader),
+                   threading.Thread(target=record, args=(rwlock.Read, 'reader')),
+                   threading.Thread(target=record, args=(rwlock.Write, 'writer')),
+                   threading.Thread(target=record, args=(rwlock.Read, 'late reader'))]
+        threads[0].start()
+        held.wait()
+        for thread in threads[1:]:
+            thread.start()
+            time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return order
+
+    # The reader got in while no writer waited.
+    assert(arrival_order(ReadWriteLock()) == ['reader', 'writer', 'late reader'])
+    # A waiting writer holds back readers arriving after it.
+    assert(arrival_order(ReadWriteLock(fair=True)) == ['reader', 'writer', 'late reader'])
+
+    # With writer preference, a waiting writer holds back even readers which
+    # arrived before it once it is waiting; with fairness they go first.
+    def queued_order(rwlock):
+        order = []
+        held = threading.Event()
+        release = threading.Event()
+        def writer():
+            with rwlock.Write:
+                held.set()
+                release.wait()
+        def record(state, name):
+            with state:
+                order.append(name)
+        threads = [threading.Thread(target=writer),
+                   threading.Thread(target=record, args=(rwlock.Read, 'reader')),
+                   threading.Thread(target=record, args=(rwlock.Write, 'writer'))]
+        threads[0].start()
+        held.wait()
+        for thread in threads[1:]:
+            thread.start()
+            time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return order
+
+    assert(queued_order(ReadWriteLock()) == ['writer', 'reader'])
+    assert(queued_order(ReadWriteLock(fair=True)) == ['reader', 'writer'])
+
 # ---
 
 class ThreadTestOneRun(CoreThread):
@@ -416,6 +613,71 @@ def thread_tests():
 
     # TODO looping tests
 
+class ThreadTestTimes(CoreThread):
+    def before_loop(self):
+        self.times = []
+    def main_loop(self):
+        self.times.append(time.time())
+
+def phase_tests():
+    # Keys map onto the same phase every time.
+    assert(phase_from_key('pumps') == phase_from_key('pumps'))
+    assert(phase_from_key('pumps') != phase_from_key('valves'))
+    assert(0 <= phase_from_key('pumps') < 1)
+
+    # The phase grid.
+    test1 = ThreadTestTimes(loop_interval=2.0, phase=0.25)
+    assert(test1.phase_time(10.5) == 10.5)
+    assert(test1.phase_time(11.0) == 10.5)
+    assert(test1.phase_time(12.4) == 10.5)
+    assert(test1.phase_time(12.5) == 12.5)
+    assert(ThreadTestTimes(phase='pumps').phase == phase_from_key('pumps'))
+
+    # Groups are spread evenly across the interval.
+    test2 = [ThreadTestTimes() for i in range(4)]
+    spread_phases(test2)
+    assert([thread.phase for thread in test2] == [0.0, 0.25, 0.5, 0.75])
+    spread_phases(test2, offset=0.5)
+    assert([thread.phase for thread in test2] == [0.5, 0.75, 0.0, 0.25])
+    spread_phases(test2, offset='pumps')
+    assert(test2[0].phase == phase_from_key('pumps'))
+
+    # Threads started together run at their phases rather than together.
+    interval = 0.2
+    test3 = [ThreadTestTimes(loop_interval=interval, sleep_delay=0.002)
+             for i in range(2)]
+    spread_phases(test3)
+    for thread in test3:
+        thread.start()
+    time.sleep(3*interval)
+    for thread in test3:
+        thread.stop(blocking=True)
+    for thread in test3:
+        assert(len(thread.times) >= 2)
+        for run in thread.times:
+            # Distance from the phase grid, wrapping around the interval.
+            error = (run - thread.phase*interval) % interval
+            assert(min(error, interval - error) < 0.03)
+
+    # Jitter is reproducible for a given seed and bounded by the fraction.
+    # It moves each loop within its interval without lengthening the
+    # intervals, so the mean period stays loop_interval.
+    test4 = [ThreadTestTimes(loop_interval=0.02, jitter=0.5, jitter_seed=7)
+             for i in range(2)]
+    for thread in test4:
+        thread.start()
+    time.sleep(1.0)
+    for thread in test4:
+        thread.stop(blocking=True)
+    for thread in test4:
+        assert(len(thread.times) > 20)
+        # Each loop runs within the fraction after its scheduled time.
+        offsets = [run - thread.times[0] - index*0.02 for index, run in enumerate(thread.times)]
+        assert(min(offsets) >= -0.001)
+        assert(max(offsets) < 0.02*0.5 + 0.03)
+        period = (thread.times[-1] - thread.times[0]) / (len(thread.times) - 1)
+        assert(abs(period - 0.02) < 0.002)
+
 # ---
 
 class ActionTest1(CoreAction):
@@ -550,12 +812,20 @@ def observable_tests():
     test5 = test4.check_observation()
     assert(test5.get_secondary('data') == 3)
 
+    # A bad result is logged, without a traceback as nothing was raised.
     test6 = DataCrashedObservable()
+    handler = ListHandler()
+    logging.getLogger('Observables').addHandler(handler)
     try:
         test6.check_observation()
         assert(False)
     except TypeError:
         pass
+    finally:
+        logging.getLogger('Observables').removeHandler(handler)
+    assert(len(handler.records) == 1)
+    assert('returned (True, None, None)' in handler.messages[0])
+    assert(handler.records[0].exc_info is None)
 
 # ---
 
@@ -601,6 +871,53 @@ def observer_tests(hard=False):
 
     #del counter
 
+class ToggleObserver(CoreObserver):
+    value = False
+    def get_observation(self):
+        return self.value
+
+def adaptive_observer_tests():
+    # Without adaptive mode, the interval is fixed.
+    test1 = ToggleObserver(loop_interval=0.5)
+    for i in range(3):
+        test1.main_loop()
+    assert(test1.loop_interval == 0.5)
+    assert(test1.get_polling_rate() == 2.0)
+
+    # Back off exponentially while stable, up to max_interval.
+    test2 = ToggleObserver(loop_interval=0.1, adaptive=True, max_interval=0.5)
+    assert(test2.min_interval == 0.1)
+    assert(test2.sleep_delay == 0.01)
+    test2.main_loop() # first observation is a change
+    assert(test2.loop_interval == 0.1)
+    test2.main_loop()
+    assert(abs(test2.loop_interval - 0.2) < 1e-9)
+    test2.main_loop()
+    assert(abs(test2.loop_interval - 0.4) < 1e-9)
+    test2.main_loop()
+    assert(test2.loop_interval == 0.5)
+    assert(test2.get_polling_rate() == 2.0)
+
+    # A change tightens the interval again.
+    test2.value = True
+    test2.main_loop()
+    assert(test2.loop_interval == 0.1)
+    assert(abs(test2.get_polling_rate() - 10.0) < 1e-9)
+
+    # Bounds are validated.
+    try:
+        ToggleObserver(adaptive=True, min_interval=2, max_interval=1)
+        assert(False)
+    except ValueError:
+        pass
+
+    # The thread polls quickly, then slowly.
+    test3 = ToggleObserver(loop_interval=0.01, adaptive=True, backoff=4, max_interval=0.64)
+    test3.start()
+    time.sleep(0.3)
+    test3.stop(blocking=True)
+    assert(test3.loop_interval == 0.64)
+
 # ---
 
 flip_bit = False
@@ -671,6 +988,1803 @@ def am_tests():
 
 # ---
 
+class HotObservable(ThresholdObservable):
+    limit = 10
+    deadband = 2
+    value = 0
+    def read_value(self):
+        return self.value
+
+class ColdObservable(ThresholdObservable):
+    limit = 0
+    above = False
+    value = 0
+    def read_value(self):
+        return self.value
+
+class BandObservable(HysteresisObservable):
+    low = 1
+    high = 3
+
+class OutsideObservable(RangeObservable):
+    low = -1
+    high = 1
+    inside = False
+
+class RisingObservable(RateOfChangeObservable):
+    limit = 1
+
+def threshold_tests():
+    # Threshold with deadband: on above 10, off at 8 or below.
+    test1 = HotObservable()
+    for value, expected in [(5, False), (10, False), (11, True), (9, True),
+                            (8, False), (9, False), (10.5, True)]:
+        test1.value = value
+        state = test1.check_observation()
+        assert(state == State(True, expected))
+        assert(state.get_secondary('value') == value)
+
+    # Threshold below without deadband.
+    test2 = ColdObservable()
+    test2.value = -1
+    assert(test2.check_observation() == State(True, True))
+    test2.value = 0
+    assert(test2.check_observation() == State(True, False))
+
+    # Hysteresis band holds its result, starting from None.
+    test3 = BandObservable()
+    assert(test3.observe_value(2)[0] is None)
+    assert(test3.observe_value(3)[0] is True)
+    assert(test3.observe_value(2)[0] is True)
+    assert(test3.observe_value(1)[0] is False)
+    assert(test3.observe_value(2)[0] is False)
+
+    # Range inverted to outside.
+    test4 = OutsideObservable()
+    assert(test4.observe_value(0)[0] is False)
+    assert(test4.observe_value(2)[0] is True)
+
+    # Rate of change: none for the first reading, then units per second.
+    test5 = RisingObservable()
+    assert(test5.observe_value(0, now=10.0) == (None, {'value': 0, 'rate': None}))
+    assert(test5.observe_value(3, now=11.0)[0] is True)
+    assert(test5.observe_value(3.5, now=12.0) == (False, {'value': 3.5, 'rate': 0.5}))
+
+    # The bank agrees with the closures, vectorized or not.
+    values = [[5, -1, 2, 0], [11, 0, 3, 2], [9, -2, 2, 0.5], [8, 1, 1, -3]]
+    for vectorize in [True, False]:
+        members = [HotObservable(), ColdObservable(), BandObservable(),
+                   OutsideObservable()]
+        singles = [HotObservable(), ColdObservable(), BandObservable(),
+                   OutsideObservable()]
+        bank = ThresholdBank(members, vectorize=vectorize)
+        for row in values:
+            expected = [s.observe_value(v) for s, v in zip(singles, row)]
+            assert(bank.evaluate(row) == expected)
+
+    # Bank results feed the observables' States.
+    members = [HotObservable(), BandObservable()]
+    bank = ThresholdBank(members)
+    states = bank.check_observations([11, 0])
+    assert(states[0] == State(True, True))
+    assert(states[1] == State(True, False))
+    assert(states[1].get_secondary('value') == 0)
+
+    # Rates cannot be evaluated in a vectorized bank.
+    if ThresholdBank([]).vectorized:
+        try:
+            ThresholdBank([RisingObservable()])
+            assert(False)
+        except NotImplementedError:
+            pass
+
+# ---
+
+def metrics_tests():
+    global flip_bit
+
+    server = MetricsServer(port=0)
+    server.start()
+    try:
+        assert(metrics.enabled)
+
+        # Record an observation, a state change, and a fired action.
+        test1 = TrueObservable()
+        test1.register_action(ActionTest1, State(None, None), State(True, True))
+        flip_bit = False
+        test1.check_observation()
+        begin = time.time()
+        while (not flip_bit or len(action_manager.thread_mapping)) and \
+              time.time() - begin < 1:
+            time.sleep(0.01)
+        assert(flip_bit)
+        time.sleep(0.05)
+
+        url = 'http://%s:%d/metrics' % server.address
+        text = urllib2.urlopen(url, timeout=5).read()
+        assert('gdci_action_queue_length 0' in text)
+        assert('gdci_observations_total{observable="TrueObservable"} 1' in text)
+        assert('gdci_state_changes_total{observable="TrueObservable"} 1' in text)
+        assert('gdci_actions_started_total{action="ActionTest1"} 1' in text)
+        assert('gdci_actions_completed_total{action="ActionTest1"} 1' in text)
+        assert('# TYPE gdci_running_actions gauge' in text)
+
+        # Only /metrics is served.
+        try:
+            urllib2.urlopen(url + '/other', timeout=5)
+            assert(False)
+        except urllib2.HTTPError, e:
+            assert(e.code == 404)
+
+        # Serving does not need the locks.
+        with action_manager.queue_lock.Write:
+            with action_manager.stripe(test1).lock.Write:
+                assert('gdci_threads' in urllib2.urlopen(url, timeout=5).read())
+
+        test1.unregister_action(ActionTest1, State(None, None), State(True, True))
+    finally:
+        server.stop()
+        metrics.disable()
+        metrics.reset()
+    assert(server.address is None)
+
+# ---
+
+def lifecycle_tests():
+    global flip_bit
+
+    # Importing the core starts no threads and installs no signal handlers.
+    code = '; '.join([
+        'import signal, threading',
+        'import gdci.core.action, gdci.core.observable',
+        'assert threading.active_count() == 1',
+        'assert signal.getsignal(signal.SIGINT) is signal.default_int_handler'])
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([path for path in sys.path if path])
+    assert(subprocess.call([sys.executable, '-c', code], env=env) == 0)
+
+    # Stopping disables auto start; queued actions wait for start().
+    action_manager.stop(blocking=True)
+    assert(not action_manager.is_running())
+    flip_bit = False
+    test1 = TrueObservable()
+    test1.register_action(ActionTest1, State(None, None), State(True, True))
+    test1.check_observation()
+    time.sleep(0.2)
+    assert(not flip_bit)
+    assert(not action_manager.is_running())
+
+    # The context manager starts and stops the dispatcher.
+    with action_manager as manager:
+        assert(manager is action_manager)
+        assert(action_manager.is_running())
+        begin = time.time()
+        while not flip_bit and time.time() - begin < 1:
+            time.sleep(0.01)
+        assert(flip_bit)
+    assert(not action_manager.is_running())
+
+    # The dispatcher can be restarted, and start() is idempotent.
+    assert(action_manager.start() is True)
+    assert(action_manager.start() is False)
+    action_manager.stop(blocking=True)
+    assert(not action_manager.is_running())
+
+    # start() enables auto start again after stop() disabled it.
+    action_manager.auto_start = True
+    action_manager.stop(blocking=True)
+    assert(not action_manager.auto_start)
+    action_manager.start()
+    assert(action_manager.auto_start)
+
+    # Shutting down dispatches the queued actions and waits for them, or
+    # discards them, failing their futures.
+    test1.register_action(ActionTest1, State(True, True), State(True, False))
+    action_manager.stop(blocking=True)
+    flip_bit = False
+    future, = action_manager.check_state_change(test1, State(True, True), State(True, False))
+    assert(action_manager.shutdown(timeout=2) == 0)
+    assert(future.done() and flip_bit)
+    future, = action_manager.check_state_change(test1, State(True, True), State(True, False))
+    suppress_errors()
+    try:
+        assert(action_manager.shutdown(drain=False) == 1)
+    finally:
+        show_errors()
+    assert(isinstance(future.exception(timeout=0), RuntimeError))
+    assert(action_manager.action_queue.empty())
+    test1.unregister_action(ActionTest1, State(True, True), State(True, False))
+
+    # Actions queued as the interpreter exits are still performed, and the
+    # dispatcher ends cleanly.
+    code = '\n'.join([
+        'import time',
+        'from gdci.core.action import CoreAction',
+        'from gdci.core.state import State',
+        'from gdci.core.observable import CoreObservable',
+        'class Late(CoreAction):',
+        '    def perform_action(self):',
+        '        time.sleep(0.2)',
+        '        print "performed"',
+        'class Source(CoreObservable):',
+        '    def get_observation(self):',
+        '        return True',
+        'source = Source()',
+        'source.register_action(Late, State(None, None), State(True, True))',
+        'source.check_observation()'])
+    child = subprocess.Popen([sys.executable, '-c', code], env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = child.communicate()
+    assert(child.returncode == 0)
+    assert(out.strip() == 'performed')
+    assert('Traceback' not in err)
+
+    # The signal handler is only installed on request.
+    previous = install_signal_handler()
+    assert(signal.getsignal(signal.SIGINT) is stop_action_manager)
+    signal.signal(signal.SIGINT, previous)
+
+    test1.unregister_action(ActionTest1, State(None, None), State(True, True))
+    action_manager.auto_start = True
+
+# ---
+
+def busy_wait(seconds):
+    begin = time.time()
+    while time.time() - begin < seconds:
+        pass
+
+class BusyObserver(CoreObserver):
+    def get_observation(self):
+        busy_wait(0.02)
+        return True
+
+class BusyObservable(CoreObservable):
+    def get_observation(self):
+        busy_wait(0.3)
+        return True
+
+class BusyAction(CoreAction):
+    def perform_action(self):
+        busy_wait(0.3)
+
+def profiler_tests():
+    test1 = SamplingProfiler(interval=0.002)
+    assert(test1.start())
+    assert(not test1.start())
+
+    # An observer thread, an action thread, and an observable polled from a
+    # plain thread should each be attributed by class.
+    test2 = BusyObserver(loop_interval=0.01)
+    test2.start()
+    test3 = BusyAction(TrueObservable(), State(), State(True, True))
+    action_manager.thread_mapping[test3] = None
+    test3.start()
+    test4 = threading.Thread(target=BusyObservable().check_observation)
+    test4.start()
+    test4.join()
+    test3.join()
+    test2.stop(blocking=True)
+
+    assert(test1.stop())
+    assert(not test1.stop())
+
+    totals = test1.totals()
+    assert(totals.get('observer:BusyObserver', 0) > 0)
+    assert(totals.get('action:BusyAction', 0) > 0)
+    assert(totals.get('observable:BusyObservable', 0) > 0)
+    lines = test1.collapsed()
+    assert([line for line in lines if line.startswith('observable:TrueObservable;action:BusyAction;') and 'perform_action' in line])
+    assert([line for line in lines if line.startswith('observer:BusyObserver;') and 'get_observation' in line])
+
+    # No samples are taken while stopped.
+    samples = test1.samples
+    time.sleep(0.05)
+    assert(test1.samples == samples)
+    test1.reset()
+    assert(test1.collapsed() == [])
+
+# ---
+
+class RemoteToggle(RemoteObservable):
+    value = False
+    def get_observation(self):
+        return (self.value, {'reading': int(self.value)})
+
+class QualityState(State):
+    schema = StateSchema(['is_operating', 'result', 'quality'])
+
+class RemoteQuality(RemoteObservable):
+    state_class = QualityState
+    def get_observation(self):
+        return (True, {'quality': True})
+
+class RecordingAction(CoreAction):
+    # Shared by every test using it; reset before use.
+    records = []
+    def perform_action(self):
+        RecordingAction.records.append(
+            (self.observable, self.initial_state, self.final_state))
+
+def wait_for(condition, timeout=2.0):
+    begin = time.time()
+    while not condition() and time.time() - begin < timeout:
+        time.sleep(0.01)
+    return condition()
+
+def transport_tests():
+    # Frames decode back to the records, leaving partial frames.
+    records = [['a', [True, False], [True, True], 1.5, {'x': 1}]]
+    frame = encode_frame(records)
+    assert(decode_frames(frame + frame[:5]) == ([records], frame[:5]))
+    assert(decode_frames(frame[:3]) == ([], frame[:3]))
+
+    # Frames are JSON, never pickles, and hold only valid records.
+    # Attributes JSON cannot encode are left out.
+    suppress_errors()
+    try:
+        frame = encode_frame([('b', (None, None), (True, False), 2.0, {'x': 2, 'raw': '\xff', 'obj': object()})])
+    finally:
+        show_errors()
+    assert(decode_frames(frame) == ([[['b', [None, None], [True, False], 2.0, {'x': 2}]]], ''))
+    for body in ['cos\nsystem\n(S"true"\ntR.', '{"a": 1}', '[["a", [], [], 1.5]]', '[["a", [], [], "now", {}]]']:
+        try:
+            decode_frames(struct.pack('!I', len(body)) + body)
+            assert(False)
+        except ValueError:
+            pass
+
+    # Localhost TCP and a Unix socket both deliver state changes.
+    socket_path = os.path.join(tempfile.mkdtemp(), 'transport.sock')
+    for address in [('127.0.0.1', 0), socket_path]:
+        receiver = TransportReceiver(address)
+        received = receiver.observable('edge/toggle')
+        received.register_action(RecordingAction, State('*', '*'), State('*', '*'))
+        receiver.start()
+        sender = TransportSender(receiver.address, loop_interval=0.01)
+        sender.start()
+
+        RecordingAction.records = []
+        test1 = RemoteToggle(sender, 'edge/toggle')
+        test1.check_observation()
+        test1.value = True
+        test1.check_observation()
+        assert(wait_for(lambda: len(RecordingAction.records) == 2))
+        # Actions run in threads of their own, so they may record out of order.
+        observable, initial, final = [record for record in RecordingAction.records if record[2].result][0]
+        assert(observable is received)
+        assert(initial == State(True, False))
+        assert(final == State(True, True))
+        assert(final.get_secondary('reading') == 1)
+        assert(initial.get_secondary('reading') == 0)
+        assert(received.get_state() == State(True, True))
+        assert(sender.sent == 2 and sender.dropped == 0)
+
+        sender.stop(blocking=True)
+        receiver.stop(blocking=True)
+        received.unregister_action(RecordingAction, State('*', '*'), State('*', '*'))
+
+    # Records are buffered, bounded, and delivered in order after the
+    # receiver becomes reachable.
+    receiver = TransportReceiver(('127.0.0.1', 0))
+    address = receiver.address
+    receiver.after_loop()
+    sender = TransportSender(address, max_buffer=3, reconnect_delay=0.01)
+    test2 = RemoteToggle(sender, 'edge/buffered')
+    for i in range(5):
+        test2.value = not test2.value
+        test2.check_observation()
+    assert(sender.pending() == 3 and sender.dropped == 2)
+    assert(not sender.flush())
+    assert(sender.pending() == 3)
+
+    receiver = TransportReceiver(address)
+    received = receiver.observable('edge/buffered')
+    RecordingAction.records = []
+    received.register_action(RecordingAction, State('*', '*'), State('*', '*'))
+    receiver.start()
+    assert(wait_for(sender.flush))
+    assert(wait_for(lambda: len(RecordingAction.records) == 3))
+    finals = sorted((final for observable, initial, final in RecordingAction.records),
+                    key=lambda final: final.get_secondary('transport_timestamp'))
+    assert([final.result for final in finals] == [True, False, True])
+    sender.disconnect()
+
+    # A frame cut off by its connection closing is counted as lost.
+    frame = encode_frame([('edge/buffered', (True, True), (True, False), 3.0, {})])
+    partial = socket.create_connection(receiver.address)
+    partial.sendall(frame[:-2])
+    time.sleep(0.1)
+    partial.close()
+    assert(wait_for(lambda: receiver.truncated == 1))
+    assert(len(RecordingAction.records) == 3)
+    receiver.stop(blocking=True)
+    received.unregister_action(RecordingAction, State('*', '*'), State('*', '*'))
+
+    # States are rebuilt with the state_class of the remote observable.
+    receiver = TransportReceiver(('127.0.0.1', 0))
+    received = receiver.observable('edge/quality', QualityState)
+    RecordingAction.records = []
+    received.register_action(RecordingAction, QualityState('*', '*', '*'), QualityState('*', '*', '*'))
+    receiver.start()
+    sender = TransportSender(receiver.address, loop_interval=0.01)
+    sender.start()
+    test3 = RemoteQuality(sender, 'edge/quality')
+    test3.check_observation()
+    assert(wait_for(lambda: len(RecordingAction.records) == 1))
+    observable, initial, final = RecordingAction.records[0]
+    assert(isinstance(final, QualityState))
+    assert(final == QualityState(True, True, True))
+    assert(received.get_observation() is True)
+    assert(input_result(received) is True)
+    sender.stop(blocking=True)
+    receiver.stop(blocking=True)
+    received.unregister_action(RecordingAction, QualityState('*', '*', '*'), QualityState('*', '*', '*'))
+
+# ---
+
+class RingToggle(RingObservable):
+    value = False
+    def get_observation(self):
+        return (self.value, {'payload': 'on' if self.value else 'off'})
+
+class RingQuality(RingObservable):
+    state_class = QualityState
+    def get_observation(self):
+        return (True, {'quality': False})
+
+def ring_producer(ring, observable_id, count):
+    # Runs in a forked process.
+    test = RingToggle(ring, observable_id)
+    for i in range(count):
+        test.value = not test.value
+        test.check_observation()
+
+def ringbuffer_tests():
+    # Records round trip in order; a full ring drops and counts.
+    test1 = RingBuffer(capacity=2, payload_size=4)
+    assert(test1.get() is None)
+    assert(test1.put(7, (None, None), (True, False), 1.5, 'abcd'))
+    assert(test1.put(8, (True, False), (False, None), 2.5))
+    assert(not test1.put(9, (True, True), (True, True)))
+    assert(test1.dropped == 1 and len(test1) == 2)
+    assert(test1.get() == (7, (None, None), (True, False), 1.5, 'abcd'))
+    assert(test1.put(9, (True, True), (True, True), 3.5))
+    assert(test1.drain() == [(8, (True, False), (False, None), 2.5, ''),
+                             (9, (True, True), (True, True), 3.5, '')])
+    try:
+        test1.put(1, (True, True), (True, True), payload='too long')
+        assert(False)
+    except ValueError:
+        pass
+
+    # A ring with a path can be attached to.
+    path = os.path.join(tempfile.mkdtemp(), 'ring')
+    test2 = RingBuffer(capacity=4, path=path)
+    test3 = RingBuffer.attach(path)
+    assert(test3.capacity == 4)
+    test2.put(1, (True, True), (True, False), 4.5)
+    assert(test3.get() == (1, (True, True), (True, False), 4.5, ''))
+    test3.close()
+    test2.close()
+
+    # Producers in other processes feed the action manager through a
+    # consumer polled by the dispatcher thread.
+    # States are rebuilt with the state_class of the producing observable.
+    ring = RingBuffer(capacity=4)
+    consumer = RingConsumer(ring)
+    received = consumer.observable(3, QualityState)
+    RingQuality(ring, 3).check_observation()
+    assert(consumer.poll() == 1)
+    assert(isinstance(received.get_state(), QualityState))
+    assert(received.get_state() == QualityState(True, True, False))
+    ring.close()
+
+    group = RingBufferGroup(2, capacity=64, payload_size=8)
+    consumer = RingConsumer(group)
+    RecordingAction.records = []
+    for observable_id in [1, 2]:
+        consumer.observable(observable_id).register_action(RecordingAction, State('*', '*'), State('*', '*'))
+    producers = [multiprocessing.Process(target=ring_producer, args=(group.ring(index), index + 1, 5))
+                 for index in range(2)]
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+        assert(producer.exitcode == 0)
+    assert(len(group) == 10)
+
+    action_manager.add_source(consumer)
+    assert(wait_for(lambda: len(RecordingAction.records) == 10))
+    action_manager.remove_source(consumer)
+    assert(len(group) == 0 and consumer.received == 10)
+
+    for observable_id in [1, 2]:
+        received = consumer.observable(observable_id)
+        # Actions run in threads of their own, so they may record out of order.
+        finals = sorted((final for observable, initial, final in RecordingAction.records if observable is received),
+                        key=lambda final: final.get_secondary('transport_timestamp'))
+        assert([final.result for final in finals] == [True, False, True, False, True])
+        assert(finals[0].get_secondary('payload') == 'on')
+        assert(finals[1].get_secondary('payload') == 'off')
+        assert(received.get_state() == State(True, True))
+        received.unregister_action(RecordingAction, State('*', '*'), State('*', '*'))
+    group.close()
+
+# ---
+
+def registration_tests():
+    # Patterns parse to the same States as the constructor.
+    assert(parse_state_pattern('T,F') == State(True, False))
+    assert(parse_state_pattern(' * , none') == State('*', None))
+    assert(parse_state_pattern('[tf], *') == State('[TF]', '*'))
+    for bad in ['T,X', 7, {'result': 'T'}]:
+        try:
+            parse_state_pattern(bad)
+            assert(False)
+        except ValueError, e:
+            assert(repr(bad) in str(e))
+
+    try:
+        # Bulk registration builds the same mapping as individual calls.
+        test1 = TrueObservable()
+        test2 = FalseObservable()
+        registrations = [(ActionTest1, test1, State('*', False), State('*', True)),
+                         ([ActionTest1, ActionTest2], test2, State(True, True), State('*', '*')),
+                         (ActionTest2, test1, State(True, False), State(None, True))]
+        action_manager.clear_mapping()
+        for registration in registrations:
+            action_manager.associate_action_with_state_change(*registration)
+        expected = action_manager.action_mapping
+        action_manager.clear_mapping()
+        action_manager.associate_actions(iter(registrations))
+        assert(action_manager.action_mapping == expected)
+        assert(len(expected) == 9 + 9)
+        assert(expected[registry_key(test1, State(True, False).get_code(), State(None, True).get_code())] == set([ActionTest1, ActionTest2]))
+
+        # A config compiles to the same mapping too.
+        config = {'registrations': [
+            {'observable': 'one', 'action': '__main__.ActionTest1',
+             'initial': '*,F', 'final': '*,T'},
+            {'observable': ['two'], 'action': ['first', 'second'],
+             'initial': 'T,T', 'final': '*,*'},
+            {'observable': 'one', 'action': 'second',
+             'initial': ['T,F'], 'final': 'N,T'}]}
+        observables = {'one': test1, 'two': test2}
+        actions = {'first': ActionTest1, 'second': ActionTest2}
+        compiled = compile_registrations(config, observables, actions)
+        assert(dict((registry_key(*key), actions) for key, actions in compiled.iteritems()) == expected)
+
+        # Loading installs it.
+        action_manager.clear_mapping()
+        path = os.path.join(tempfile.mkdtemp(), 'registrations.json')
+        with open(path, 'w') as config_file:
+            json.dump(config, config_file)
+        assert(load_registrations(path, observables, actions) == len(expected))
+        assert(action_manager.action_mapping == expected)
+
+        # Invalid configs install nothing.
+        action_manager.clear_mapping()
+        for bad in [{'observable': 'three', 'action': 'first', 'initial': '*,*', 'final': '*,*'},
+                    {'observable': 'one', 'action': 'third', 'initial': '*,*', 'final': '*,*'},
+                    {'observable': 'one', 'action': 'no.such.Action', 'initial': '*,*', 'final': '*,*'},
+                    {'observable': 'one', 'action': 'first', 'initial': '*,Q', 'final': '*,*'},
+                    {'observable': 'one', 'action': 'first', 'initial': 1, 'final': '*,*'},
+                    {'observable': 'one', 'action': 'first', 'initial': '*,*', 'final': {'result': 'T'}}]:
+            suppress_errors()
+            try:
+                compile_registrations({'registrations': config['registrations'] + [bad]}, observables, actions)
+                assert(False)
+            except ValueError, e:
+                assert('Invalid registration 3' in str(e))
+            finally:
+                show_errors()
+        assert(action_manager.action_mapping == {})
+    finally:
+        action_manager.clear_mapping()
+
+# ---
+
+def check_reverse_indexes():
+    # The reverse indexes must describe exactly the action mapping.
+    observable_index = {}
+    action_index = {}
+    for key, actions in action_manager.action_mapping.iteritems():
+        assert(len(actions) > 0)
+        observable_index.setdefault(key[0], set()).add(key)
+        for action in actions:
+            action_index.setdefault(action, set()).add(key)
+    assert(action_manager.observable_index == observable_index)
+    assert(action_manager.action_index == action_index)
+    assert(set(action_manager.observable_refs) == set(observable_index))
+    # Each stripe holds the registrations of its own observations only.
+    for stripe in action_manager.stripes:
+        for key in stripe.action_mapping:
+            assert(action_manager.stripe(key[0]) is stripe)
+            assert(key in stripe.observable_index[key[0]])
+        for action, keys in stripe.action_index.iteritems():
+            assert(keys.issubset(stripe.action_mapping))
+
+def reverse_index_tests():
+    try:
+        action_manager.clear_mapping()
+        test1 = TrueObservable()
+        test2 = FalseObservable()
+        test1.register_action(ActionTest1, State('*', False), State('*', True))
+        test1.register_action([ActionTest1, ActionTest2], State(True, True), State(True, False))
+        test2.register_action(ActionTest1, State(True, '*'), State(False, '*'))
+        test2.register_action(ActionTest2, State(True, True), State(None, None))
+        check_reverse_indexes()
+        assert(len(action_manager.observable_index[weakref.ref(test1)]) == 10)
+        assert(len(action_manager.action_index[ActionTest2]) == 2)
+
+        # Individual unregistration keeps the indexes up to date.
+        test1.unregister_action(ActionTest2, State(True, True), State(True, False))
+        check_reverse_indexes()
+        assert(len(action_manager.action_index[ActionTest2]) == 1)
+
+        # Removing an action removes it from every observable.
+        assert(action_manager.disassociate_all(ActionTest1) == 19)
+        check_reverse_indexes()
+        assert(action_manager.action_mapping.keys() == [registry_key(test2, State(True, True).get_code(), State().get_code())])
+        assert(ActionTest1 not in action_manager.action_index)
+        assert(weakref.ref(test1) not in action_manager.observable_index)
+
+        # Removing an observable removes every action of it.
+        test1.register_action(ActionTest1, State('*', False), State('*', True))
+        assert(test2.unregister_all() == 1)
+        check_reverse_indexes()
+        assert(weakref.ref(test2) not in action_manager.observable_index)
+        assert(ActionTest2 not in action_manager.action_index)
+        assert(len(action_manager.action_mapping) == 9)
+        assert(test1.unregister_all() == 9)
+        assert(test1.unregister_all() == 0)
+        assert(action_manager.disassociate_all(ActionTest1) == 0)
+        check_reverse_indexes()
+        assert(action_manager.action_mapping == {})
+
+        # Actions of a removed observable are not fired.
+        global flip_bit
+        flip_bit = False
+        test1.register_action(ActionTest1, State(None, None), State(True, True))
+        test1.unregister_all()
+        test1.check_observation()
+        time.sleep(0.3)
+        assert(flip_bit == False)
+    finally:
+        action_manager.clear_mapping()
+
+def weak_registry_tests():
+    try:
+        action_manager.clear_mapping()
+
+        # Registering actions does not keep an observable alive.
+        test1 = TrueObservable()
+        reference = weakref.ref(test1)
+        test1.register_action(ActionTest1, State(True, '*'), State('*', True))
+        test2 = FalseObservable()
+        test2.register_action(ActionTest2, State(True, '*'), State('*', True))
+        assert(len(action_manager.action_mapping) == 18)
+        del test1
+        assert(reference() is None)
+
+        # Its registrations go at the next opportunity; others stay.
+        action_manager.purge_collected()
+        check_reverse_indexes()
+        assert(len(action_manager.action_mapping) == 9)
+        assert(ActionTest1 not in action_manager.action_index)
+        assert(action_manager.pending_purge == [])
+
+        # A registry which churns through observables does not grow.
+        def cycle():
+            observables = [TrueObservable() for index in range(50)]
+            action_manager.associate_actions(
+                (ActionTest1, observable, State(True, '*'), State(False, '*'))
+                for observable in observables)
+            assert(len(action_manager.observable_index) == 51)
+            for observable in observables[::2]:
+                observable.check_observation()
+
+        cycle()
+        action_manager.purge_collected()
+        gc.collect()
+        footprint = len(gc.get_objects())
+        for repeat in range(200):
+            cycle()
+        action_manager.purge_collected()
+        gc.collect()
+        check_reverse_indexes()
+        assert(len(action_manager.action_mapping) == 9)
+        assert(len(action_manager.observable_refs) == 1)
+        assert(len(gc.get_objects()) - footprint < 100)
+        assert(len([obj for obj in gc.get_objects() if isinstance(obj, TrueObservable)]) == 0)
+
+        # Threads purging at once share out the references pending, and
+        # none are lost. Switching threads often widens any race.
+        errors = []
+        interval = sys.getcheckinterval()
+        def purge():
+            try:
+                for repeat in range(20):
+                    action_manager.purge_collected()
+            except Exception, e:
+                errors.append(e)
+        for repeat in range(5):
+            observables = [TrueObservable() for index in range(200)]
+            action_manager.associate_actions(
+                (ActionTest1, observable, State(True, True), State(False, True))
+                for observable in observables)
+            # The dispatcher may purge some of these too.
+            del observables
+            purgers = [threading.Thread(target=purge) for index in range(4)]
+            sys.setcheckinterval(1)
+            try:
+                for purger in purgers:
+                    purger.start()
+                for purger in purgers:
+                    purger.join()
+            finally:
+                sys.setcheckinterval(interval)
+            assert(errors == [])
+            assert(action_manager.pending_purge == [])
+            assert(len(action_manager.observable_refs) == 1)
+        check_reverse_indexes()
+    finally:
+        action_manager.clear_mapping()
+
+class ReturningAction(CoreAction):
+    def perform_action(self):
+        time.sleep(0.1)
+        return self.final_state.get_primary()
+
+class RaisingAction(CoreAction):
+    def perform_action(self):
+        raise ValueError('Failing on purpose.')
+
+class SlowAction(CoreAction):
+    def perform_action(self):
+        time.sleep(1)
+
+def future_tests():
+    # Futures on their own.
+    future = ActionFuture(ActionTest1, None, State(), State())
+    called = []
+    future.add_done_callback(called.append)
+    assert(not future.done())
+    try:
+        future.result(timeout=0.05)
+        assert(False)
+    except TimeoutError:
+        pass
+    future.set_result(3)
+    assert(future.done() and future.result() == 3 and future.exception() is None)
+    assert(called == [future])
+    future.add_done_callback(called.append)
+    assert(called == [future, future])
+    suppress_errors()
+    try:
+        future.set_result(4)
+        assert(False)
+    except RuntimeError:
+        pass
+    finally:
+        show_errors()
+
+    try:
+        action_manager.clear_mapping()
+        test1 = TrueObservable()
+        test1.register_action([ReturningAction, RaisingAction], State(None, None), State(True, True))
+        test1.register_action(SlowAction, State(True, True), State(True, False))
+
+        # A state change returns a future for each action fired.
+        assert(action_manager.check_state_change(test1, State(False, False), State(True, True)) == [])
+        suppress_errors()
+        try:
+            test1.check_observation()
+            futures = test1.action_futures
+            done, not_done = wait_all(futures, timeout=2)
+        finally:
+            show_errors()
+        assert(set(future.action for future in futures) == set([ReturningAction, RaisingAction]))
+        assert(len(done) == 2 and len(not_done) == 0)
+        for future in futures:
+            assert(isinstance(future.thread, future.action))
+            future.thread.join()
+            if future.action is ReturningAction:
+                assert(future.result() == (True, True))
+                assert(future.exception() is None)
+            else:
+                try:
+                    future.result()
+                    assert(False)
+                except ValueError:
+                    pass
+                assert(isinstance(future.exception(), ValueError))
+        # Actions are no longer tracked once their futures are resolved.
+        assert(len(action_manager.thread_mapping) == 0)
+
+        # Waiting gives up at the timeout.
+        futures = action_manager.check_state_change(test1, State(True, True), State(True, False))
+        resolved = threading.Event()
+        futures[0].add_done_callback(lambda future: resolved.set())
+        begin = time.time()
+        done, not_done = wait_all(futures, timeout=0.2)
+        assert(time.time() - begin < 0.5)
+        assert(len(done) == 0 and not_done == set(futures))
+        assert(futures[0].result(timeout=2) is None)
+        assert(resolved.is_set())
+    finally:
+        action_manager.clear_mapping()
+
+class StageLog(object):
+    # (stage class, thread, input) of each stage run.
+    runs = []
+    cleanups = []
+
+class CaptureStage(CoreAction):
+    def perform_action(self):
+        StageLog.runs.append((self.__class__, threading.current_thread(), self.pipeline_input))
+        return 1
+    def cleanup(self):
+        StageLog.cleanups.append(self.__class__)
+
+class ProcessStage(CaptureStage):
+    def perform_action(self):
+        CaptureStage.perform_action(self)
+        return self.pipeline_input + 1
+
+class UploadStage(CaptureStage):
+    def perform_action(self):
+        CaptureStage.perform_action(self)
+        if self.final_state.result is False:
+            raise IOError('Upload failed.')
+        return self.pipeline_input * 10
+
+class BrokenStage(CaptureStage):
+    def setup(self):
+        raise IOError('No camera.')
+
+class CaptureProcess(CoreActionPipeline):
+    stages = (CaptureStage, ProcessStage)
+
+def pipeline_tests():
+    try:
+        action_manager.clear_mapping()
+        suppress_errors()
+        try:
+            action_pipeline(CaptureStage, TrueObservable)
+            assert(False)
+        except TypeError:
+            pass
+        finally:
+            show_errors()
+        pipeline = action_pipeline(CaptureStage, ProcessStage, UploadStage)
+        assert(pipeline.__name__ == 'Pipeline_CaptureStage_ProcessStage_UploadStage')
+        assert(issubclass(pipeline, CoreActionPipeline))
+
+        # Stages run in order in one thread, each given the last's output.
+        test1 = TrueObservable()
+        test1.register_action(pipeline, State('*', '*'), State(True, True))
+        StageLog.runs = []
+        StageLog.cleanups = []
+        test1.check_observation()
+        future, = test1.action_futures
+        assert(future.result(timeout=2) == 20)
+        assert([(stage, value) for stage, thread, value in StageLog.runs] ==
+               [(CaptureStage, None), (ProcessStage, 1), (UploadStage, 2)])
+        assert(set(thread for stage, thread, value in StageLog.runs) == set([future.thread]))
+        assert(StageLog.cleanups == [CaptureStage, ProcessStage, UploadStage])
+
+        # A failing stage fails the pipeline, after its cleanup.
+        StageLog.runs = []
+        StageLog.cleanups = []
+        test1.register_action(pipeline, State(True, True), State(True, False))
+        suppress_errors()
+        try:
+            futures = action_manager.check_state_change(test1, State(True, True), State(True, False))
+            assert(isinstance(futures[0].exception(timeout=2), IOError))
+        finally:
+            show_errors()
+        assert(StageLog.cleanups == [CaptureStage, ProcessStage, UploadStage])
+
+        # So does a failing setup(), which is cleaned up and timed.
+        StageLog.runs = []
+        StageLog.cleanups = []
+        broken = action_pipeline(CaptureStage, BrokenStage, ProcessStage)
+        metrics.enable()
+        suppress_errors()
+        try:
+            test1.register_action(broken, State(False, False), State(True, False))
+            future, = action_manager.check_state_change(test1, State(False, False), State(True, False))
+            assert(isinstance(future.exception(timeout=2), IOError))
+            stats = metrics.actions['BrokenStage']
+            assert(stats[2] == 1 and stats[4] == 1)
+        finally:
+            show_errors()
+            metrics.disable()
+            metrics.reset()
+        assert([stage for stage, thread, value in StageLog.runs] == [CaptureStage])
+        assert(StageLog.cleanups == [CaptureStage, BrokenStage])
+
+        # Pipelines nest, and may be declared as subclasses.
+        nested = action_pipeline(CaptureProcess, ProcessStage, name='Nested')
+        assert(nested.__name__ == 'Nested')
+        test2 = FalseObservable()
+        test2.register_action(nested, State(True, False), State(True, True))
+        future, = action_manager.check_state_change(test2, State(True, False), State(True, True))
+        assert(future.result(timeout=2) == 3)
+    finally:
+        action_manager.clear_mapping()
+
+class ValueObservable(CoreObservable):
+    value = None
+    def get_observation(self):
+        return self.value
+
+def derived_tests():
+    # Unknown results make the helpers unknown only when they matter.
+    assert(all_true(True, True) and all_true(False, None) is False and all_true(True, None) is None)
+    assert(any_true(False, True) and any_true(False, False) is False and any_true(False, None) is None)
+    assert(negate(True) is False and negate(False) is True and negate(None) is None)
+
+    try:
+        action_manager.clear_mapping()
+
+        # Pump on and pressure low; either unobserved is unknown.
+        pump = ValueObservable()
+        low = ValueObservable()
+        pump_low = DerivedObservable([pump, low], all_true)
+        assert(pump_low.rank == 1 and pump.dependents == (pump_low,))
+        RecordingAction.records = []
+        pump_low.register_action(RecordingAction, State('*', '*'), State(True, True))
+        pump.value = True
+        pump.check_observation()
+        assert(pump_low.get_state() == State(True, None))
+        low.value = True
+        low.check_observation()
+        assert(pump_low.get_state() == State(True, True))
+        assert(wait_for(lambda: len(RecordingAction.records) == 1))
+        assert(RecordingAction.records[0][0] is pump_low)
+
+        # A diamond: each derived observable is evaluated once per change,
+        # after its inputs, and only when an input changed.
+        evaluations = []
+        def counted(name, function):
+            def evaluate(*results):
+                evaluations.append(name)
+                return function(*results)
+            return evaluate
+        source = ValueObservable()
+        other = ValueObservable()
+        left = DerivedObservable([source], counted('left', lambda value: value))
+        right = DerivedObservable([source, other], counted('right', any_true))
+        both = DerivedObservable([left, right], counted('both', all_true))
+        top = DerivedObservable([both, source], counted('top', lambda value, unused: negate(value)))
+        assert([left.rank, right.rank, both.rank, top.rank] == [1, 1, 2, 3])
+
+        source.value = True
+        source.check_observation()
+        assert(sorted(evaluations[:2]) == ['left', 'right'] and evaluations[2:] == ['both', 'top'])
+        assert(both.get_state() == State(True, True) and top.get_state() == State(True, False))
+
+        # right stays True, so nothing past it is evaluated.
+        del evaluations[:]
+        other.value = True
+        other.check_observation()
+        assert(evaluations == ['right'])
+
+        # Unchanged inputs evaluate nothing.
+        del evaluations[:]
+        source.check_observation()
+        assert(evaluations == [])
+
+        # A failing function leaves the state stale, as any observation.
+        def fail(value):
+            raise ValueError('No.')
+        broken = DerivedObservable([source], fail)
+        source.value = False
+        source.check_observation()
+        assert(broken.get_state().is_operating is False)
+        assert(top.get_state() == State(True, True))
+
+        # Detached observables are no longer evaluated.
+        for derived in [broken, top, both, left, right]:
+            derived.detach()
+        assert(source.dependents == () and other.dependents == ())
+        del evaluations[:]
+        source.value = True
+        source.check_observation()
+        assert(evaluations == [])
+
+        try:
+            suppress_errors()
+            DerivedObservable([], all_true)
+            assert(False)
+        except ValueError:
+            pass
+        finally:
+            show_errors()
+    finally:
+        action_manager.clear_mapping()
+
+class QualityObservable(CoreObservable):
+    state_class = QualityState
+    value = (True, {'quality': True})
+    def get_observation(self):
+        return self.value
+
+def schema_tests():
+    # Codes pack one bit per value, three bits per attribute.
+    assert(encode((True, False)) == 1 | 2 << 3)
+    assert(decode(encode((None, True, False))) == (None, True, False))
+    assert(State(True, False).get_code() == encode((True, False)))
+    assert(State(result=True).get_primary() == (None, True))
+    try:
+        State(True, True, True)
+        assert(False)
+    except TypeError:
+        pass
+    try:
+        State(True, '[TX]')
+        assert(False)
+    except TypeError:
+        pass
+
+    # Choices of values expand like '*'.
+    test1 = State('[TF]', '*')
+    assert(len(test1) == 6)
+    assert(State(False, None) in test1 and State(None, False) not in test1)
+    assert(State([True, None], '[fn]') == StateCollection([State(True, False), State(True, None),
+                                                            State(None, False), State(None, None)]))
+
+    # States hash by value, so collections hold distinct values.
+    assert(hash(State(True, True)) == hash(State(True, True)))
+    assert(len(StateCollection([State(True, True), State(True, True)])) == 1)
+    assert(State() in set([State(None, None)]))
+    assert('T,T' not in test1 and None not in test1)
+
+    # Patterns match with a mask, without expanding.
+    test2 = StatePattern(State, '*', '[TF]')
+    assert(State(None, True) in test2 and State(True, None) not in test2)
+    assert(test2.matches(State(False, False).get_code()))
+    assert(test2.states() == State('*', '[TF]'))
+    assert(State.pattern(True, True).mask == State.schema.full_mask & ~State(True, True).get_code())
+
+    # More attributes.
+    test3 = QualityState(True, True, quality=False)
+    assert(test3.quality is False and test3.get_primary() == (True, True, False))
+    assert(test3 != State(True, True) and test3 == test3.copy())
+    assert(len(QualityState('*', True, '*')) == 9)
+    assert(QualityState(True, True) in QualityState.pattern(True, True, '[NT]'))
+    assert(QualityState(True, True) not in State.pattern('*', '*'))
+
+    # Observables of such States take the extra attributes from their
+    # observations, and are registered with like any other.
+    try:
+        action_manager.clear_mapping()
+        test4 = QualityObservable()
+        assert(test4.get_state() == QualityState())
+        test4.register_action(ReturningAction, QualityState('*', '*', '*'), QualityState(True, True, False))
+        assert(test4.check_observation() == QualityState(True, True, True))
+        assert(test4.action_futures == [])
+        test4.value = (True, {})
+        assert(test4.check_observation() == QualityState(True, True, True))
+        test4.value = (True, {'quality': False})
+        test4.check_observation()
+        future, = test4.action_futures
+        assert(future.result(timeout=2) == (True, True, False))
+    finally:
+        action_manager.clear_mapping()
+
+def lock_profile_tests():
+    rwlock = ReadWriteLock()
+    # Costs nothing until enabled: the states use the lock's own methods.
+    assert(rwlock.Read.acquire == rwlock.acquire_read_lock)
+    assert(rwlock.contention_report() is None)
+
+    profile = rwlock.enable_profiling()
+    assert(rwlock.Read.acquire != rwlock.acquire_read_lock)
+    # States created later are profiled too.
+    timed_read = ReadWriteState(rwlock, 'read', timeout=0.05)
+    assert(timed_read.acquire == timed_read.profiled_acquire)
+
+    held = threading.Event()
+    release = threading.Event()
+    def holder():
+        with rwlock.Write:
+            held.set()
+            release.wait()
+    holding_thread = threading.Thread(target=holder)
+    holding_thread.start()
+    held.wait()
+
+    # The holder and the waiting call site are tracked while they are.
+    waiters, holders = profile.current()
+    assert(waiters == [])
+    assert(len(holders) == 1 and holders[0][1] == 'write' and holders[0][0].startswith('holder '))
+    try:
+        with rwlock.ReadOrNot:
+            assert(False)
+    except LockError:
+        pass
+    try:
+        with timed_read:
+            assert(False)
+    except LockError:
+        pass
+    waiting_thread = threading.Thread(target=lambda: rwlock.Read.__enter__() and rwlock.Read.__exit__())
+    waiting_thread.start()
+    assert(wait_for(lambda: len(profile.current()[0]) == 1))
+    time.sleep(0.05)
+    release.set()
+    holding_thread.join()
+    waiting_thread.join()
+    waiters, holders = profile.current()
+    assert(waiters == [] and holders == [])
+
+    statistics = profile.statistics()
+    sites = dict(((key[0].split()[0], key[1]), stats) for key, stats in statistics.items())
+    # Both failed attempts were made from here, each on its own line.
+    failed = [stats for key, stats in statistics.items() if key[0].startswith('lock_profile_tests ')]
+    assert(len(failed) == 2)
+    assert([(stats['acquisitions'], stats['failures']) for stats in failed] == [(0, 1), (0, 1)])
+    assert(0.04 < max(stats['longest_wait'] for stats in failed) < 0.5)
+    written = sites[('holder', 'write')]
+    assert(written['acquisitions'] == 1 and written['longest_hold'] > 0.04)
+    assert(sum(written['hold_buckets']) == 1)
+    assert(sites[('<lambda>', 'read')]['longest_wait'] > 0.04)
+    assert('holder (' in rwlock.contention_report())
+
+    # Disabling restores the lock's methods and stops recording.
+    assert(rwlock.disable_profiling() is profile)
+    assert(rwlock.Read.acquire == rwlock.acquire_read_lock)
+    with rwlock.Read:
+        pass
+    assert(profile.statistics() == statistics)
+
+    # The action manager's lock is exported as histograms while profiled.
+    assert('gdci_lock_wait_seconds' not in metrics.render())
+    for name, lock in action_manager.locks():
+        lock.enable_profiling()
+    try:
+        test1 = TrueObservable()
+        test1.register_action(ActionTest1, State(True, True), State(True, False))
+        test1.unregister_action(ActionTest1, State(True, True), State(True, False))
+        text = metrics.render()
+        assert('# TYPE gdci_lock_wait_seconds histogram' in text)
+        assert('gdci_lock_hold_seconds_count{lock="stripe%d",mode="write",site="install_mapping' %
+               action_manager.stripe(test1).index in text)
+        assert('le="+Inf"' in text)
+    finally:
+        for name, lock in action_manager.locks():
+            lock.disable_profiling()
+
+# ---
+
+def dispatch_lock_tests():
+    global flip_bit
+
+    test1 = TrueObservable()
+    try:
+        test1.register_action(ActionTest1, State(True, True), State(True, False))
+        # Queue an action while the dispatcher is stopped.
+        action_manager.stop(blocking=True)
+        flip_bit = False
+        futures = action_manager.check_state_change(test1, State(True, True), State(True, False))
+        assert(len(futures) == 1)
+
+        # A thread holding the queue lock longer than lock_timeout makes the
+        # dispatcher give up and try again rather than block.
+        held = threading.Event()
+        release = threading.Event()
+        def holder():
+            with action_manager.queue_lock.Read:
+                held.set()
+                release.wait()
+        holding_thread = threading.Thread(target=holder)
+        holding_thread.start()
+        held.wait()
+        waits = action_manager.dispatch_lock_waits
+        timeouts = action_manager.dispatch_lock_timeouts
+        action_manager.start()
+        suppress_errors()
+        try:
+            time.sleep(action_manager.lock_timeout * 3.5)
+        finally:
+            show_errors()
+        assert(not futures[0].done())
+        release.set()
+        holding_thread.join()
+
+        # Dispatch carries on once the lock is free.
+        futures[0].result(2)
+        assert(flip_bit)
+        assert(action_manager.dispatch_lock_timeouts >= timeouts + 2)
+        assert(action_manager.dispatch_lock_waits == waits + 1)
+        assert(action_manager.dispatch_lock_longest_wait >= action_manager.lock_timeout)
+        assert(action_manager.dispatch_lock_longest_wait < action_manager.lock_timeout * 3)
+
+        text = metrics.render()
+        assert('gdci_dispatch_lock_timeouts_total %d' % action_manager.dispatch_lock_timeouts in text)
+        assert('gdci_dispatch_lock_wait_seconds_total' in text)
+    finally:
+        action_manager.auto_start = True
+        action_manager.start()
+        test1.unregister_all()
+
+# ---
+
+def stripe_tests():
+    global flip_bit
+
+    try:
+        action_manager.clear_mapping()
+        # Find two observables of different stripes. The candidates are
+        # kept alive so that their addresses, and hashes, differ.
+        test1 = TrueObservable()
+        candidates = [TrueObservable() for index in range(64)]
+        test2 = [candidate for candidate in candidates
+                 if action_manager.stripe(candidate) is not action_manager.stripe(test1)][0]
+        del candidates
+        stripe1 = action_manager.stripe(test1)
+        stripe2 = action_manager.stripe(test2)
+        assert(action_manager.stripe(weakref.ref(test1)) is stripe1)
+
+        # Observables spread over the stripes, although their addresses
+        # share their low bits.
+        spread = [TrueObservable() for index in range(64)]
+        used = set(action_manager.stripe(observable).index for observable in spread)
+        assert(len(used) > len(action_manager.stripes) // 2)
+        del spread
+
+        # A bulk registration spans both stripes at once.
+        action_manager.associate_actions([(ActionTest1, test1, State(True, True), State(True, False)),
+                                          (ActionTest1, test2, State(True, True), State(True, False))])
+        assert(len(stripe1.action_mapping) == 1 and len(stripe2.action_mapping) == 1)
+        check_reverse_indexes()
+
+        # Large registrations are built before the locks are taken and
+        # merged with those already there under the same weak references.
+        many = [TrueObservable() for index in range(100)]
+        for registrations in [[(ActionTest2, observable, State('*', '*'), State('*', '*')) for observable in many],
+                              [(ActionTest1, observable, State(True, True), State(True, False)) for observable in many],
+                              [(ActionTest1, observable, State('*', '*'), State('*', '*')) for observable in many]]:
+            action_manager.associate_actions(registrations)
+            check_reverse_indexes()
+        for stripe in action_manager.stripes:
+            for key in stripe.action_mapping:
+                assert(stripe.observable_refs[key[0]] is key[0])
+        assert(len(action_manager.action_mapping) == 2 + 100 * 81)
+        assert(all(action_manager.action_mapping[key] == set([ActionTest1, ActionTest2])
+                   for observable in many for key in action_manager.observable_index[weakref.ref(observable)]))
+        for observable in many:
+            observable.unregister_all()
+        del many
+
+        # Holding one stripe does not hold up the other.
+        flip_bit = False
+        with stripe1.lock.Write:
+            futures = action_manager.check_state_change(test2, State(True, True), State(True, False))
+            test2.register_action(ActionTest2, State(True, False), State(True, True))
+            assert(action_manager.disassociate_all(test2) == 2)
+        futures[0].result(2)
+        assert(flip_bit)
+
+        # Nor does holding the lock of running threads.
+        test2.register_action(ActionTest1, State(True, True), State(True, False))
+        with action_manager.thread_lock:
+            futures = action_manager.check_state_change(test2, State(True, True), State(True, False))
+        futures[0].result(2)
+
+        # Concurrent registrations of many observables keep every stripe
+        # consistent.
+        observables = [TrueObservable() for index in range(200)]
+        def register(part):
+            for observable in observables[part::4]:
+                observable.register_action(ActionTest1, State(True, '*'), State(False, '*'))
+            action_manager.associate_actions((ActionTest2, observable, State(None, None), State(True, True))
+                                             for observable in observables[part::4])
+            for observable in observables[part::8]:
+                observable.unregister_all()
+        threads = [threading.Thread(target=register, args=(part,)) for part in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check_reverse_indexes()
+        assert(len(action_manager.observable_index) == 2 + 100)
+        assert(len([stripe for stripe in action_manager.stripes if stripe.action_mapping]) > 1)
+    finally:
+        action_manager.clear_mapping()
+    assert(all(not stripe.action_mapping for stripe in action_manager.stripes))
+
+# ---
+
+def stress_tests():
+    # A short seeded run upholds every invariant.
+    suppress_errors()
+    try:
+        result = run_stress(seed=1, workers=4, observables=8, operations=300)
+    finally:
+        show_errors()
+    assert(result.ok())
+    assert(result.operations == 4 * 300)
+    assert(result.actions > 0)
+    assert('Seed 1: 1200 operations' in result.summary())
+    assert(action_manager.action_mapping == {})
+    assert(len(action_manager.thread_mapping) == 0)
+
+    # Holding every stripe once the run is underway stops the workers,
+    # which the watchdog reports.
+    release = threading.Event()
+    def holder():
+        time.sleep(0.2)
+        for stripe in action_manager.stripes:
+            stripe.lock.acquire_write_lock()
+        release.wait()
+        for stripe in action_manager.stripes:
+            stripe.lock.release_write_lock()
+    holding_thread = threading.Thread(target=holder)
+    holding_thread.start()
+    suppress_errors()
+    try:
+        result = run_stress(seed=2, workers=2, observables=4, operations=100000, stall_timeout=0.3)
+    finally:
+        release.set()
+        holding_thread.join()
+        show_errors()
+    assert(result.deadlocked and not result.ok())
+    assert('StressWorker' in result.stacks)
+    assert('acquire_read_lock' in result.stacks or 'acquire_write_lock' in result.stacks)
+    result.join(5)
+    action_manager.clear_mapping()
+
+# ---
+
+def snapshot_tests():
+    global flip_bit
+
+    try:
+        test1 = TrueObservable()
+        test2 = FalseObservable()
+        observables = {'one': test1, 'two': test2}
+        actions = {'second': ActionTest2}
+        action_manager.clear_mapping()
+        test1.register_action(ActionTest1, State(True, False), State(True, True))
+        test1.register_action([ActionTest1, ActionTest2], State(None, None), State(True, '*'))
+        test2.register_action(ActionTest2, State('*', True), State(True, False))
+        test1.set_state(State(True, True))
+        test2.set_state(State(True, False))
+        expected = action_manager.action_mapping
+
+        # Snapshots are written atomically, leaving no temporary file.
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'registry.snapshot')
+        snapshot = save_snapshot(path, observables, actions)
+        save_snapshot(path, observables, actions)
+        assert(os.listdir(directory) == ['registry.snapshot'])
+        assert(sorted(snapshot['actions']) == ['__main__.ActionTest1', 'second'])
+        assert(snapshot['observables']['one']['state'] == State(True, True).get_code())
+        assert(len(snapshot['observables']['two']['registrations']) == 3)
+
+        # A restart restores states and registrations alike.
+        action_manager.clear_mapping()
+        test1.set_state(State())
+        test2.set_state(State())
+        assert(restore_snapshot(path, observables, actions) == (2, len(expected)))
+        assert(action_manager.action_mapping == expected)
+        check_reverse_indexes()
+        assert(test1.get_state() == State(True, True))
+        assert(test2.get_state() == State(True, False))
+
+        # The first observation after a restore is no state change.
+        flip_bit = False
+        assert(test1.check_observation() == State(True, True))
+        time.sleep(0.5)
+        assert(flip_bit == False)
+
+        # Observables the snapshot does not know are left alone, and those
+        # not given are skipped.
+        test3 = TrueObservable()
+        action_manager.clear_mapping()
+        assert(restore_snapshot(path, {'one': test1, 'three': test3}, actions) == (1, 4))
+        assert(test3.get_state() == State())
+
+        # Invalid snapshots restore nothing.
+        with open(path) as snapshot_file:
+            valid = snapshot_file.read()
+        bad_snapshots = [
+            valid.replace('"version":1', '"version":2'),
+            valid.replace('"second"', '"third"'),
+            valid.replace('"is_operating","result"', '"is_operating","value"'),
+            valid.replace('"state":%d' % State(True, True).get_code(), '"state":63'),
+            '{"version":1}']
+        action_manager.clear_mapping()
+        test1.set_state(State())
+        for bad in bad_snapshots:
+            assert(bad != valid)
+            with open(path, 'w') as snapshot_file:
+                snapshot_file.write(bad)
+            suppress_errors()
+            try:
+                restore_snapshot(path, observables, actions)
+                assert(False)
+            except ValueError:
+                pass
+            finally:
+                show_errors()
+        assert(action_manager.action_mapping == {})
+        assert(test1.get_state() == State())
+    finally:
+        action_manager.clear_mapping()
+
+# ---
+
+class PayloadObservable(CoreObservable):
+    def __init__(self, *args, **kwargs):
+        CoreObservable.__init__(self, *args, **kwargs)
+        self.attribs = {}
+        self.reported = []
+    def get_observation(self):
+        return (len(self.reported) % 2 == 0, self.attribs)
+    def report_state_change(self, initial_state, final_state):
+        self.reported.append((initial_state, final_state))
+
+def payload_tests():
+    # Read-only buffers are kept; writable ones become read-only.
+    data = 'x' * 1000
+    assert(freeze_payload(data) is data)
+    assert(freeze_payload(bytearray('abc')) == 'abc')
+    view = memoryview(data)
+    assert(freeze_payload(view) is view)
+    frozen = freeze_payload(memoryview(bytearray('abc')))
+    assert(frozen.readonly and frozen.tobytes() == 'abc')
+    listing = [1, 2]
+    assert(freeze_payload(listing) is listing)
+
+    # Copies of a State share payloads but still copy everything else.
+    state = State(True, True)
+    assert(state.set_payload('view', view) is view)
+    state.set_secondary('listing', listing)
+    copied = state.copy()
+    assert(copied.get_secondary('view') is view)
+    assert(copied.get_secondary('listing') == listing)
+    assert(copied.get_secondary('listing') is not listing)
+
+    if numpy is not None:
+        # Writable arrays, and read-only views of them, are copied.
+        frame = numpy.zeros((480, 640), dtype=numpy.uint8)
+        frozen = state.set_payload('frame', frame)
+        assert(frozen is not frame and frozen.base is None)
+        assert(not frozen.flags.writeable and frame.flags.writeable)
+        try:
+            frozen[0, 0] = 1
+            assert(False)
+        except ValueError:
+            pass
+        frame[0, 0] = 1
+        assert(frozen[0, 0] == 0)
+        assert(state.copy().get_secondary('frame') is frozen)
+        view = frame.view()
+        view.flags.writeable = False
+        assert(freeze_payload(view) is not view)
+
+        # Arrays nothing can write are kept.
+        assert(freeze_payload(frozen) is frozen)
+        fixed = numpy.frombuffer(data, dtype=numpy.uint8)
+        assert(freeze_payload(fixed) is fixed)
+
+        # Arrays of objects are copied, as the objects may change.
+        objects = freeze_payload(numpy.array([listing], dtype=object))
+        state.set_secondary('objects', objects)
+        assert(state.copy().get_secondary('objects') is not objects)
+
+        # Payloads returned by observations reach actions without a further
+        # copy, and refilling the observable's array leaves them unchanged.
+        observable = PayloadObservable()
+        observable.attribs = {'frame': frame}
+        current = observable.check_observation()
+        initial, final = observable.reported[-1]
+        assert(final.get_secondary('frame') is current.get_secondary('frame'))
+        frame.fill(7)
+        current = observable.check_observation()
+        assert(final.get_secondary('frame')[0, 0] == 1)
+        assert(current.get_secondary('frame')[0, 0] == 7)
+        observable.attribs = {'frame': frozen}
+        current = observable.check_observation()
+        assert(current.get_secondary('frame') is frozen)
+        assert(not current.get_secondary('frame').flags.writeable)
+
+# ---
+
+class ListHandler(logging.Handler):
+    def __init__(self, delay=0.0):
+        logging.Handler.__init__(self)
+        self.delay = delay
+        self.messages = []
+        self.records = []
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.messages.append(record.getMessage())
+        self.records.append(record)
+
+class ThreadNamer(object):
+    def __init__(self):
+        self.thread = None
+    def __str__(self):
+        self.thread = threading.current_thread().name
+        return 'named'
+
+def asynclog_tests():
+    test_log = logging.getLogger('Async Log Test')
+    test_log.propagate = False
+    slow = ListHandler(delay=0.1)
+    test_log.handlers = [slow]
+
+    # Logging through a slow handler takes no time, and messages are
+    # formatted by the handling thread, in order.
+    handler = install_async_logging(test_log, burst=None)
+    try:
+        assert(test_log.handlers == [handler])
+        namer = ThreadNamer()
+        begin = time.time()
+        for index in range(5):
+            test_log.error('Message %d from %s.', index, namer)
+        assert(time.time() - begin < 0.1)
+        assert(namer.thread is None)
+        handler.flush()
+        assert(slow.messages == ['Message %d from named.' % index for index in range(5)])
+        assert(namer.thread == 'AsyncHandler')
+    finally:
+        remove_async_logging(handler)
+    assert(test_log.handlers == [slow])
+    assert(not handler.thread.is_alive())
+
+    # A full queue drops records rather than waiting.
+    slow.messages = []
+    handler = install_async_logging(test_log, capacity=2, burst=None)
+    try:
+        for index in range(10):
+            test_log.error('Message %d.', index)
+        assert(handler.dropped >= 7)
+        handler.flush()
+        assert(len(slow.messages) == 10 - handler.dropped)
+        assert(slow.messages[0] == 'Message 0.')
+    finally:
+        remove_async_logging(handler)
+
+    # Each site is limited separately, and the first record let through
+    # afterwards counts those suppressed.
+    records = ListHandler()
+    limiter = RateLimitFilter(interval=0.2, burst=3)
+    records.addFilter(limiter)
+    passed = []
+    records.emit = lambda record: passed.append((record.getMessage(), record.suppressed))
+    test_log.handlers = [records]
+    def storm(count):
+        for index in range(count):
+            test_log.error('Storm %d.', index)
+    storm(20)
+    test_log.error('Elsewhere.')
+    assert(passed == [('Storm 0.', 0), ('Storm 1.', 0), ('Storm 2.', 0), ('Elsewhere.', 0)])
+    assert(limiter.suppressed == 17)
+    time.sleep(0.25)
+    storm(2)
+    assert(passed[4:] == [('Storm 0.', 17), ('Storm 1.', 0)])
+
+    # Closing handles what is queued and closes the handlers.
+    slow.messages = []
+    handler = AsyncHandler([slow])
+    test_log.handlers = [handler]
+    test_log.error('Last.')
+    handler.close()
+    assert(slow.messages == ['Last.'])
+    assert(not handler.thread.is_alive())
+    test_log.handlers = []
+
+# ---
+
+class FlakyObservable(CoreObservable):
+    def __init__(self, *args, **kwargs):
+        CoreObservable.__init__(self, *args, **kwargs)
+        self.failing = True
+        self.calls = 0
+    def get_observation(self):
+        self.calls += 1
+        if self.failing:
+            raise IOError('Device unreachable.')
+        return True
+
+def breaker_tests():
+    for bad in [{'failure_threshold': 0}, {'base_delay': 0}, {'base_delay': 2, 'max_delay': 1}, {'multiplier': 0.5}]:
+        try:
+            CircuitBreaker(**bad)
+            assert(False)
+        except ValueError:
+            pass
+
+    # Consecutive failures open the circuit; each failed probe doubles the
+    # delay, up to max_delay; a success closes it.
+    fleet = CircuitFleet()
+    breaker = CircuitBreaker(failure_threshold=2, base_delay=1, max_delay=4, jitter=0, fleet=fleet)
+    suppress_errors()
+    try:
+        assert(breaker.allow(0))
+        breaker.record_failure(0)
+        breaker.record_success()
+        breaker.record_failure(0)
+        assert(breaker.get_state() is CLOSED)
+        breaker.record_failure(0)
+        assert(breaker.get_state() is OPEN)
+        assert(fleet.counts() == {CLOSED: 0, OPEN: 1, HALF_OPEN: 0})
+        assert(not breaker.allow(0.5))
+        for probe_at, delay in [(1, 2), (3, 4), (7, 4)]:
+            assert(not breaker.allow(probe_at - 0.01))
+            assert(breaker.allow(probe_at))
+            assert(breaker.get_state() is HALF_OPEN)
+            # Only one probe at a time.
+            assert(not breaker.allow(probe_at))
+            breaker.record_failure(probe_at)
+            assert(breaker.delay == delay and breaker.retry_at == probe_at + delay)
+        assert(breaker.allow(11))
+        breaker.record_success()
+        assert(breaker.get_state() is CLOSED and breaker.allow(11))
+        assert(fleet.trips == 4 and fleet.open_count() == 0)
+        assert(breaker.skipped == fleet.skipped == 7)
+    finally:
+        show_errors()
+    del breaker
+    gc.collect()
+    assert(fleet.counts() == {CLOSED: 0, OPEN: 0, HALF_OPEN: 0})
+
+    # An open circuit stops an observable from observing until a probe
+    # succeeds.
+    observable = FlakyObservable()
+    breaker = observable.enable_circuit_breaker(failure_threshold=2, base_delay=0.2, jitter=0)
+    trips = circuit_fleet.trips
+    suppress_errors()
+    try:
+        for index in range(10):
+            state = observable.check_observation()
+        assert(observable.calls == 2)
+        assert(state.is_operating is False)
+        assert(breaker.get_state() is OPEN and circuit_fleet.open_count() >= 1)
+        assert(circuit_fleet.trips == trips + 1)
+        time.sleep(0.25)
+        observable.check_observation()
+        observable.check_observation()
+        assert(observable.calls == 3 and breaker.delay == 0.4)
+        observable.failing = False
+        time.sleep(0.45)
+        state = observable.check_observation()
+        assert(observable.calls == 4 and state.is_operating is True)
+        assert(breaker.get_state() is CLOSED)
+        observable.check_observation()
+        assert(observable.calls == 5)
+    finally:
+        show_errors()
+    assert('gdci_circuit_trips_total %d' % circuit_fleet.trips in metrics.render())
+    assert('gdci_circuits{state="open"}' in metrics.render())
+
+    observable.disable_circuit_breaker()
+    observable.failing = True
+    for index in range(5):
+        observable.check_observation()
+    assert(observable.calls == 10)
+
+# ---
+
+class SlowToggleObservable(CoreObservable):
+    def __init__(self, delay=0.05, *args, **kwargs):
+        CoreObservable.__init__(self, *args, **kwargs)
+        self.delay = delay
+        self.result = False
+        self.threads = set()
+    def get_observation(self):
+        self.threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        self.result = not self.result
+        return self.result
+
+class ReportingObservable(SlowToggleObservable):
+    def report_state_change(self, initial_state, final_state):
+        self.reported = (initial_state, final_state)
+
+def group_tests():
+    try:
+        action_manager.clear_mapping()
+
+        # A batch fires the same actions as separate changes, in order.
+        test1 = TrueObservable()
+        test2 = FalseObservable()
+        test1.register_action([ActionTest1, ActionTest2], State(None, None), State(True, True))
+        test2.register_action(ActionTest1, State(None, None), State(True, False))
+        batch = [(test1, State(None, None), State(True, True)),
+                 (test2, State(True, True), State(True, False)),
+                 (test2, State(None, None), State(True, False))]
+        futures = action_manager.check_state_changes(batch)
+        assert([len(fired) for fired in futures] == [2, 0, 1])
+        assert(set(future.action for future in futures[0]) == set([ActionTest1, ActionTest2]))
+        assert(futures[2][0].observable is test2)
+        done, not_done = wait_all(futures[0] + futures[2], timeout=5)
+        assert(not not_done)
+        try:
+            action_manager.check_state_changes([(test1, State('*', True), State(True, True))])
+            assert(False)
+        except TypeError:
+            pass
+
+        # Members are evaluated at once on the pool, each change is
+        # reported, and actions see the batch.
+        action_manager.clear_mapping()
+        members = [SlowToggleObservable() for index in range(20)]
+        for member in members:
+            member.register_action(ActionTest1, State(None, None), State(True, True))
+        group = ObserverGroup(members, workers=10, deadline=2.0)
+        begin = time.time()
+        group.main_loop()
+        assert(time.time() - begin < 0.5)
+        assert(len(group.last_changes) == 20)
+        assert([change[0] for change in group.last_changes] == members)
+        assert(all(member.get_state() == State(True, True) for member in members))
+        assert(all(len(member.action_futures) == 1 for member in members))
+        assert(len(group.pool.threads) <= 10)
+        assert(set().union(*[member.threads for member in members]) <= set(thread.name for thread in group.pool.threads))
+        done, not_done = wait_all(sum([member.action_futures for member in members], []), timeout=5)
+        assert(not not_done)
+        group.main_loop()
+        assert(all(member.get_state() == State(True, False) for member in members))
+        assert(group.late == 0 and group.overruns == 0)
+        group.pool.shutdown()
+
+        # A member missing the deadline is reported once it finishes, and is
+        # not evaluated again meanwhile.
+        slow = SlowToggleObservable(delay=0.5)
+        other = ReportingObservable(delay=0.0)
+        group = ObserverGroup([slow, other], workers=2, deadline=0.1)
+        begin = time.time()
+        group.main_loop()
+        assert(time.time() - begin < 0.4)
+        assert([change[0] for change in group.last_changes] == [other])
+        assert(other.reported[1] == State(True, True))
+        assert(group.late == 1)
+        group.main_loop()
+        assert(group.overruns == 1 and slow.get_state() == State())
+        assert(wait_for(lambda: group.results.qsize() == 1))
+        assert(slow.get_state() == State(True, True))
+        group.main_loop()
+        assert([change[0] for change in group.last_changes] == [slow, other])
+        assert(group.overruns == 2)
+        group.pool.shutdown()
+
+        # Several groups may share a pool, and a running group shuts down
+        # only the pool it made.
+        pool = ObserverPool(4)
+        shared = [ObserverGroup([SlowToggleObservable(delay=0)], pool=pool) for index in range(2)]
+        for group in shared:
+            group.main_loop()
+        assert(len(pool.threads) <= 4)
+        pool.shutdown()
+        assert(not pool.threads)
+
+        member = SlowToggleObservable(delay=0)
+        group = ObserverGroup([member], loop_interval=0.05)
+        group.start()
+        assert(wait_for(lambda: group.pool.threads and member.get_state() != State()))
+        threads = list(group.pool.threads)
+        group.stop(blocking=True)
+        assert(wait_for(lambda: not any(thread.is_alive() for thread in threads)))
+
+        try:
+            ObserverPool(0)
+            assert(False)
+        except ValueError:
+            pass
+    finally:
+        action_manager.clear_mapping()
+
+# ---
+
 # Run tests if this file is called as an executable.
 if __name__ == '__main__':
     print "Running State tests."
@@ -685,12 +2799,24 @@ if __name__ == '__main__':
 
     print ""
 
+    print "Running ReadWriteLock policy tests."
+    rwlock_policy_tests()
+    print "ReadWriteLock policy tests completed."
+
+    print ""
+
     print "Running CoreThread tests."
     thread_tests()
     print "CoreThread tests completed."
 
     print ""
 
+    print "Running phase scheduling tests."
+    phase_tests()
+    print "Phase scheduling tests completed."
+
+    print ""
+
     print "Running Action tests."
     action_tests()
     print "Action tests completed."
@@ -707,11 +2833,126 @@ if __name__ == '__main__':
     observer_tests()
     print "Observer tests completed."
 
+    print ""
+    print "Running adaptive Observer tests."
+    adaptive_observer_tests()
+    print "Adaptive Observer tests completed."
+
     print ""
     print "Running Action Manager tests."
     am_tests()
     print "Action Manager tests completed."
 
+    print ""
+    print "Running Threshold tests."
+    threshold_tests()
+    print "Threshold tests completed."
+
+    print ""
+    print "Running Metrics tests."
+    metrics_tests()
+    print "Metrics tests completed."
+
+    print ""
+    print "Running Action Manager lifecycle tests."
+    lifecycle_tests()
+    print "Action Manager lifecycle tests completed."
+
+    print ""
+    print "Running Profiler tests."
+    profiler_tests()
+    print "Profiler tests completed."
+
+    print ""
+    print "Running Transport tests."
+    transport_tests()
+    print "Transport tests completed."
+
+    print ""
+    print "Running Ring Buffer tests."
+    ringbuffer_tests()
+    print "Ring Buffer tests completed."
+
+    print ""
+    print "Running Registration tests."
+    registration_tests()
+    print "Registration tests completed."
+
+    print ""
+    print "Running State Schema tests."
+    schema_tests()
+    print "State Schema tests completed."
+
+    print ""
+    print "Running Reverse Index tests."
+    reverse_index_tests()
+    print "Reverse Index tests completed."
+
+    print ""
+    print "Running Weak Registry tests."
+    weak_registry_tests()
+    print "Weak Registry tests completed."
+
+    print ""
+    print "Running Future tests."
+    future_tests()
+    print "Future tests completed."
+
+    print ""
+    print "Running Pipeline tests."
+    pipeline_tests()
+    print "Pipeline tests completed."
+
+    print ""
+    print "Running Derived Observable tests."
+    derived_tests()
+    print "Derived Observable tests completed."
+
+    print ""
+    print "Running Lock Profile tests."
+    lock_profile_tests()
+    print "Lock Profile tests completed."
+
+    print ""
+    print "Running Dispatch Lock tests."
+    dispatch_lock_tests()
+    print "Dispatch Lock tests completed."
+
+    print ""
+    print "Running Lock Striping tests."
+    stripe_tests()
+    print "Lock Striping tests completed."
+
+    print ""
+    print "Running Stress tests."
+    stress_tests()
+    print "Stress tests completed."
+
+    print ""
+    print "Running Snapshot tests."
+    snapshot_tests()
+    print "Snapshot tests completed."
+
+    print ""
+    print "Running Payload tests."
+    payload_tests()
+    print "Payload tests completed."
+
+    print ""
+    print "Running Async Logging tests."
+    asynclog_tests()
+    print "Async Logging tests completed."
+
+    print ""
+    print "Running Circuit Breaker tests."
+    breaker_tests()
+    print "Circuit Breaker tests completed."
+
+    print ""
+    print "Running Observer Group tests."
+    group_tests()
+    print "Observer Group tests completed."
+
     print ""
     print "Testing that execution ends when action_manager thread is stopped."
     print "This will implicitly show itself if the test doesn't terminate now."
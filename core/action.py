@@ -13,15 +13,30 @@ To the extent possible under law, Bryan Bonvallet has waived all copyright and r
 https://github.com/btbonval/Generic-Data-Collection-Infrastructure
 '''
 
+import time
+import logging
+
 from gdci.core.thread import CoreThread
+from gdci.core.metrics import metrics
 from gdci.core.actionmanager import action_manager
 
+log = logging.getLogger('Actions')
+
 class CoreAction(CoreThread):
     '''
     CoreAction is meant to be extended. The perform_action() method must
     be overridden to define functionality for any given subclass.
+
+    Whatever perform_action() returns is kept as result, and any exception
+    it raises as exception; either resolves the action's future once the
+    action has completed. See ActionFuture.
     '''
 
+    # When run as a stage of a CoreActionPipeline, the pipeline and the
+    # value returned by the previous stage.
+    pipeline = None
+    pipeline_input = None
+
     def __init__(self, observable, initial_state, final_state, *args, **kwargs):
         '''
         Each action should be provided with an observable it is responding to
@@ -41,6 +56,12 @@ class CoreAction(CoreThread):
         self.initial_state = initial_state
         self.final_state = final_state
 
+        # The outcome of perform_action(), and the ActionFuture awaiting it,
+        # which the action manager sets when it fires the action.
+        self.result = None
+        self.exception = None
+        self.future = None
+
     def setup(self):
         '''
         setup is called before perform_action().
@@ -52,7 +73,8 @@ class CoreAction(CoreThread):
     def perform_action(self):
         '''
         perform_action should be defined by subclasses to perform whatever
-        functionality is desired when the action is fired.
+        functionality is desired when the action is fired. It may return a
+        result for the action's future.
         '''
         raise NotImplementedError("perform_action() must be overridden.")
 
@@ -80,8 +102,23 @@ class CoreAction(CoreThread):
         run in its own thread.
         '''
 
-        # Call perform_action in the thread.
-        self.perform_action()
+        # Call perform_action in the thread, timing it if metrics are being
+        # recorded.
+        timed = metrics.enabled
+        if timed:
+            begin = time.time()
+
+        # Keep the outcome for the future. A failed action does not loop
+        # again.
+        try:
+            self.result = self.perform_action()
+        except Exception, e:
+            log.error('Action %s failed.', self, exc_info=True)
+            self.exception = e
+            self.do_loop = False
+
+        if timed:
+            metrics.record_action_completed(self, time.time() - begin, self.exception is not None)
 
     def after_loop(self):
         '''
@@ -90,8 +127,22 @@ class CoreAction(CoreThread):
         ended.
         '''
 
-        # Call any cleanup functionality.
-        self.cleanup()
+        # Call any cleanup functionality. Complete the action even if it
+        # fails.
+        try:
+            self.cleanup()
+        except Exception, e:
+            log.error('Cleanup of action %s failed.', self, exc_info=True)
+            if self.exception is None:
+                self.exception = e
 
         # Report completion of running to the action manager.
         action_manager.action_completed(self)
+
+        # Only then resolve the future, so that whoever waits on it finds
+        # the action no longer tracked.
+        if self.future is not None:
+            if self.exception is None:
+                self.future.set_result(self.result)
+            else:
+                self.future.set_exception(self.exception)
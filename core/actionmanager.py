@@ -14,27 +14,338 @@ To the extent possible under law, Bryan Bonvallet has waived all copyright and r
 https://github.com/btbonval/Generic-Data-Collection-Infrastructure
 '''
 
+import gc
+import time
+import atexit
 import signal
 import logging
+import weakref
+import threading
 from Queue import Queue
 
+from gdci.core.state import StatePattern
 from gdci.core.state import StateCollection
+from gdci.core.future import ActionFuture
 from gdci.core.thread import CoreThread
+from gdci.core.rwlock import LockError
 from gdci.core.rwlock import ReadWriteLock
+from gdci.core.metrics import metrics
 from gdci.core.singleton import Singleton
 
 # Initialize logging utility.
 log = logging.getLogger('ActionManager')
 
-class CoreActionManager(CoreThread):
+# The fewest registrations of a stripe which install_mapping() prepares
+# before taking the stripe's lock.
+PREPARE_MINIMUM = 64
+
+# The most seconds the interpreter waits at exit for the actions dispatched
+# by shutdown().
+EXIT_TIMEOUT = 5.0
+
+def as_action_set(action):
+    '''
+    Convert a single action class or a collection of them into a set.
+    '''
+
+    try:
+        return set([action])
+    except TypeError:
+        return set(action)
+
+def state_codes(states):
+    '''
+    Return the list of codes of a single state, a collection of states, or
+    a StatePattern.
+    '''
+
+    if isinstance(states, StatePattern):
+        return states.codes()
+    try:
+        states = StateCollection([states])
+    except TypeError:
+        states = StateCollection(states)
+    return [state.get_code() for state in states]
+
+def registry_key(observation, initial_code, final_code):
+    '''
+    Return the key of the action mapping for a change of observation from
+    the state of initial_code to that of final_code. Observations are
+    referred to weakly so that registering actions does not keep them alive.
+    '''
+    return (weakref.ref(observation), initial_code, final_code)
+
+def stripe_index(observation, stripe_count):
+    '''
+    Return the index of the stripe of observation, which may also be given
+    by weak reference. CPython hashes most objects by their address, whose
+    low bits are the same for every aligned object, so the hash is mixed
+    before it is divided among the stripes.
+    '''
+
+    code = hash(observation)
+    code ^= code >> 4
+    code ^= code >> 10
+    return code % stripe_count
+
+class PausedCollection(object):
+    '''
+    PausedCollection pauses the cyclic garbage collector within a with
+    block. Registering builds many containers, which would otherwise set off
+    collections over every live object again and again, and the entries
+    built hold no cycles for the collector to find.
+    '''
+
+    def __enter__(self):
+        self.paused = gc.isenabled()
+        if self.paused:
+            gc.disable()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        if self.paused:
+            gc.enable()
+
+def check_singular(initial_state, final_state):
+    '''
+    Raise TypeError unless both states are singular States rather than
+    collections of them.
+    '''
+
+    for check_variable in [initial_state, final_state]:
+        length_test = None
+        try:
+            length_test = len(check_variable)
+        except TypeError:
+            pass
+        if length_test is not None:
+            raise TypeError('initial_state and final_state must not be collections.')
+
+class ActionDispatcher(CoreThread):
+    '''
+    ActionDispatcher is the thread which periodically calls the action
+    manager's main_loop(). A new dispatcher is created each time the action
+    manager is started, so the action manager may be stopped and started
+    again. It is a daemon thread: it will not keep the process alive on its
+    own, and the action manager's shutdown() stops it at exit instead.
+    '''
+
+    def __init__(self, manager, *args, **kwargs):
+        '''
+        manager is the CoreActionManager to dispatch for. All other
+        arguments will be passed into CoreThread.
+        '''
+
+        CoreThread.__init__(self, *args, **kwargs)
+        self.manager = manager
+        self.name = 'ActionDispatcher'
+        self.daemon = True
+
+    def main_loop(self):
+        '''
+        Dispatch queued actions.
+        '''
+        self.manager.main_loop()
+
+class MappingStripe(object):
+    '''
+    MappingStripe holds the registrations of the observations whose hash
+    selects it, under a lock of its own, so that observations of different
+    stripes are registered, looked up, and unregistered without contending.
+    Its methods other than the constructor and prepare() require its write
+    lock to be held.
+    '''
+
+    def __init__(self, index, collected):
+        '''
+        index is the position of this stripe in the action manager.
+        collected is called with the weak reference of an observation of
+        this stripe once the observation has been collected.
+        '''
+
+        self.index = index
+        self.lock = ReadWriteLock()
+        self.collected = collected
+        self.clear()
+
+    def clear(self):
+        '''
+        Remove every registration.
+        '''
+
+        # Initialize an empty mapping of (observation, state, state) to
+        # a set of action classes. Observations are held by weak reference
+        # and states by their codes; see registry_key().
+        self.action_mapping = {}
+        # Reverse indexes of the action mapping: observation to the set of
+        # its keys, and action class to the set of keys it is mapped from.
+        # They let every registration of either be removed without knowing
+        # the states they were registered with.
+        self.observable_index = {}
+        self.action_index = {}
+        # The weak reference to each registered observation used in keys,
+        # keyed by itself. When the observation is collected, the reference
+        # is passed to collected and its keys are removed later, when the
+        # lock can safely be taken.
+        self.observable_refs = {}
+
+    def prepare(self, staged):
+        '''
+        Build the entries of staged, a sequence of ((observation, code,
+        code), actions) pairs of observations of this stripe, ready for
+        install(). Unlike the other methods, this needs no lock, so that
+        the work of a bulk registration is done before any is taken.
+        '''
+
+        # The new weak reference of each observation, and the entries of
+        # the action mapping and reverse indexes which use it.
+        references = {}
+        action_mapping = {}
+        observable_index = {}
+        action_index = {}
+        for key, actions in staged:
+            observation = key[0]
+            reference = references.get(observation)
+            if reference is None:
+                reference = references[observation] = weakref.ref(observation, self.collected)
+                observation_keys = observable_index[reference] = set()
+            else:
+                observation_keys = observable_index[reference]
+            key = (reference, key[1], key[2])
+            action_mapping[key] = actions
+            observation_keys.add(key)
+            for action in actions:
+                keys = action_index.get(action)
+                if keys is None:
+                    action_index[action] = set([key])
+                else:
+                    keys.add(key)
+        return staged, references.values(), action_mapping, observable_index, action_index
+
+    def install(self, prepared):
+        '''
+        Merge the entries built by prepare() into the action mapping. When
+        none of their observations is registered already, as when loading
+        at startup, they are merged a dictionary at a time.
+        '''
+
+        staged, references, staged_mapping, staged_observables, staged_actions = prepared
+        observable_refs = self.observable_refs
+        if any(reference in observable_refs for reference in references):
+            self.merge(staged)
+            return
+
+        for reference in references:
+            observable_refs[reference] = reference
+        self.action_mapping.update(staged_mapping)
+        self.observable_index.update(staged_observables)
+        action_index = self.action_index
+        for action, keys in staged_actions.iteritems():
+            existing = action_index.get(action)
+            if existing is None:
+                action_index[action] = keys
+            else:
+                existing.update(keys)
+
+    def merge(self, staged):
+        '''
+        Merge staged, a sequence of ((observation, code, code), actions)
+        pairs of observations of this stripe, into the action mapping entry
+        by entry.
+        '''
+
+        action_mapping = self.action_mapping
+        observable_index = self.observable_index
+        action_index = self.action_index
+        # The weak reference and index entry of each observation.
+        references = {}
+        for key, actions in staged:
+            observation = key[0]
+            try:
+                reference, observation_keys = references[observation]
+            except KeyError:
+                reference = self.observable_reference(observation)
+                observation_keys = observable_index.setdefault(reference, set())
+                references[observation] = (reference, observation_keys)
+            key = (reference, key[1], key[2])
+            existing = action_mapping.get(key)
+            if existing is None:
+                action_mapping[key] = actions
+                observation_keys.add(key)
+            else:
+                existing.update(actions)
+            for action in actions:
+                keys = action_index.get(action)
+                if keys is None:
+                    action_index[action] = set([key])
+                else:
+                    keys.add(key)
+
+    def observable_reference(self, observation):
+        '''
+        Return the weak reference to observation used in keys, creating one
+        which reports when observation is collected.
+        '''
+
+        reference = self.observable_refs.get(weakref.ref(observation))
+        if reference is None:
+            reference = weakref.ref(observation, self.collected)
+            self.observable_refs[reference] = reference
+        return reference
+
+    def remove_reference(self, reference):
+        '''
+        Remove every registration of the collected observation of reference.
+        '''
+
+        # Dead references only equal themselves, which is what is stored.
+        self.observable_refs.pop(reference, None)
+        for key in self.observable_index.pop(reference, ()):
+            for action in self.action_mapping.pop(key):
+                keys = self.action_index[action]
+                keys.discard(key)
+                if not keys:
+                    del self.action_index[action]
+
+    def remove_from_mapping(self, key, actions):
+        '''
+        Remove actions from the action mapping of key, and key from the
+        reverse indexes wherever it no longer applies.
+        '''
+
+        mapped = self.action_mapping[key]
+        for action in actions.intersection(mapped):
+            keys = self.action_index[action]
+            keys.discard(key)
+            if not keys:
+                del self.action_index[action]
+        mapped.difference_update(actions)
+        if not mapped:
+            del self.action_mapping[key]
+            keys = self.observable_index[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.observable_index[key[0]]
+                del self.observable_refs[key[0]]
+
+class CoreActionManager(object):
     '''
     CoreActionManager acts as a registry for actions to be fired in response
     to observations. Fired actions will be run in individual threads to
     increase parallel utility. Actions are supplied as classes, not objects,
     and will be instantiated as objects when fired.
 
-    This class is implemented as a singleton thread.
-    As a thread, it must be start()ed. 
+    This class is implemented as a singleton. Constructing it has no side
+    effects; queued actions are dispatched by a thread which runs between
+    start() and stop(), or within a with block:
+
+    with action_manager:
+        do some observing
+
+    Unless auto_start is False, the dispatcher is also started the first time
+    an action is queued, so that code which never calls start() still works.
+    When the interpreter exits, shutdown() dispatches any actions still
+    queued, or reports them discarded if the dispatcher was stopped.
     '''
 
     # Cause this object to be a singleton by creating the class using
@@ -42,31 +353,183 @@ class CoreActionManager(CoreThread):
     # metaclass.
     __metaclass__ = Singleton
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, loop_interval=0.1, sleep_delay=None, auto_start=True, lock_timeout=None,
+                 stripe_count=16):
         '''
         Initialize local variables.
-        All arguments will be passed into CoreThread.
+        loop_interval and sleep_delay will be passed into the dispatcher
+        thread; see CoreThread.
+        auto_start determines whether queueing an action starts the
+        dispatcher if it is not running.
+        lock_timeout is the most seconds the dispatcher waits for the lock
+        to drain the action queue before trying again on its next loop; by
+        default, loop_interval.
+        stripe_count is the number of independently locked stripes the
+        registrations are divided into by observation.
         '''
 
-        # Call superclass constructor.
-        CoreThread.__init__(self, *args, **kwargs)
-
-        # Prepare a mutex to prevent concurrent race conditions when
-        # modifying and accessing data in this object by multiple threads.
-        self.access_lock = ReadWriteLock()
+        # Parameters of the dispatcher thread, created by start().
+        self.loop_interval = loop_interval
+        self.sleep_delay = sleep_delay
+        self.auto_start = auto_start
+        # Whether stop() disabled auto_start, for start() to enable again.
+        self.resume_auto_start = False
+        self.dispatcher = None
+        # Serializes start() and stop().
+        self.lifecycle_lock = threading.Lock()
 
-        # Initialize an empty mapping of (observation, state, state) to 
-        # a set of action classes.
-        self.action_mapping = {}
+        # Registrations are divided by observation into stripes, each with
+        # its own lock, rather than guarded by one lock for the whole
+        # manager. Observations collected by the garbage collector are put
+        # in pending_purge and removed from their stripe later, when its
+        # lock can safely be taken.
+        self.stripes = tuple(MappingStripe(index, self.observable_collected)
+                             for index in range(stripe_count))
+        self.pending_purge = []
+        # Serializes the threads taking references out of pending_purge.
+        # The garbage collector only ever appends, which needs no lock, so
+        # it may collect an observation in a thread holding this one.
+        self.purge_lock = threading.Lock()
+        # Observers queue actions under the read lock of queue_lock and the
+        # dispatcher drains the queue under its write lock, so the actions
+        # of a state change are always dispatched together.
+        self.queue_lock = ReadWriteLock()
+        # The dispatcher's bounded waits for queue_lock, and statistics of
+        # them: acquisitions, seconds waited, the longest wait, and timeouts.
+        if lock_timeout is None:
+            lock_timeout = loop_interval
+        self.lock_timeout = lock_timeout
+        self.dispatch_write = self.queue_lock.WriteWithin(lock_timeout)
+        self.dispatch_lock_waits = 0
+        self.dispatch_lock_wait_seconds = 0.0
+        self.dispatch_lock_longest_wait = 0.0
+        self.dispatch_lock_timeouts = 0
         # Initialize an empty mapping of thread to a set of
-        # (observation, state, state) tuples.
+        # (observation, state, state) tuples, guarded by a lock of its own.
+        self.thread_lock = threading.Lock()
         self.thread_mapping = {}
         # Maintain a sequence of actions so that firing order is preserved.
         self.action_queue = Queue()
-        # Maintain a counter of failed queue reads and a threshold after which
-        # the read will wait.
-        self.action_queue_read_counter = 0
-        self.action_queue_read_threshold = 3
+        # Sources of state changes from outside this process, polled by the
+        # dispatcher thread. Replaced rather than modified so that it can be
+        # iterated without a lock.
+        self.sources = []
+
+    def start(self):
+        '''
+        Start dispatching queued actions in a new thread, enabling auto_start
+        again if stop() disabled it. Returns False if the dispatcher was
+        already running, True otherwise.
+        '''
+
+        with self.lifecycle_lock:
+            if self.resume_auto_start:
+                self.auto_start = True
+                self.resume_auto_start = False
+            if self.is_running():
+                return False
+            self.dispatcher = ActionDispatcher(self, loop_interval=self.loop_interval, sleep_delay=self.sleep_delay)
+            self.dispatcher.start()
+        return True
+
+    def stop(self, blocking=False):
+        '''
+        Stop dispatching actions. Queued actions remain queued until the next
+        start(). Stopping also disables auto_start, until the next start(),
+        so that the dispatcher is not restarted behind the caller's back.
+        blocking waits for the dispatcher thread to end.
+        '''
+
+        with self.lifecycle_lock:
+            if self.auto_start:
+                self.resume_auto_start = True
+            self.auto_start = False
+            dispatcher = self.dispatcher
+            if dispatcher is None:
+                return
+            dispatcher.stop()
+        if blocking and dispatcher is not threading.current_thread():
+            dispatcher.join()
+
+    def shutdown(self, drain=True, timeout=None):
+        '''
+        Stop the dispatcher and settle the queued actions, as when the
+        process ends. With drain, queued actions are dispatched from the
+        calling thread and waited for, with any already running, up to
+        timeout seconds in all. Actions left queued are discarded with a
+        warning and their futures fail with RuntimeError. Returns the
+        number of actions discarded.
+        '''
+
+        self.stop(blocking=True)
+        end = None if timeout is None else time.time() + timeout
+        if drain:
+            self.main_loop()
+
+        # Anything still queued, whether or not the lock was had, is dropped.
+        discarded = []
+        while not self.action_queue.empty():
+            discarded.append(self.action_queue.get())
+        for action, observation, initial_state, final_state, queued_time, future in discarded:
+            log.warning('Discarded %s queued for %s at shutdown.', action.__name__, observation)
+            future.set_exception(RuntimeError('The action manager shut down before dispatching %s.' % action.__name__))
+
+        if drain:
+            with self.thread_lock:
+                running = list(self.thread_mapping)
+            for thread in running:
+                if thread is threading.current_thread():
+                    continue
+                remaining = None if end is None else max(end - time.time(), 0)
+                thread.join(remaining)
+            running = [thread for thread in running if thread.is_alive()]
+            if running:
+                log.warning('%d actions were still running at shutdown.', len(running))
+        return len(discarded)
+
+    def join(self, timeout=None):
+        '''
+        Wait for the dispatcher thread, if any, to end.
+        '''
+
+        dispatcher = self.dispatcher
+        if dispatcher is not None and dispatcher is not threading.current_thread():
+            dispatcher.join(timeout)
+
+    def is_running(self):
+        '''
+        Return True while the dispatcher thread is alive. A process forked
+        from a running action manager begins with it not running.
+        '''
+
+        dispatcher = self.dispatcher
+        return dispatcher is not None and dispatcher.do_loop and dispatcher.is_alive()
+
+    def add_source(self, source):
+        '''
+        Poll source on every loop of the dispatcher thread by calling its
+        poll() method, which should report any state changes it has
+        received with check_state_change(). Starts the dispatcher unless
+        auto_start is off.
+        '''
+
+        self.sources = self.sources + [source]
+        if self.auto_start and not self.is_running():
+            self.start()
+
+    def remove_source(self, source):
+        '''
+        Stop polling source.
+        '''
+
+        self.sources = [other for other in self.sources if other is not source]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.stop(blocking=True)
 
     def associate_action_with_state_change(self, action, observation,
                                            initial_state, final_state):
@@ -76,39 +539,181 @@ class CoreActionManager(CoreThread):
 
         The action may be a single action class or a collection of action
         classes.
-        The states may be single states or a collection of states, signifying
-        that any of the states apply to the transition.
+        The states may be single states, a collection of states, or a
+        StatePattern, signifying that any of the states apply to the
+        transition.
         '''
 
-        # Convert into a set for consistency and to eliminate duplication.
-        try:
-            action = set([action])
-        except TypeError:
-            action = set(action)
-        try:
-            initial_state = StateCollection([initial_state])
-        except TypeError:
-            initial_state = StateCollection(initial_state)
-        try:
-            final_state = StateCollection([final_state])
-        except TypeError:
-            final_state = StateCollection(final_state)
+        self.associate_actions([(action, observation, initial_state, final_state)])
 
-        # Build a series of keys (tuples) to map actions to.
-        keys = []
-        for i_state in initial_state:
-            for f_state in final_state:
-                keys.append(tuple([observation, i_state.get_primary(), f_state.get_primary()]))
+    def associate_actions(self, registrations):
+        '''
+        Register many actions at once. registrations is an iterable of
+        (action, observation, initial_state, final_state) tuples, each as
+        for associate_action_with_state_change(). All of the registrations
+        are expanded before the write lock is taken, and then installed
+        under a single acquisition of it, so that dispatch never sees only
+        some of them.
+        '''
+
+        # Expanding the same states repeatedly is the bulk of the work, so
+        # remember each expansion. The states are kept alongside so that
+        # their ids cannot be reused while the cache is in use.
+        expansions = {}
+        def expand(states):
+            expansion = expansions.get(id(states))
+            if expansion is None:
+                expansion = expansions[id(states)] = (states, state_codes(states))
+            return expansion[1]
+
+        # Build the mapping of keys (tuples) to the actions to add to them.
+        staged = {}
+        with PausedCollection():
+            for action, observation, initial_state, final_state in registrations:
+                action = as_action_set(action)
+                final_codes = expand(final_state)
+                for i_code in expand(initial_state):
+                    for f_code in final_codes:
+                        key = (observation, i_code, f_code)
+                        if key in staged:
+                            staged[key].update(action)
+                        else:
+                            staged[key] = set(action)
+
+            self.install_mapping(staged)
+
+    def install_mapping(self, staged):
+        '''
+        Merge staged, a mapping of (observation, code, code) keys to
+        sets of action classes, into the action mapping while holding the
+        write lock of every stripe involved, taken in order. The entries are
+        built beforehand, so the locks are held only to merge them. staged
+        must not be used afterwards.
+        '''
+
+        if self.pending_purge:
+            self.purge_collected()
+
+        # Divide the registrations among the stripes of their observations
+        # and build their entries before any lock is taken.
+        stripe_count = len(self.stripes)
+        divided = {}
+        with PausedCollection():
+            for item in staged.iteritems():
+                index = stripe_index(item[0][0], stripe_count)
+                if index in divided:
+                    divided[index].append(item)
+                else:
+                    divided[index] = [item]
+            # Few registrations are merged as they are, as preparing them
+            # would only add to the work.
+            prepared = dict((index, self.stripes[index].prepare(items))
+                            for index, items in divided.iteritems()
+                            if len(items) >= PREPARE_MINIMUM)
 
-        # Create or update the mapping depending upon whether it already
-        # exists or not.
         # Prevent writing this data while another thread might be reading it.
-        with self.access_lock.Write:
-            for key in keys:
-                if self.action_mapping.has_key(key):
-                    self.action_mapping[key].update(action.copy())
+        # Taking the locks in order means concurrent installs cannot
+        # deadlock; holding them all means dispatch never sees only some of
+        # the registrations. Only the merging is done under the locks.
+        held = []
+        try:
+            for index in sorted(divided):
+                stripe = self.stripes[index]
+                stripe.lock.Write.__enter__()
+                held.append(stripe)
+            for stripe in held:
+                if stripe.index in prepared:
+                    stripe.install(prepared[stripe.index])
                 else:
-                    self.action_mapping[key] = action.copy()
+                    stripe.merge(divided[stripe.index])
+        finally:
+            for stripe in reversed(held):
+                stripe.lock.Write.__exit__()
+
+    def stripe(self, observation):
+        '''
+        Return the stripe holding the registrations of observation, which
+        may also be given by weak reference.
+        '''
+        return self.stripes[stripe_index(observation, len(self.stripes))]
+
+    def observable_collected(self, reference):
+        '''
+        Called by the garbage collector once a registered observation is
+        gone, possibly in a thread holding a lock; so only note the
+        reference for purge_collected().
+        '''
+        self.pending_purge.append(reference)
+
+    def purge_collected(self):
+        '''
+        Remove every registration of observations which have been collected.
+        This happens anyway on each loop of the dispatcher thread and when
+        actions are registered.
+        '''
+
+        divided = {}
+        with self.purge_lock:
+            while self.pending_purge:
+                reference = self.pending_purge.pop()
+                divided.setdefault(self.stripe(reference), []).append(reference)
+        for stripe, references in divided.iteritems():
+            with stripe.lock.Write:
+                for reference in references:
+                    stripe.remove_reference(reference)
+
+    def registrations_of(self, observation):
+        '''
+        Return a dictionary of (initial code, final code) to a copy of the
+        set of action classes registered for each change of observation.
+        '''
+
+        stripe = self.stripe(observation)
+        with stripe.lock.Read:
+            keys = stripe.observable_index.get(weakref.ref(observation), ())
+            return dict(((key[1], key[2]), set(stripe.action_mapping[key])) for key in keys)
+
+    def locks(self):
+        '''
+        Return a list of (name, lock) of every lock of the action manager,
+        for example to profile them.
+        '''
+
+        locks = [('stripe%d' % stripe.index, stripe.lock) for stripe in self.stripes]
+        locks.append(('queue', self.queue_lock))
+        return locks
+
+    # The registrations of all stripes, merged. Each is a copy, for
+    # inspection only.
+
+    @property
+    def action_mapping(self):
+        merged = {}
+        for stripe in self.stripes:
+            merged.update(stripe.action_mapping)
+        return merged
+
+    @property
+    def observable_index(self):
+        merged = {}
+        for stripe in self.stripes:
+            merged.update(stripe.observable_index)
+        return merged
+
+    @property
+    def action_index(self):
+        merged = {}
+        for stripe in self.stripes:
+            for action, keys in stripe.action_index.items():
+                merged.setdefault(action, set()).update(keys)
+        return merged
+
+    @property
+    def observable_refs(self):
+        merged = {}
+        for stripe in self.stripes:
+            merged.update(stripe.observable_refs)
+        return merged
 
     def disassociate_action_from_state_change(self, action, observation,
                                               initial_state, final_state):
@@ -127,42 +732,78 @@ class CoreActionManager(CoreThread):
             action = set([action])
         except TypeError:
             action = set(action)
-        try:
-            initial_state = StateCollection([initial_state])
-        except TypeError:
-            initial_state = StateCollection(initial_state)
-        try:
-            final_state = StateCollection([final_state])
-        except TypeError:
-            final_state = StateCollection(final_state)
+        initial_codes = state_codes(initial_state)
+        final_codes = state_codes(final_state)
 
         # Build a series of keys (tuples) to remove mapped actions from.
         keys = []
-        for i_state in initial_state:
-           for f_state in final_state:
-               keys.append((observation, i_state.get_primary(), f_state.get_primary()))
+        for i_code in initial_codes:
+           for f_code in final_codes:
+               keys.append(registry_key(observation, i_code, f_code))
 
         # While there are two for loops that could be made one, the work
         # performed at the end  requires a write lock. It is not worth
         # holding the lock for the additional time spent, thus extra loop.
 
         # Atomically check for errors prior to removing actions.
+        stripe = self.stripe(observation)
+        action_mapping = stripe.action_mapping
         for key in keys:
-            if not self.action_mapping.has_key(key):
+            if not action_mapping.has_key(key):
                 msg = 'Action Manager cannot unregister {1} from {0} as {0} is not registered at all.'.format(key, action)
                 log.error(msg)
                 raise KeyError(msg)
-            if len(self.action_mapping[key].intersection(action)) != 1:
+            if len(action_mapping[key].intersection(action)) != 1:
                 msg = 'Action Manager cannot unregister {1} from {0} as {1} is not registered with {0}.'.format(key, action)
                 log.error(msg)
                 raise KeyError(msg)
         # Remove the given action from the state change if it is defined.
         # Prevent writing this data while another thread might be reading it.
-        with self.access_lock.Write:
+        with stripe.lock.Write:
             for key in keys:
-                self.action_mapping[key].difference_update(action)
-                if len(self.action_mapping[key]) == 0:
-                    del self.action_mapping[key]
+                stripe.remove_from_mapping(key, action)
+
+    def disassociate_all(self, target):
+        '''
+        Remove every registration of target, which is either an observation
+        or an action class, whatever states it was registered with. Takes
+        time in proportion to the number of registrations removed.
+        Returns the number of (observation, state, state) keys affected.
+        '''
+
+        if not isinstance(target, type):
+            stripe = self.stripe(target)
+            with stripe.lock.Write:
+                keys = list(stripe.observable_index.get(weakref.ref(target), ()))
+                for key in keys:
+                    stripe.remove_from_mapping(key, set(stripe.action_mapping[key]))
+            return len(keys)
+
+        # An action may be registered in every stripe.
+        count = 0
+        actions = set([target])
+        for stripe in self.stripes:
+            with stripe.lock.Write:
+                # Copy the keys, which are removed from the index as we go.
+                keys = list(stripe.action_index.get(target, ()))
+                for key in keys:
+                    stripe.remove_from_mapping(key, actions)
+            count += len(keys)
+        return count
+
+    def clear_mapping(self):
+        '''
+        Remove every registration of every action.
+        '''
+
+        # Forget the references pending first: any collected afterwards may
+        # be of observations registered again meanwhile. The list itself is
+        # kept, as the garbage collector may be appending to it.
+        with self.purge_lock:
+            del self.pending_purge[:]
+        for stripe in self.stripes:
+            with stripe.lock.Write:
+                stripe.clear()
 
     def check_state_change(self, observation, initial_state, final_state):
         '''
@@ -170,87 +811,151 @@ class CoreActionManager(CoreThread):
         Instantiate and run any associated actions in separate threads.
         initial_state and final_state must be singular states and must not
         be collections of states.
+        Returns a list of ActionFutures, one for each action fired.
         '''
 
-        # contract to ensure states are singular and not collections.
-        for check_variable in [initial_state, final_state]:
-            length_test = None
-            try:
-                length_test = len(check_variable)
-            except TypeError:
-                pass
-            if length_test is not None:
-                raise TypeError('initial_state and final_state must not be collections.')
+        check_singular(initial_state, final_state)
 
         # Create a tuple for the action response mapping.
-        key = (observation, initial_state.get_primary(), final_state.get_primary())
+        key = registry_key(observation, initial_state.get_code(), final_state.get_code())
 
         # Do not bother pursuing any actions if none are defined.
-        # Otherwise build a list of actions
-        with self.access_lock.Read:
-            if not self.action_mapping.has_key(key):
-                actions = None
-            else:
-                actions = self.action_mapping[key]
+        # Otherwise build a list of actions, copied as the set may change
+        # once the lock is released.
+        stripe = self.stripe(observation)
+        with stripe.lock.Read:
+            actions = stripe.action_mapping.get(key)
+            if actions is not None:
+                actions = tuple(actions)
         if actions is None:
-            return
+            return []
 
-        # Queue each action to be fired.
-        with self.access_lock.Write:
+        # Queue each action to be fired, noting when so that the dispatch
+        # latency can be measured. Observers queue concurrently; only the
+        # dispatcher excludes them.
+        queued_time = time.time()
+        futures = []
+        with self.queue_lock.Read:
             for action in actions:
-                self.action_queue.put( (action, observation, initial_state, final_state) )
+                future = ActionFuture(action, observation, initial_state, final_state)
+                futures.append(future)
+                self.action_queue.put( (action, observation, initial_state, final_state, queued_time, future) )
+
+        # Dispatch the actions even if nobody has started the action manager.
+        if self.auto_start and not self.is_running():
+            self.start()
+
+        return futures
+
+    def check_state_changes(self, changes):
+        '''
+        Submit a batch of changes, a sequence of (observation, initial_state,
+        final_state), as check_state_change() would each of them, taking
+        the read lock of each stripe and of the queue once for the batch.
+        Returns a list of the ActionFutures of each change, in order.
+        '''
+
+        changes = list(changes)
+        stripe_count = len(self.stripes)
+        # The positions of the changes of each stripe.
+        divided = {}
+        for position, (observation, initial_state, final_state) in enumerate(changes):
+            check_singular(initial_state, final_state)
+            index = stripe_index(observation, stripe_count)
+            if index in divided:
+                divided[index].append(position)
+            else:
+                divided[index] = [position]
+
+        # Copy the actions of each change, as the sets may change once the
+        # locks are released.
+        fired = []
+        for index, positions in divided.iteritems():
+            stripe = self.stripes[index]
+            with stripe.lock.Read:
+                action_mapping = stripe.action_mapping
+                for position in positions:
+                    observation, initial_state, final_state = changes[position]
+                    actions = action_mapping.get(registry_key(observation, initial_state.get_code(), final_state.get_code()))
+                    if actions is not None:
+                        fired.append((position, tuple(actions)))
+
+        results = [[] for change in changes]
+        if not fired:
+            return results
+
+        queued_time = time.time()
+        with self.queue_lock.Read:
+            for position, actions in sorted(fired):
+                observation, initial_state, final_state = changes[position]
+                futures = results[position]
+                for action in actions:
+                    future = ActionFuture(action, observation, initial_state, final_state)
+                    futures.append(future)
+                    self.action_queue.put( (action, observation, initial_state, final_state, queued_time, future) )
+
+        if self.auto_start and not self.is_running():
+            self.start()
+
+        return results
 
     def main_loop(self):
         '''
-        This method will be called periodically by Action Manager thread.
+        This method will be called periodically by the dispatcher thread.
         Consume actions from the action queue, fire them, and resolve them.
         '''
 
-        # Do a quick test to see if there is anything in the queue, so a Write
-        # lock doesn't hold us back for no reason.
-        empty_queue = False
-        if self.action_queue_read_counter < self.action_queue_read_threshold:
+        # Collect state changes from outside this process first so that
+        # their actions are fired in this same loop.
+        for source in self.sources:
             try:
-                with self.access_lock.ReadOrNot:
-                    empty_queue = self.action_queue.empty()
-                    self.action_queue_read_counter = 0
-            except LockError:
-                # Failed to get a read lock, which means a write must be
-                # ongoing. Try again on the next loop. Pretend queue was
-                # empty for now.
-                self.action_queue_read_counter = \
-                        self.action_queue_read_counter + 1
-                empty_queue = True
-        else:
-            # After 3 failed attempts, wait for the lock.
-            log.warn('Action Manager has failed to acquire a read lock three times in a row. Attempting to wait on the lock. If a write lock did not release, this could permanently stall the Action Manager.')
-            with self.access_lock.Read:
-                empty_queue = self.action_queue.empty()
-                self.action_queue_read_counter = 0
-        if empty_queue:
+                source.poll()
+            except Exception, e:
+                log.error('Failed to poll source %s.', source, exc_info=True)
+
+        # Forget observations which have been collected.
+        if self.pending_purge:
+            self.purge_collected()
+
+        # Do a quick test to see if there is anything in the queue, so a Write
+        # lock doesn't hold us back for no reason. The Queue has a mutex of
+        # its own.
+        if self.action_queue.empty():
             return
 
-        # Draw off the actions from the queue while locking to modify.
+        # Draw off the actions from the queue while locking to modify. Waits
+        # for the lock are bounded so that a long write delays dispatch by
+        # at most lock_timeout; the queue is left as it is and read again on
+        # the next loop.
         queued_actions = []
-        with self.access_lock.Write:
-            while not self.action_queue.empty():
-                queued_actions.append( self.action_queue.get() )
+        begin = time.time()
+        try:
+            with self.dispatch_write:
+                self.record_lock_wait(time.time() - begin, True)
+                while not self.action_queue.empty():
+                    queued_actions.append( self.action_queue.get() )
+        except LockError:
+            self.record_lock_wait(time.time() - begin, False)
+            log.warn('Action Manager could not acquire a write lock within %s seconds; trying again on the next loop.', self.lock_timeout)
+            return
         # TODO make this method atomic: upon failure, restore action queue
 
         # Process actions in order and kick them off.
         for queued_action in queued_actions:
-            action, observation, initial_state, final_state = queued_action
-            key = (observation, initial_state.get_primary(), final_state.get_primary())
+            action, observation, initial_state, final_state, queued_time, future = queued_action
+            key = registry_key(observation, initial_state.get_code(), final_state.get_code())
             try:
-                # initialize an action object
+                # initialize an action object, which resolves its future.
                 thread = action(observation, initial_state, final_state)
+                thread.future = future
+                future.thread = thread
 
                 # register this as a running thread prior to running it.
                 # otherwise the other thread might complete before this thread
                 # can update the dictionary.
 
                 # track thread. each threaded action should be unique.
-                with self.access_lock.Write:
+                with self.thread_lock:
                     if self.thread_mapping.has_key(thread):
                         log.warning('Threaded action %s already being tracked!', thread)
                     self.thread_mapping[thread] = key
@@ -259,6 +964,24 @@ class CoreActionManager(CoreThread):
 
             except Exception, e:
                 log.error('Failed to start thread for %s.', action.__class__, exc_info=True)
+                future.set_exception(e)
+            else:
+                if metrics.enabled:
+                    metrics.record_action_started(action, time.time() - queued_time)
+
+    def record_lock_wait(self, seconds, acquired):
+        '''
+        Record that the dispatcher waited seconds for the lock, and whether
+        it acquired it. Only called from the dispatcher thread.
+        '''
+
+        if acquired:
+            self.dispatch_lock_waits += 1
+        else:
+            self.dispatch_lock_timeouts += 1
+        self.dispatch_lock_wait_seconds += seconds
+        if seconds > self.dispatch_lock_longest_wait:
+            self.dispatch_lock_longest_wait = seconds
 
     def action_completed(self, action):
         '''
@@ -270,7 +993,7 @@ class CoreActionManager(CoreThread):
 
         # remove the thread from action manager tracking
         # lock for modifications.
-        with self.access_lock.Write:
+        with self.thread_lock:
             try:
                 del self.thread_mapping[action]
             except KeyError, e:
@@ -282,7 +1005,7 @@ class CoreActionManager(CoreThread):
 
 
 
-# Create the singleton.
+# Create the singleton. This does not start any thread.
 # Set the loop interval for checking new actions to approximately
 # 10 times/sec (allot ~0.1 seconds per check).
 action_manager = CoreActionManager(loop_interval=0.1)
@@ -294,11 +1017,25 @@ def stop_action_manager(signum, frame):
     action_manager.join()
     log.info('Action Manager thread has stopped execution.')
 
-# Intercept signals for Windows!
-# (claims to be supported in Python 2.7, but not found in my 2.7.1)
-#signal.signal(signal.CTRL_C_EVENT, stop_action_manager)
-# Intercept signals for Not Windows!
-signal.signal(signal.SIGINT, stop_action_manager)
+def shutdown_action_manager():
+    '''
+    Called at interpreter exit. If the dispatcher is running, the actions
+    still queued are dispatched and waited for up to EXIT_TIMEOUT seconds;
+    otherwise they are discarded and reported. Either way the dispatcher
+    ends before the interpreter tears down the modules it uses.
+    '''
+    action_manager.shutdown(drain=action_manager.is_running(), timeout=EXIT_TIMEOUT)
+
+atexit.register(shutdown_action_manager)
+
+def install_signal_handler(signum=signal.SIGINT):
+    '''
+    Stop the action manager when the process receives signum. Must be called
+    from the main thread. Returns the previous handler.
+    '''
 
-# Start the action manager thread a-runnin'!
-action_manager.start()
+    # Intercept signals for Windows!
+    # (claims to be supported in Python 2.7, but not found in my 2.7.1)
+    #signal.signal(signal.CTRL_C_EVENT, stop_action_manager)
+    # Intercept signals for Not Windows!
+    return signal.signal(signum, stop_action_manager)
@@ -0,0 +1,192 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains logging which never holds up the thread logging.
+Observers and the action manager log from their loops; a handler writing to
+a slow disk, a full pipe or the network would stall them on every message,
+and a storm of errors would stall them on every loop. AsyncHandler instead
+queues records for a thread of its own to pass to the real handlers, dropping
+records rather than waiting when the queue is full. Messages are formatted
+in that thread, so logging calls should pass their arguments separately,
+log.error('Bad result %s.', result), rather than formatting them first, and
+must not change those arguments afterwards.
+RateLimitFilter lets through a few records from each line of code per
+interval and counts the rest.
+
+install_async_logging()
+
+moves the handlers of the root logger behind an AsyncHandler, limited by a
+RateLimitFilter, and remove_async_logging() puts them back.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import Queue
+import logging
+import threading
+
+# Queued to the handling thread to end it.
+STOP = object()
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    RateLimitFilter passes at most burst records from each site (the file
+    and line of the logging call) per interval seconds and suppresses the
+    rest. The first record passed from a site after some were suppressed
+    has their number as its suppressed attribute, which formats may show
+    with %(suppressed)s; other records have 0.
+    '''
+
+    def __init__(self, interval=1.0, burst=5):
+        logging.Filter.__init__(self)
+
+        self.interval = interval
+        self.burst = burst
+        self.lock = threading.Lock()
+        # Keyed by (pathname, lineno): [start of interval, records passed
+        # within it, records suppressed since one was last passed].
+        self.sites = {}
+        # Records suppressed in all.
+        self.suppressed = 0
+
+    def filter(self, record):
+        '''
+        Return True if record may be logged.
+        '''
+
+        site = (record.pathname, record.lineno)
+        now = record.created
+        with self.lock:
+            window = self.sites.get(site)
+            if window is None:
+                window = self.sites[site] = [now, 0, 0]
+            elif now - window[0] >= self.interval:
+                window[0] = now
+                window[1] = 0
+            if window[1] >= self.burst:
+                window[2] += 1
+                self.suppressed += 1
+                return False
+            window[1] += 1
+            record.suppressed = window[2]
+            window[2] = 0
+        return True
+
+
+class AsyncHandler(logging.Handler):
+    '''
+    AsyncHandler passes records to handlers from a thread of its own, so
+    that emit() only ever queues the record. Records are dropped and
+    counted when capacity records are already waiting.
+    '''
+
+    def __init__(self, handlers, capacity=10000, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+
+        self.handlers = list(handlers)
+        self.queue = Queue.Queue(capacity)
+        # Records dropped because the queue was full.
+        self.dropped = 0
+        # The logger install_async_logging() attached this handler to.
+        self.logger = None
+
+        self.thread = threading.Thread(target=self.handle_records, name='AsyncHandler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        '''
+        Queue record for the handling thread. Exception information is
+        formatted later, like the message, from the traceback in record.
+        '''
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def handle_records(self):
+        '''
+        Pass queued records to the handlers until closed.
+        '''
+
+        while True:
+            record = self.queue.get()
+            try:
+                if record is STOP:
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            except Exception:
+                self.handleError(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        '''
+        Wait until every record queued so far has been handled, then flush
+        the handlers.
+        '''
+
+        if self.thread.is_alive():
+            self.queue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        '''
+        Handle the records still queued and stop the handling thread.
+        Records emitted afterwards are never handled.
+        '''
+
+        if self.thread.is_alive():
+            self.queue.put(STOP)
+            self.thread.join()
+
+    def close(self):
+        '''
+        Stop the handling thread and close the handlers.
+        '''
+
+        self.stop()
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+def install_async_logging(logger=None, capacity=10000, interval=1.0, burst=5):
+    '''
+    Move the handlers of logger, the root logger by default, behind an
+    AsyncHandler of capacity records limited by a RateLimitFilter of
+    interval and burst; burst None applies no limit. Loggers which do not
+    propagate to logger keep their own handlers. Returns the AsyncHandler.
+    '''
+
+    if logger is None:
+        logger = logging.getLogger()
+    handler = AsyncHandler(logger.handlers, capacity)
+    if burst is not None:
+        handler.addFilter(RateLimitFilter(interval, burst))
+    handler.logger = logger
+    # Replace the list at once so that threads logging meanwhile see either
+    # list whole.
+    logger.handlers = [handler]
+    return handler
+
+def remove_async_logging(handler):
+    '''
+    Put back the handlers moved by install_async_logging() once the records
+    queued have been handled.
+    '''
+
+    logger = handler.logger
+    if logger is not None:
+        logger.handlers = [existing for existing in logger.handlers if existing is not handler] + handler.handlers
+        handler.logger = None
+    # Stop the thread without closing the handlers, which are in use again.
+    handler.stop()
+    logging.Handler.close(handler)
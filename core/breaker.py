@@ -0,0 +1,209 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains the CircuitBreaker, which stops an observable
+from calling get_observation() while whatever it observes is failing. A dead
+device otherwise costs a call, often a timeout, on every poll forever.
+
+After failure_threshold consecutive failures the circuit opens and
+observations are skipped, the state remaining stale, for a delay. When the
+delay is over the circuit is half-open: one observation is let through as a
+probe. If it succeeds the circuit closes again; if it fails the circuit
+reopens for longer, twice as long by default, up to max_delay.
+
+observable.enable_circuit_breaker(failure_threshold=3, max_delay=300)
+
+Every CircuitBreaker is counted by the circuit_fleet singleton, which the
+metrics export.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import time
+import random
+import logging
+import weakref
+import threading
+
+log = logging.getLogger('Circuit Breakers')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitFleet(object):
+    '''
+    CircuitFleet keeps track of every CircuitBreaker in the process, so that
+    failing observables can be counted across the fleet.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.breakers = weakref.WeakSet()
+        # Times any circuit has opened.
+        self.trips = 0
+        # Observations skipped by any open circuit.
+        self.skipped = 0
+
+    def add(self, breaker):
+        '''
+        Count breaker for as long as it exists.
+        '''
+        with self.lock:
+            self.breakers.add(breaker)
+
+    def record_trip(self):
+        '''
+        Record that a circuit has opened.
+        '''
+        with self.lock:
+            self.trips += 1
+
+    def record_skip(self):
+        '''
+        Record that an open circuit skipped an observation.
+        '''
+        with self.lock:
+            self.skipped += 1
+
+    def counts(self):
+        '''
+        Return a dictionary of each circuit state to the number of circuits
+        in it.
+        '''
+
+        with self.lock:
+            breakers = list(self.breakers)
+        counts = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        for breaker in breakers:
+            counts[breaker.get_state()] += 1
+        return counts
+
+    def open_count(self):
+        '''
+        Return the number of circuits which are open or half-open.
+        '''
+
+        counts = self.counts()
+        return counts[OPEN] + counts[HALF_OPEN]
+
+# Module singleton.
+circuit_fleet = CircuitFleet()
+
+
+class CircuitBreaker(object):
+    '''
+    CircuitBreaker decides whether each observation may be attempted and is
+    told how each attempt went. The delay before the first probe is
+    base_delay, multiplied by multiplier after each failed probe up to
+    max_delay. jitter lengthens each delay by a random fraction of it up to
+    jitter, so that devices which failed together are not probed together.
+    name identifies the circuit in the log.
+    '''
+
+    def __init__(self, failure_threshold=3, base_delay=1.0, max_delay=60.0,
+                 multiplier=2.0, jitter=0.1, seed=None, name='', fleet=None):
+        if failure_threshold < 1:
+            raise ValueError('A circuit breaker requires a failure_threshold of at least 1; got %s.' % failure_threshold)
+        if not 0 < base_delay <= max_delay:
+            raise ValueError('A circuit breaker requires 0 < base_delay <= max_delay; got %s and %s.' % (base_delay, max_delay))
+        if multiplier < 1:
+            raise ValueError('A circuit breaker requires a multiplier of at least 1; got %s.' % multiplier)
+
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.name = name
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        # Consecutive failures while closed.
+        self.failures = 0
+        # The delay of the current or last opening, and when it ends.
+        self.delay = 0.0
+        self.retry_at = 0.0
+        # Whether the half-open probe has been let through.
+        self.probing = False
+        # Observations skipped while open.
+        self.skipped = 0
+
+        self.fleet = fleet or circuit_fleet
+        self.fleet.add(self)
+
+    def get_state(self):
+        '''
+        Return CLOSED, OPEN, or HALF_OPEN.
+        '''
+        return self.state
+
+    def allow(self, now=None):
+        '''
+        Return True if an observation may be attempted now. Once the delay
+        is over, the circuit becomes half-open and lets exactly one probe
+        through until its outcome is recorded.
+        '''
+
+        if self.state is CLOSED:
+            return True
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self.state is OPEN and now >= self.retry_at:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state is HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            if self.state is CLOSED:
+                return True
+            self.skipped += 1
+        self.fleet.record_skip()
+        return False
+
+    def record_success(self):
+        '''
+        Record a successful observation, closing the circuit.
+        '''
+
+        if self.state is CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.failures = 0
+            if self.state is not CLOSED:
+                log.info('Circuit %s closed after a successful observation.', self.name)
+            self.state = CLOSED
+            self.delay = 0.0
+            self.probing = False
+
+    def record_failure(self, now=None):
+        '''
+        Record a failed observation, opening the circuit after
+        failure_threshold of them in a row, or straight away if it was the
+        probe of a half-open circuit.
+        '''
+
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self.state is CLOSED:
+                self.failures += 1
+                if self.failures < self.failure_threshold:
+                    return
+                self.delay = self.base_delay
+            elif self.state is OPEN:
+                # An observation begun before the circuit opened.
+                return
+            else:
+                self.delay = min(self.delay * self.multiplier, self.max_delay)
+            self.state = OPEN
+            self.probing = False
+            self.retry_at = now + self.delay * (1 + self.jitter * self.random.random())
+            delay = self.delay
+        self.fleet.record_trip()
+        log.warning('Circuit %s opened for %s seconds.', self.name, delay)
@@ -0,0 +1,175 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains DerivedObservable, an observable whose result is
+a function of the results of other observables, its inputs. It does not
+poll: whenever an input changes state, everything derived from it is
+re-evaluated straight away in the thread which observed the change. Only
+observables downstream of a change are re-evaluated, each at most once, in
+order of their rank (distance from plain observables), so that a derived
+observable always sees its inputs after they have been brought up to date.
+
+Pump on and pressure low:
+
+pump_low = DerivedObservable([pump, pressure], lambda on, low: all_true(on, low))
+pump_low.register_action(...)
+
+Results are True, False, or None for unknown. The helpers all_true(),
+any_true(), and negate() combine them, treating None as unknown.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import heapq
+import logging
+import threading
+
+from gdci.core.observable import CoreObservable
+
+log = logging.getLogger('Derived')
+
+# Propagations are serialized so that a derived observable is never
+# evaluated by two threads at once.
+propagation_lock = threading.Lock()
+# Marks the thread running a propagation, whose re-evaluations must not
+# start propagations of their own.
+propagating = threading.local()
+
+
+def all_true(*values):
+    '''
+    True if all values are True, False if any is False, otherwise None.
+    '''
+
+    if False in values:
+        return False
+    if None in values:
+        return None
+    return True
+
+def any_true(*values):
+    '''
+    True if any value is True, False if all are False, otherwise None.
+    '''
+
+    if True in values:
+        return True
+    if None in values:
+        return None
+    return False
+
+def negate(value):
+    '''
+    The opposite of True or False; None remains None.
+    '''
+
+    if value is None:
+        return None
+    return not value
+
+def input_result(observable):
+    '''
+    Return the result of an observable's current state, or None if it is not
+    currently being observed.
+    '''
+
+    # The first two primary attributes, whatever the state_class names them.
+    is_operating, result = observable.get_state().get_primary()[:2]
+    if is_operating is not True:
+        return None
+    return result
+
+def propagate(observable):
+    '''
+    Re-evaluate everything derived from observable, which has just changed
+    state, in order of rank. Called by CoreObservable.notify_dependents().
+    '''
+
+    # A re-evaluation within a propagation only needs its dependents added
+    # to that propagation, which it does itself.
+    if getattr(propagating, 'active', False):
+        return
+
+    with propagation_lock:
+        propagating.active = True
+        try:
+            # Heap of (rank, sequence, observable); sequence keeps
+            # observables themselves from being compared.
+            pending = []
+            queued = set()
+            def schedule(changed):
+                for dependent in changed.dependents:
+                    if id(dependent) not in queued:
+                        queued.add(id(dependent))
+                        heapq.heappush(pending, (dependent.rank, len(queued), dependent))
+
+            schedule(observable)
+            while pending:
+                rank, sequence, derived = heapq.heappop(pending)
+                before = derived.get_state()
+                # check_observation() returns the same State until it changes.
+                if derived.check_observation() is not before:
+                    schedule(derived)
+        finally:
+            propagating.active = False
+
+
+class DerivedObservable(CoreObservable):
+    '''
+    DerivedObservable observes a function of other observables. It may be
+    used like any other observable, and may itself be an input to others.
+    '''
+
+    def __init__(self, inputs, function=None, *args, **kwargs):
+        '''
+        inputs is a sequence of observables. function is called with the
+        result of each input, in order, and must return what
+        get_observation() would: True, False, None, or (result, dictionary).
+        Without a function, derive() must be overridden instead.
+        The state is unknown until an input changes or check_observation()
+        is called.
+        '''
+
+        CoreObservable.__init__(self, *args, **kwargs)
+
+        self.inputs = tuple(inputs)
+        if not self.inputs:
+            msg = 'DerivedObservable requires at least one input.'
+            log.error(msg)
+            raise ValueError(msg)
+        if function is not None:
+            self.derive = function
+
+        # Inputs are always evaluated first: rank one more than the
+        # highest ranked input. Plain observables have rank 0.
+        self.rank = 1 + max(getattr(observable, 'rank', 0) for observable in self.inputs)
+
+        # Replace rather than modify dependents so that propagations
+        # underway can iterate them without a lock.
+        for observable in self.inputs:
+            observable.dependents = observable.dependents + (self,)
+
+    def derive(self, *results):
+        '''
+        derive should be defined by subclasses which are not given a
+        function.
+        '''
+        raise NotImplementedError("derive() must be overridden.")
+
+    def get_observation(self):
+        '''
+        Apply the function to the current results of the inputs.
+        '''
+        return self.derive(*[input_result(observable) for observable in self.inputs])
+
+    def detach(self):
+        '''
+        Stop being re-evaluated when the inputs change, for example before
+        discarding this observable; the inputs refer to it until then.
+        '''
+
+        for observable in self.inputs:
+            observable.dependents = tuple(dependent for dependent in observable.dependents
+                                          if dependent is not self)
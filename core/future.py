@@ -0,0 +1,172 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains ActionFuture, the eventual outcome of an action
+fired by the action manager. check_state_change() returns a future for each
+action it queues; the future is resolved with the return value of the
+action's perform_action(), or the exception it raised, once the action's
+thread has completed. Code orchestrating observations can then wait on the
+actions they trigger instead of polling for their effects:
+
+futures = action_manager.check_state_change(observable, initial, final)
+done, not_done = wait_all(futures, timeout=5)
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import time
+import logging
+import threading
+
+log = logging.getLogger('Futures')
+
+
+class TimeoutError(RuntimeError):
+    '''
+    A future was not resolved within the time allowed.
+    '''
+    pass
+
+
+class ActionFuture(object):
+    '''
+    ActionFuture holds the result of one firing of an action class in
+    response to a state change of an observable. It is resolved exactly once,
+    by set_result() or set_exception(), which the action manager and the
+    action take care of.
+    '''
+
+    def __init__(self, action, observable, initial_state, final_state):
+        '''
+        action is the action class fired in response to observable changing
+        from initial_state to final_state.
+        '''
+
+        self.action = action
+        self.observable = observable
+        self.initial_state = initial_state
+        self.final_state = final_state
+        # The action object, once the action manager has created it.
+        self.thread = None
+
+        self.condition = threading.Condition()
+        self.resolved = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def __str__(self):
+        if not self.resolved:
+            status = 'pending'
+        elif self.error is not None:
+            status = 'raised %r' % self.error
+        else:
+            status = 'returned %r' % (self.value,)
+        return '<ActionFuture of %s: %s>' % (self.action.__name__, status)
+
+    def done(self):
+        '''
+        Return True once the action has completed or failed.
+        '''
+        return self.resolved
+
+    def wait(self, timeout=None):
+        '''
+        Wait up to timeout seconds (forever if None) for the action to
+        complete. Returns done().
+        '''
+
+        with self.condition:
+            if not self.resolved:
+                self.condition.wait(timeout)
+            return self.resolved
+
+    def result(self, timeout=None):
+        '''
+        Return the value returned by perform_action(), waiting up to timeout
+        seconds for it. Raises the exception the action failed with, or
+        TimeoutError.
+        '''
+
+        if not self.wait(timeout):
+            raise TimeoutError('%s did not complete within %s seconds.' % (self.action.__name__, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        '''
+        Return the exception the action failed with, or None if it
+        succeeded, waiting up to timeout seconds for it. Raises TimeoutError.
+        '''
+
+        if not self.wait(timeout):
+            raise TimeoutError('%s did not complete within %s seconds.' % (self.action.__name__, timeout))
+        return self.error
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback with this future once it is resolved, from the thread
+        which resolves it; immediately if it already is.
+        '''
+
+        with self.condition:
+            if not self.resolved:
+                self.callbacks.append(callback)
+                return
+        self.run_callback(callback)
+
+    def set_result(self, value):
+        '''
+        Resolve the future with the value returned by the action.
+        '''
+        self.resolve(value, None)
+
+    def set_exception(self, error):
+        '''
+        Resolve the future with the exception the action failed with.
+        '''
+        self.resolve(None, error)
+
+    def resolve(self, value, error):
+        with self.condition:
+            if self.resolved:
+                msg = '%s has already been resolved.' % self
+                log.error(msg)
+                raise RuntimeError(msg)
+            self.value = value
+            self.error = error
+            self.resolved = True
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.condition.notify_all()
+
+        for callback in callbacks:
+            self.run_callback(callback)
+
+    def run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception, e:
+            log.error('Callback %s of %s failed.', callback, self, exc_info=True)
+
+
+def wait_all(futures, timeout=None):
+    '''
+    Wait up to timeout seconds (forever if None) for all of futures to be
+    resolved. Returns a tuple of the sets of resolved and unresolved futures.
+    '''
+
+    futures = set(futures)
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for future in futures:
+        if timeout is None:
+            future.wait()
+        elif not future.wait(max(deadline - time.time(), 0)):
+            break
+
+    done = set(future for future in futures if future.done())
+    return done, futures - done
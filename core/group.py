@@ -0,0 +1,214 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains ObserverGroup, which polls many observables on
+the same tick. A CoreObserver is a thread per observable with timing of its
+own, so hundreds of related sensors take hundreds of threads and are never
+observed at quite the same moment. An ObserverGroup is a single thread which,
+every loop_interval, has a bounded ObserverPool evaluate all of its members
+at once, waits for them up to a deadline, and then submits every change of
+state found to the action manager as one batch.
+
+group = ObserverGroup([pump1, pump2, ...], loop_interval=1, workers=16)
+group.start()
+
+A member still being evaluated at the deadline is reported on a later tick,
+once it finishes, and is not evaluated again until then. Several groups may
+share one ObserverPool.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import time
+import Queue
+import logging
+import threading
+
+from gdci.core.thread import CoreThread
+from gdci.core.observable import CoreObservable
+from gdci.core.actionmanager import action_manager
+
+log = logging.getLogger('Observer Groups')
+
+# Queued to a pool thread to end it.
+STOP = object()
+
+
+def reports_to_manager(observable):
+    '''
+    Return True if observable reports changes of state to the action manager
+    as CoreObservable does, so that they may be submitted in a batch.
+    '''
+
+    report = getattr(type(observable).report_state_change, 'im_func', None)
+    return report is CoreObservable.report_state_change.im_func
+
+
+class ObserverPool(object):
+    '''
+    ObserverPool runs tasks on at most size threads, started as they are
+    first needed.
+    '''
+
+    def __init__(self, size=8, name='ObserverPool'):
+        if size < 1:
+            raise ValueError('An ObserverPool requires at least one thread; got %s.' % size)
+
+        self.size = size
+        self.name = name
+        self.tasks = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        # Threads free for a task, less the tasks waiting for a thread.
+        self.idle = 0
+
+    def submit(self, function, *args):
+        '''
+        Queue function to be called with args by a pool thread.
+        '''
+
+        with self.lock:
+            if self.idle <= 0 and len(self.threads) < self.size:
+                thread = threading.Thread(target=self.run_tasks,
+                                          name='%s-%d' % (self.name, len(self.threads)))
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+            else:
+                self.idle -= 1
+        self.tasks.put((function, args))
+
+    def run_tasks(self):
+        '''
+        Call queued tasks until shut down.
+        '''
+
+        while True:
+            task = self.tasks.get()
+            if task is STOP:
+                return
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                log.error('Task %s failed.', function, exc_info=True)
+            with self.lock:
+                self.idle += 1
+
+    def shutdown(self, blocking=True):
+        '''
+        Stop every pool thread once the tasks queued are done.
+        '''
+
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+            self.idle = 0
+        for thread in threads:
+            self.tasks.put(STOP)
+        if blocking:
+            for thread in threads:
+                thread.join()
+
+
+class ObserverGroup(CoreThread):
+    '''
+    ObserverGroup evaluates its members together each loop and reports
+    their changes of state in one batch. deadline is the number of seconds
+    to wait for the members each loop, by default loop_interval. Without a
+    pool, the group makes one of workers threads, shut down with the group.
+    '''
+
+    def __init__(self, members, pool=None, workers=8, deadline=None, *args, **kwargs):
+        CoreThread.__init__(self, *args, **kwargs)
+
+        self.members = list(members)
+        self.own_pool = pool is None
+        if pool is None:
+            pool = ObserverPool(workers, name='%s-pool' % self.name)
+        self.pool = pool
+        if deadline is None:
+            deadline = self.loop_interval
+        self.deadline = deadline
+
+        # Results of members, (member, change), put by pool threads.
+        self.results = Queue.Queue()
+        # Members being evaluated. Only the group's thread changes this.
+        self.running = set()
+        # Members not yet evaluated when their loop's deadline passed.
+        self.late = 0
+        # Times a member was not evaluated as it was still running.
+        self.overruns = 0
+        # The changes reported by the last loop, (member, initial, final).
+        self.last_changes = []
+
+    def evaluate(self, member):
+        '''
+        Evaluate one member in a pool thread and pass on its change, if any.
+        '''
+
+        change = None
+        try:
+            change = member.evaluate_observation()[1]
+        except Exception:
+            log.error('Failed to evaluate %s.', member, exc_info=True)
+        self.results.put((member, change))
+
+    def main_loop(self):
+        '''
+        Evaluate every member not still running, wait up to the deadline,
+        and report the changes found.
+        '''
+
+        deadline = time.time() + self.deadline
+        for member in self.members:
+            if member in self.running:
+                self.overruns += 1
+                continue
+            self.running.add(member)
+            self.pool.submit(self.evaluate, member)
+
+        # Each result is of a running member, so none are left once no
+        # member is running.
+        changes = {}
+        while self.running:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    member, change = self.results.get(timeout=remaining)
+                else:
+                    member, change = self.results.get_nowait()
+            except Queue.Empty:
+                break
+            self.running.discard(member)
+            if change is not None:
+                changes[member] = change
+        self.late += len(self.running)
+
+        # Report in the order of the members.
+        self.report([(member,) + changes[member] for member in self.members if member in changes])
+
+    def report(self, changes):
+        '''
+        Report changes, a list of (member, initial, final), submitting
+        those reported to the action manager as one batch.
+        '''
+
+        self.last_changes = changes
+        batch = [change for change in changes if reports_to_manager(change[0])]
+        if batch:
+            for change, futures in zip(batch, action_manager.check_state_changes(batch)):
+                change[0].report_observation(change[1], change[2], futures)
+        for change in changes:
+            if not reports_to_manager(change[0]):
+                change[0].report_observation(change[1], change[2])
+
+    def after_loop(self):
+        '''
+        Shut down the pool if the group made it.
+        '''
+
+        if self.own_pool:
+            self.pool.shutdown(blocking=False)
@@ -0,0 +1,367 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains the runtime statistics of the core and an
+optional HTTP endpoint which serves them in the Prometheus text format.
+Observables and actions record their timings into the metrics singleton
+while it is enabled; the action manager's queue, mapping, and thread counts
+are read directly when the endpoint is scraped. Neither recording nor
+serving takes the action manager's locks.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from gdci.core.rwlock import PROFILE_BUCKETS
+from gdci.core.breaker import circuit_fleet
+
+log = logging.getLogger('Metrics')
+
+
+class CoreMetrics(object):
+    '''
+    CoreMetrics accumulates counters and timings per observable and action
+    class. Recording is skipped entirely until enable() is called, so the
+    hot paths only pay for a single attribute check while metrics are off.
+    '''
+
+    def __init__(self):
+        '''
+        Initialize empty statistics. Recording starts disabled.
+        '''
+
+        self.enabled = False
+        # Guards the dictionaries below. It is never held while calling out.
+        self.lock = threading.Lock()
+        # Observable class name to [observations, seconds, failures, changes]
+        self.observations = {}
+        # Action class name to [started, dispatch latency seconds,
+        # completed, perform_action seconds, failures]
+        self.actions = {}
+
+    def enable(self):
+        '''
+        Begin recording statistics.
+        '''
+        self.enabled = True
+
+    def disable(self):
+        '''
+        Stop recording statistics. Recorded statistics are kept.
+        '''
+        self.enabled = False
+
+    def reset(self):
+        '''
+        Discard all recorded statistics.
+        '''
+        with self.lock:
+            self.observations = {}
+            self.actions = {}
+
+    def record_observation(self, observable, seconds, failed):
+        '''
+        Record one call to get_observation() taking seconds.
+        '''
+
+        name = observable.__class__.__name__
+        with self.lock:
+            stats = self.observations.get(name)
+            if stats is None:
+                stats = self.observations[name] = [0, 0.0, 0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            if failed:
+                stats[2] += 1
+
+    def record_state_change(self, observable):
+        '''
+        Record a state change reported to the action manager.
+        '''
+
+        name = observable.__class__.__name__
+        with self.lock:
+            stats = self.observations.get(name)
+            if stats is None:
+                stats = self.observations[name] = [0, 0.0, 0, 0]
+            stats[3] += 1
+
+    def record_action_started(self, action, latency):
+        '''
+        Record that an action was started latency seconds after being queued.
+        '''
+
+        name = action.__name__
+        with self.lock:
+            stats = self.actions.get(name)
+            if stats is None:
+                stats = self.actions[name] = [0, 0.0, 0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += latency
+
+    def record_action_completed(self, action, seconds, failed):
+        '''
+        Record that a running action's perform_action() took seconds.
+        '''
+
+        name = action.__class__.__name__
+        with self.lock:
+            stats = self.actions.get(name)
+            if stats is None:
+                stats = self.actions[name] = [0, 0.0, 0, 0.0, 0]
+            stats[2] += 1
+            stats[3] += seconds
+            if failed:
+                stats[4] += 1
+
+    def render(self, manager=None):
+        '''
+        Return all statistics as Prometheus text exposition format.
+        manager defaults to the action manager singleton.
+        '''
+
+        if manager is None:
+            from gdci.core.actionmanager import action_manager
+            manager = action_manager
+
+        with self.lock:
+            observations = dict((name, list(stats)) for name, stats in self.observations.iteritems())
+            actions = dict((name, list(stats)) for name, stats in self.actions.iteritems())
+
+        lines = []
+        def metric(name, kind, text, samples):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+        # Reading these without the locks is safe: each read is a single
+        # operation on a builtin container and the Queue has its own mutex.
+        registrations = [len(actions_set) for actions_set in manager.action_mapping.values()]
+        metric('gdci_action_manager_running', 'gauge', 'Whether the action manager is dispatching actions.',
+               [(None, int(manager.is_running()))])
+        metric('gdci_action_queue_length', 'gauge', 'Actions queued and awaiting dispatch.',
+               [(None, manager.action_queue.qsize())])
+        metric('gdci_action_mapping_keys', 'gauge', 'Registered (observable, state, state) transitions.',
+               [(None, len(registrations))])
+        metric('gdci_action_mapping_registrations', 'gauge', 'Registered actions across all transitions.',
+               [(None, sum(registrations))])
+        metric('gdci_running_actions', 'gauge', 'Action threads tracked by the action manager.',
+               [(None, len(manager.thread_mapping))])
+        metric('gdci_threads', 'gauge', 'Live threads in this process.',
+               [(None, threading.active_count())])
+        metric('gdci_dispatch_lock_waits_total', 'counter', 'Acquisitions of the queue lock by the dispatcher.',
+               [(None, manager.dispatch_lock_waits)])
+        metric('gdci_dispatch_lock_timeouts_total', 'counter', 'Times the dispatcher gave up waiting for the queue lock.',
+               [(None, manager.dispatch_lock_timeouts)])
+        metric('gdci_dispatch_lock_wait_seconds_total', 'counter', 'Time the dispatcher spent waiting for the queue lock.',
+               [(None, manager.dispatch_lock_wait_seconds)])
+        metric('gdci_dispatch_lock_longest_wait_seconds', 'gauge', 'Longest the dispatcher has waited for the queue lock.',
+               [(None, manager.dispatch_lock_longest_wait)])
+
+        # Only the action manager's locks being profiled.
+        profiles = [(name, lock.profile) for name, lock in manager.locks() if lock.profile is not None]
+        if profiles:
+            for kind, text in [('wait', 'Time spent waiting for the action manager locks.'),
+                               ('hold', 'Time the action manager locks were held.')]:
+                samples = []
+                for name, profile in profiles:
+                    statistics = profile.statistics()
+                    for key in sorted(statistics):
+                        stats = statistics[key]
+                        labels = dict(zip(['site', 'mode', 'thread'], key))
+                        labels['lock'] = name
+                        samples.extend(histogram_samples(labels, stats[kind + '_buckets'], stats[kind + '_seconds']))
+                lines.append('# HELP gdci_lock_%s_seconds %s' % (kind, text))
+                lines.append('# TYPE gdci_lock_%s_seconds histogram' % kind)
+                for suffix, labels, value in samples:
+                    lines.append('gdci_lock_%s_seconds%s%s %s' % (kind, suffix, format_labels(labels), format_value(value)))
+
+        circuits = circuit_fleet.counts()
+        metric('gdci_circuits', 'gauge', 'Circuit breakers of observables in each state.',
+               [({'state': state}, circuits[state]) for state in sorted(circuits)])
+        metric('gdci_circuit_trips_total', 'counter', 'Times a circuit breaker has opened.',
+               [(None, circuit_fleet.trips)])
+        metric('gdci_observations_skipped_total', 'counter', 'Observations skipped by open circuit breakers.',
+               [(None, circuit_fleet.skipped)])
+
+        names = sorted(observations)
+        metric('gdci_observations_total', 'counter', 'Calls to get_observation().',
+               [({'observable': name}, observations[name][0]) for name in names])
+        metric('gdci_observation_seconds_total', 'counter', 'Time spent in get_observation().',
+               [({'observable': name}, observations[name][1]) for name in names])
+        metric('gdci_observation_failures_total', 'counter', 'Calls to get_observation() which raised.',
+               [({'observable': name}, observations[name][2]) for name in names])
+        metric('gdci_state_changes_total', 'counter', 'State changes reported to the action manager.',
+               [({'observable': name}, observations[name][3]) for name in names])
+
+        names = sorted(actions)
+        metric('gdci_actions_started_total', 'counter', 'Actions started by the action manager.',
+               [({'action': name}, actions[name][0]) for name in names])
+        metric('gdci_action_dispatch_seconds_total', 'counter', 'Time actions spent queued before being started.',
+               [({'action': name}, actions[name][1]) for name in names])
+        metric('gdci_actions_completed_total', 'counter', 'Actions whose perform_action() has returned or raised.',
+               [({'action': name}, actions[name][2]) for name in names])
+        metric('gdci_action_seconds_total', 'counter', 'Time spent in perform_action().',
+               [({'action': name}, actions[name][3]) for name in names])
+        metric('gdci_action_failures_total', 'counter', 'Calls to perform_action() which raised.',
+               [({'action': name}, actions[name][4]) for name in names])
+
+        return '\n'.join(lines) + '\n'
+
+def histogram_samples(labels, buckets, seconds):
+    '''
+    Return (suffix, labels, value) samples of a histogram from its counts
+    per bucket of PROFILE_BUCKETS and the sum of its observations.
+    '''
+
+    samples = []
+    total = 0
+    for bound, count in zip(PROFILE_BUCKETS + ('+Inf',), buckets):
+        total += count
+        bucket_labels = dict(labels)
+        bucket_labels['le'] = bound
+        samples.append(('_bucket', bucket_labels, total))
+    samples.append(('_sum', labels, seconds))
+    samples.append(('_count', labels, total))
+    return samples
+
+def format_labels(labels):
+    '''
+    Format a dictionary of labels as {key="value",...}.
+    '''
+
+    if not labels:
+        return ''
+    pairs = []
+    for key in sorted(labels):
+        value = str(labels[key]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('%s="%s"' % (key, value))
+    return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+    '''
+    Format a sample value; floats use repr() to retain their precision.
+    '''
+
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# Create the singleton. It records nothing until enabled.
+metrics = CoreMetrics()
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serve the rendered metrics at /metrics.
+    '''
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        try:
+            body = self.server.core_metrics.render(self.server.manager)
+        except Exception, e:
+            log.error('Failed to render metrics.', exc_info=True)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent; keep them out of the application's logs.
+        log.debug(format, *args)
+
+class MetricsHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''
+    Each scrape is answered in its own daemon thread so that a slow client
+    cannot hold up the others.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+class MetricsServer(object):
+    '''
+    MetricsServer runs the metrics endpoint in a background daemon thread.
+    Starting the server enables recording of metrics.
+
+    server = MetricsServer(port=9100)
+    server.start()
+    ...
+    server.stop()
+    '''
+
+    def __init__(self, host='127.0.0.1', port=9100, core_metrics=None, manager=None):
+        '''
+        Serve on host:port; a port of 0 picks a free port, which can be read
+        back from the address attribute once started. core_metrics defaults
+        to the metrics singleton and manager to the action manager singleton.
+        '''
+
+        self.host = host
+        self.port = port
+        self.core_metrics = core_metrics or metrics
+        self.manager = manager
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        '''
+        Bind the socket and begin serving without blocking the caller.
+        '''
+
+        if self.server is not None:
+            raise RuntimeError('Metrics server is already running on %s:%d.' % self.address)
+        self.server = MetricsHTTPServer((self.host, self.port), MetricsRequestHandler)
+        self.server.core_metrics = self.core_metrics
+        self.server.manager = self.manager
+        self.core_metrics.enable()
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Serving metrics on http://%s:%d/metrics', *self.address)
+
+    def stop(self):
+        '''
+        Stop serving and close the socket. Recording remains enabled.
+        '''
+
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.server = None
+        self.thread = None
+
+    @property
+    def address(self):
+        '''
+        The (host, port) the server is bound to, or None if not started.
+        '''
+        if self.server is None:
+            return None
+        return self.server.server_address[:2]
+
+def start_metrics_server(port=9100, host='127.0.0.1'):
+    '''
+    Convenience function to create and start a MetricsServer.
+    '''
+
+    server = MetricsServer(host, port)
+    server.start()
+    return server
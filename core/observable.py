@@ -21,11 +21,14 @@ import time
 
 from gdci.core.state import State
 from gdci.core.thread import CoreThread
+from gdci.core.metrics import metrics
 from gdci.core.actionmanager import action_manager
 
 
 log = logging.getLogger('Observables')
 
+BAD_RESULT = 'get_observation() in %s must return True, False, None, or a tuple of (truth value, dictionary); returned %s.'
+
 
 class CoreObservable(object):
     '''
@@ -35,6 +38,18 @@ class CoreObservable(object):
     and pass it through the architecture.
     '''
 
+    # Observables derived from this one, re-evaluated whenever it changes
+    # state. See DerivedObservable.
+    dependents = ()
+    # The class of State observed. Its first two primary attributes are
+    # whether the observation succeeded and the result, whatever their
+    # names; any others are taken by name from the dictionary returned by
+    # get_observation().
+    state_class = State
+    # The CircuitBreaker deciding whether to observe, if any. See
+    # enable_circuit_breaker().
+    breaker = None
+
     def __init__(self, *args, **kwargs):
         '''
         Initialize local variables. Ensure that extended classes call this
@@ -45,7 +60,9 @@ class CoreObservable(object):
         object.__init__(self, *args, **kwargs)
 
         # Set an initial state to be "uninitialized" (no values).
-        self.__current_state = State()
+        self.__current_state = self.state_class()
+        # The futures of the actions fired by the last state change.
+        self.action_futures = []
 
     def get_observation(self):
         '''
@@ -71,6 +88,29 @@ class CoreObservable(object):
         # check_observation can be called more often than get_observation
         # returns results.
 
+        state, change = self.evaluate_observation()
+        if change is not None:
+            self.report_observation(*change)
+        return state
+
+    def evaluate_observation(self):
+        '''
+        The first half of check_observation(): observe and bring the current
+        State up to date, without reporting a change. Returns the current
+        State and, if it changed, copies of the (initial, final) States to
+        be passed to report_observation(); otherwise None.
+        '''
+
+        # While the circuit is open, skip the observation altogether.
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            return self.__current_state, None
+
+        # Time the observation only if metrics are being recorded.
+        timed = metrics.enabled
+        if timed:
+            begin = time.time()
+
         # Retrieve the new state.
         try:
             # Note the new result and mark the result as currently observed.
@@ -78,57 +118,142 @@ class CoreObservable(object):
             observed = True
         except Exception, e:
             # Retain old result but note that the observation is stale.
-            result = self.__current_state.result
+            result = self.__current_state.get_primary()[1]
             observed = False
 
+        if timed:
+            metrics.record_observation(self, time.time() - begin, not observed)
+        if breaker is not None:
+            if observed:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
         # Result may be [True, False, None] or...
         # Result may be a tuple of (result, dictionary).
         # in this case, parse out result and cache dictionary into the state.
-        new_state = None
-        new_attribs = None
-        try:
-            if len(result) == 2 and result[0] in [True, False, None] and \
-                 result[1].__class__ is dict:
-                new_state = State(observed, result[0])
-                new_attribs = result[1]
-            else:
-                msg = 'get_observation() in %s must return True, False, None, or a tuple of (truth value, dictionary); returned %s.' %(str(self), str(result))
-                log.exception(msg)
-                raise TypeError(msg)
-        except TypeError:
-            if result in [True, False, None]:
-                new_state = State(observed, result)
-                new_attribs = {}
-            else:
-                msg = 'get_observation() in %s must return True, False, None, or a tuple of (truth value, dictionary); returned %s.' %(str(self), str(result))
-                log.exception(msg)
-                raise TypeError(msg)
+        if isinstance(result, (tuple, list)) and len(result) == 2 and \
+             result[0] in [True, False, None] and result[1].__class__ is dict:
+            new_attribs = result[1]
+            new_state = self.new_state(observed, result[0], new_attribs)
+        elif result in [True, False, None]:
+            new_attribs = {}
+            new_state = self.new_state(observed, result, new_attribs)
+        else:
+            # Formatting is left to the handlers, which may be
+            # asynchronous; see gdci.core.asynclog. There is no traceback
+            # worth logging, as nothing was raised.
+            log.error(BAD_RESULT, self, result)
+            raise TypeError(BAD_RESULT % (self, result))
 
         # If the state remains the same, do not report anything.
         # Update the current state with attribs and return the old State.
         if self.__current_state == new_state:
-            with self.__current_state.lock:
-                self.__current_state.secondary_attributes.update(new_attribs)
-            return self.__current_state
+            self.__current_state.update_secondary(new_attribs)
+            return self.__current_state, None
 
         # Update the attributes into the new state.
-        with new_state.lock:
-            new_state.secondary_attributes.update(new_attribs)
+        new_state.update_secondary(new_attribs)
 
         # These states could change before the Action Manager can call actions
-        # in response; thus we must freeze the states as a copy.
+        # in response; thus we must freeze the states as a copy. Buffer
+        # payloads are frozen already, so the copies share them.
         initial_state = self.__current_state.copy()
         final_state = new_state.copy()
 
         # Update the current state, which is different.
         self.__current_state = new_state
 
+        return new_state, (initial_state, final_state)
+
+    def report_observation(self, initial_state, final_state, futures=None):
+        '''
+        The second half of check_observation(): report a change of state
+        found by evaluate_observation() with report_state_change(), then
+        bring derived observables up to date. futures are the ActionFutures
+        of the change if it has been submitted to the action manager
+        already, for example in a batch by CoreActionManager.check_state_changes().
+        '''
+
         # Inform the action manager to perform any actions necessary.
-        action_manager.check_state_change(self, initial_state, final_state)
+        if metrics.enabled:
+            metrics.record_state_change(self)
+        if futures is None:
+            futures = self.report_state_change(initial_state, final_state)
+        self.action_futures = futures or []
+
+        # Bring observables derived from this one up to date.
+        if self.dependents:
+            self.notify_dependents()
+
+    def new_state(self, observed, result, attribs):
+        '''
+        Return a new State of state_class for an observation. Primary
+        attributes beyond the first two are looked up by name in attribs,
+        and keep their current values if absent.
+        '''
+
+        extra = self.state_class.schema.attributes[2:]
+        if not extra:
+            return self.state_class(observed, result)
+        values = {}
+        for name in extra:
+            if name in attribs:
+                values[name] = attribs[name]
+            else:
+                values[name] = getattr(self.__current_state, name)
+        return self.state_class(observed, result, **values)
+
+    def report_state_change(self, initial_state, final_state):
+        '''
+        Submit a change of this observable's state to the action manager.
+        The states are copies which will not change. Override this method to
+        report state changes elsewhere, for example to another process.
+        Returns the ActionFutures of the actions fired, if any.
+        '''
+
+        return action_manager.check_state_change(self, initial_state, final_state)
+
+    def notify_dependents(self):
+        '''
+        Re-evaluate the observables derived from this one after a change of
+        state which was not found by check_observation().
+        '''
 
-        # Return the State
+        from gdci.core.derived import propagate
+        propagate(self)
+
+    def get_state(self):
+        '''
+        Return the current State. It must not be modified.
+        '''
         return self.__current_state
 
+    def set_state(self, state):
+        '''
+        Replace the current State without reporting a state change, for
+        example when the state is known from elsewhere.
+        '''
+        self.__current_state = state
+
+    def enable_circuit_breaker(self, *args, **kwargs):
+        '''
+        Stop calling get_observation() while it keeps raising, probing now
+        and again until it succeeds. Arguments are passed to CircuitBreaker.
+        Returns the CircuitBreaker.
+        '''
+
+        from gdci.core.breaker import CircuitBreaker
+        kwargs.setdefault('name', str(self))
+        self.breaker = CircuitBreaker(*args, **kwargs)
+        return self.breaker
+
+    def disable_circuit_breaker(self):
+        '''
+        Observe every time check_observation() is called again.
+        '''
+        self.breaker = None
+
     def register_action(self, action, initial_state, final_state):
         '''
         Register an action in response to this observable changing state
@@ -147,6 +272,15 @@ class CoreObservable(object):
 
         action_manager.disassociate_action_from_state_change(action, self, initial_state, final_state)
 
+    def unregister_all(self):
+        '''
+        Remove every registration of an action in response to this
+        observable, for example before discarding it.
+        See CoreActionManager.disassociate_all()
+        '''
+
+        return action_manager.disassociate_all(self)
+
 
 class CoreObserver(CoreObservable, CoreThread):
     '''
@@ -154,6 +288,11 @@ class CoreObserver(CoreObservable, CoreThread):
     must be overridden to define functionality for any given subclass.
     This class is a variant of CoreObservable that must be started as a
     thread by calling the start() method.
+
+    In adaptive mode, the polling interval drops to min_interval whenever the
+    state changes and is multiplied by backoff after each observation in
+    which it does not, up to max_interval. The interval in effect is
+    loop_interval; get_polling_rate() returns it as observations per second.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -161,14 +300,43 @@ class CoreObserver(CoreObservable, CoreThread):
         Initialize local variables. Ensure that extended classes call this
         constructor.
         This constructor calls both parent constructors.
-        All arguments will be passed to CoreThread, none will be passed to
-        CoreObservable.
+        The key word arguments adaptive, min_interval, max_interval, and
+        backoff configure adaptive polling. min_interval defaults to
+        loop_interval and max_interval to ten times min_interval.
+        All other arguments will be passed to CoreThread, none will be passed
+        to CoreObservable.
         '''
 
+        # Separate the adaptive polling arguments from CoreThread's.
+        self.adaptive = kwargs.pop('adaptive', False)
+        min_interval = kwargs.pop('min_interval', None)
+        max_interval = kwargs.pop('max_interval', None)
+        self.backoff = kwargs.pop('backoff', 2.0)
+
         # Call parent constructors
         CoreObservable.__init__(self)
         CoreThread.__init__(self, *args, **kwargs)
 
+        if min_interval is None:
+            min_interval = self.loop_interval
+        if max_interval is None:
+            max_interval = 10 * min_interval
+        if self.adaptive and not 0 < min_interval <= max_interval:
+            raise ValueError('Adaptive polling requires 0 < min_interval <= max_interval; got %s and %s.' % (min_interval, max_interval))
+        if self.adaptive and self.backoff < 1:
+            raise ValueError('Adaptive polling requires a backoff of at least 1; got %s.' % self.backoff)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        if self.adaptive:
+            # Start out polling quickly; sleep finely enough to honor the
+            # shortest interval.
+            self.loop_interval = min_interval
+            if self.sleep_delay is None:
+                self.sleep_delay = min_interval / 10.0
+
+        # The State returned by the last observation, to detect changes.
+        self.last_state = None
 
     def main_loop(self):
         '''
@@ -176,4 +344,24 @@ class CoreObserver(CoreObservable, CoreThread):
         get_observation() be overridden.
         '''
 
-        self.check_observation()
+        state = self.check_observation()
+        if self.adaptive:
+            # check_observation() returns the same State until it changes.
+            self.adapt_interval(state is not self.last_state)
+        self.last_state = state
+
+    def adapt_interval(self, changed):
+        '''
+        Tighten the polling interval after a state change, otherwise back off.
+        '''
+
+        if changed:
+            self.loop_interval = self.min_interval
+        else:
+            self.loop_interval = min(self.loop_interval * self.backoff, self.max_interval)
+
+    def get_polling_rate(self):
+        '''
+        Return the current number of observations per second.
+        '''
+        return 1.0 / self.loop_interval
@@ -0,0 +1,89 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains CoreActionPipeline, an action which runs a
+sequence of other actions, its stages, one after another in its own thread.
+Each stage's perform_action() is given the value returned by the previous
+stage as pipeline_input, and the value returned by the last stage is the
+pipeline's result. Stages share the pipeline's observable and states; no
+thread is started and no State is copied between them.
+
+Capture, then process, then upload:
+
+CaptureProcessUpload = action_pipeline(Capture, Process, Upload)
+observable.register_action(CaptureProcessUpload, initial, final)
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import time
+import logging
+
+from gdci.core.action import CoreAction
+from gdci.core.metrics import metrics
+
+log = logging.getLogger('Pipelines')
+
+
+class CoreActionPipeline(CoreAction):
+    '''
+    CoreActionPipeline is meant to be extended by setting stages to a
+    sequence of action classes, or created with action_pipeline(). Each
+    stage is instantiated, but never started, and its setup(),
+    perform_action(), and cleanup() are called in turn. A stage whose setup()
+    or perform_action() raises an exception ends the pipeline, which fails
+    with that exception; the stage's cleanup() is still called.
+    '''
+
+    # The action classes to run, in order.
+    stages = ()
+
+    def perform_action(self):
+        '''
+        Run each stage, passing along what it returns.
+        '''
+
+        value = None
+        for stage_class in self.stages:
+            stage = stage_class(self.observable, self.initial_state, self.final_state)
+            stage.pipeline = self
+            stage.pipeline_input = value
+
+            # Time each stage under its own name if metrics are being
+            # recorded.
+            timed = metrics.enabled
+            if timed:
+                begin = time.time()
+            failed = True
+            try:
+                stage.setup()
+                value = stage.perform_action()
+                failed = False
+            finally:
+                stage.cleanup()
+                if timed:
+                    metrics.record_action_completed(stage, time.time() - begin, failed)
+        return value
+
+
+def action_pipeline(*stages, **kwargs):
+    '''
+    Create a CoreActionPipeline class running stages, which are action
+    classes, in the order given. The key word argument name names the class;
+    by default it is made from the names of the stages.
+    '''
+
+    for stage in stages:
+        if not (isinstance(stage, type) and issubclass(stage, CoreAction)):
+            msg = 'Pipeline stages must be action classes; got %s.' % (stage,)
+            log.error(msg)
+            raise TypeError(msg)
+
+    name = kwargs.pop('name', None)
+    if kwargs:
+        raise TypeError('Unexpected arguments %s.' % ', '.join(sorted(kwargs)))
+    if name is None:
+        name = 'Pipeline_' + '_'.join(stage.__name__ for stage in stages)
+    return type(name, (CoreActionPipeline,), {'stages': tuple(stages)})
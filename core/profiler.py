@@ -0,0 +1,242 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains a sampling profiler which can be switched on and
+off while collectors are running. A background thread periodically samples
+the stack of every other thread and attributes it to the observer, action,
+or observable running there, so that a slow get_observation() or
+perform_action() can be found by class rather than by anonymous thread.
+Results are written in the collapsed-stack format read by flame graph tools.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+
+from gdci.core.action import CoreAction
+from gdci.core.observable import CoreObserver
+from gdci.core.observable import CoreObservable
+from gdci.core.actionmanager import ActionDispatcher
+
+log = logging.getLogger('Profiler')
+
+# Functions whose frames identify the observable being polled when the
+# polling thread is not a CoreThread.
+OBSERVATION_FUNCTIONS = set(['check_observation', 'get_observation'])
+
+
+def thread_label(thread, frame):
+    '''
+    Return the root of the collapsed stack for a thread: the class of the
+    observer or action it runs, the observable it is polling, or its name.
+    '''
+
+    if isinstance(thread, CoreAction):
+        observable = thread.observable
+        if observable is not None:
+            return 'observable:%s;action:%s' % (observable.__class__.__name__, thread.__class__.__name__)
+        return 'action:%s' % thread.__class__.__name__
+    if isinstance(thread, CoreObserver):
+        return 'observer:%s' % thread.__class__.__name__
+    if isinstance(thread, ActionDispatcher):
+        return 'dispatcher'
+
+    # Any other thread may still be polling an observable directly.
+    while frame is not None:
+        if frame.f_code.co_name in OBSERVATION_FUNCTIONS:
+            owner = frame.f_locals.get('self')
+            if isinstance(owner, CoreObservable):
+                return 'observable:%s' % owner.__class__.__name__
+        frame = frame.f_back
+
+    if thread is None:
+        return 'thread:unknown'
+    return 'thread:%s' % thread.name
+
+def frame_label(frame):
+    '''
+    Return a frame as "function (file:line)", using the line on which the
+    function begins so that samples within a function are merged.
+    '''
+
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    '''
+    SamplingProfiler samples every thread's stack each interval seconds while
+    running. It costs nothing while stopped.
+
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.write_collapsed('collectors.folded')
+    '''
+
+    def __init__(self, interval=0.005, max_depth=128):
+        '''
+        interval is the number of seconds between samples. Stacks deeper than
+        max_depth frames are truncated at the root.
+        '''
+
+        self.interval = interval
+        self.max_depth = max_depth
+        self.thread = None
+        self.running = False
+        # Guards counts, which maps a collapsed stack to its sample count.
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.samples = 0
+
+    def start(self):
+        '''
+        Begin sampling in a daemon thread. Samples from earlier runs are kept
+        until reset().
+        '''
+
+        if self.running:
+            return False
+        self.running = True
+        self.thread = threading.Thread(target=self.sample_loop, name='SamplingProfiler')
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Sampling profiler started with an interval of %s seconds.', self.interval)
+        return True
+
+    def stop(self):
+        '''
+        Stop sampling and wait for the sampling thread to end.
+        '''
+
+        if not self.running:
+            return False
+        self.running = False
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        log.info('Sampling profiler stopped after %d samples.', self.samples)
+        return True
+
+    def toggle(self):
+        '''
+        Start sampling if stopped, stop if started. Returns True if now
+        running.
+        '''
+
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+        return self.running
+
+    def reset(self):
+        '''
+        Discard all samples.
+        '''
+
+        with self.lock:
+            self.counts = {}
+            self.samples = 0
+
+    def sample_loop(self):
+        '''
+        Run in the sampling thread until stop() is called.
+        '''
+
+        while self.running:
+            self.sample()
+            time.sleep(self.interval)
+
+    def sample(self):
+        '''
+        Take a single sample of every thread except the sampling thread.
+        '''
+
+        own_ident = threading.current_thread().ident
+        threads = dict((thread.ident, thread) for thread in threading.enumerate())
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+
+            names = []
+            top = frame
+            while top is not None and len(names) < self.max_depth:
+                names.append(frame_label(top))
+                top = top.f_back
+            names.append(thread_label(threads.get(ident), frame))
+            names.reverse()
+            stacks.append(';'.join(names))
+
+        with self.lock:
+            for stack in stacks:
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.samples = self.samples + 1
+
+    def collapsed(self):
+        '''
+        Return the samples as lines of "root;caller;...;callee count".
+        '''
+
+        with self.lock:
+            counts = self.counts.items()
+        return ['%s %d' % (stack, count) for stack, count in sorted(counts)]
+
+    def totals(self):
+        '''
+        Return a dictionary of root label (observer, action, ...) to the
+        number of samples attributed to it.
+        '''
+
+        totals = {}
+        with self.lock:
+            counts = self.counts.items()
+        for stack, count in counts:
+            # The root label of an action spans two levels.
+            parts = stack.split(';')
+            root = parts[0]
+            if root.startswith('observable:') and len(parts) > 1 and parts[1].startswith('action:'):
+                root = parts[1]
+            totals[root] = totals.get(root, 0) + count
+        return totals
+
+    def write_collapsed(self, path):
+        '''
+        Write the samples to path in collapsed-stack format, suitable for
+        flamegraph.pl or speedscope.
+        '''
+
+        with open(path, 'w') as output:
+            for line in self.collapsed():
+                output.write(line + '\n')
+
+
+# Create the singleton. It does not sample until started.
+profiler = SamplingProfiler()
+
+def install_toggle_signal(signum=signal.SIGUSR2, path=None):
+    '''
+    Toggle the profiler each time the process receives signum. When path is
+    given, the samples are written there each time profiling stops. Must be
+    called from the main thread. Returns the previous handler.
+    '''
+
+    def toggle_profiler(signum, frame):
+        # Stopping joins the sampling thread; keep that out of the signal
+        # handler, which interrupts the main thread.
+        def toggle():
+            if profiler.toggle() or path is None:
+                return
+            profiler.write_collapsed(path)
+            log.info('Sampling profiler wrote %s.', path)
+        threading.Thread(target=toggle, name='SamplingProfilerToggle').start()
+
+    return signal.signal(signum, toggle_profiler)
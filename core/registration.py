@@ -0,0 +1,201 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains the loader of declarative registration configs.
+A config lists which actions respond to which state changes of which
+observables; it is compiled in a single pass into the action manager's
+mapping and installed all at once, instead of through one call to
+register_action() per registration.
+
+A config is JSON of the form:
+
+{"registrations": [
+    {"observable": "pump1", "action": "package.module.ActionClass",
+     "initial": "*,F", "final": "*,T"},
+    {"observable": ["pump2", "pump3"], "action": ["Capture", "Upload"],
+     "initial": ["T,F", "N,F"], "final": "*,T"}
+]}
+
+Observables are named by the caller. Actions are named by the caller or by
+their dotted import path. States are written as comma separated values of
+the primary attributes, each T, F, N (None), * (any), or a bracketed choice
+such as [TF]; a list of them means any of them.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import json
+import logging
+
+from gdci.core.state import State
+from gdci.core.actionmanager import action_manager
+from gdci.core.actionmanager import state_codes
+from gdci.core.actionmanager import PausedCollection
+
+log = logging.getLogger('Registration')
+
+# Spellings of the values of primary attributes in state patterns.
+STATE_TOKENS = {
+    't': True, 'true': True,
+    'f': False, 'false': False,
+    'n': None, 'none': None,
+    '*': '*',
+}
+# Letters which may be combined in brackets, as in "[TF]".
+STATE_CHOICES = set('tfn')
+
+
+def parse_state_pattern(pattern, state_class=State):
+    '''
+    Parse a state pattern such as "*,[TF]" into a State or StateCollection
+    of state_class.
+    '''
+
+    if not isinstance(pattern, basestring):
+        raise ValueError('Invalid state pattern %r; patterns are strings.' % (pattern,))
+    values = []
+    for token in pattern.split(','):
+        token = token.strip().lower()
+        if token in STATE_TOKENS:
+            values.append(STATE_TOKENS[token])
+        elif token[:1] == '[' and token[-1:] == ']' and token[1:-1] and set(token[1:-1]) <= STATE_CHOICES:
+            values.append(token.upper())
+        else:
+            raise ValueError('Invalid value %r in state pattern %r.' % (token, pattern))
+    try:
+        return state_class(*values)
+    except TypeError, e:
+        raise ValueError('Invalid state pattern %r: %s' % (pattern, e))
+
+def as_list(value):
+    '''
+    Configs accept a single value or a list of them.
+    '''
+
+    if isinstance(value, list):
+        return value
+    return [value]
+
+def resolve_action(name, actions):
+    '''
+    Find an action class by its name in actions or its dotted import path.
+    '''
+
+    if name in actions:
+        return actions[name]
+
+    module_name, dot, class_name = name.rpartition('.')
+    if not module_name:
+        raise KeyError('Unknown action %r.' % name)
+    try:
+        module = __import__(module_name, fromlist=[class_name])
+        return getattr(module, class_name)
+    except (ImportError, AttributeError), e:
+        raise KeyError('Unknown action %r: %s' % (name, e))
+
+
+class RegistrationCompiler(object):
+    '''
+    RegistrationCompiler turns configs into the staged mapping accepted by
+    CoreActionManager.install_mapping(). Each distinct state pattern and
+    action name is parsed only once, however often it appears.
+    '''
+
+    def __init__(self, observables, actions=None, state_class=State):
+        '''
+        observables maps the names used in configs to observables. actions
+        optionally maps names to action classes. Patterns are of states of
+        state_class.
+        '''
+
+        self.observables = observables
+        self.actions = actions or {}
+        self.state_class = state_class
+        self.pattern_cache = {}
+        self.action_cache = {}
+
+    def codes(self, patterns):
+        '''
+        Return the codes of the states matched by a pattern or list of
+        patterns.
+        '''
+
+        codes = []
+        for pattern in as_list(patterns):
+            # Checked before the cache, as some patterns cannot be hashed.
+            if not isinstance(pattern, basestring):
+                raise ValueError('Invalid state pattern %r; patterns are strings.' % (pattern,))
+            expansion = self.pattern_cache.get(pattern)
+            if expansion is None:
+                expansion = self.pattern_cache[pattern] = state_codes(parse_state_pattern(pattern, self.state_class))
+            codes.extend(expansion)
+        return codes
+
+    def action(self, name):
+        '''
+        Return the action class for a name.
+        '''
+
+        action = self.action_cache.get(name)
+        if action is None:
+            action = self.action_cache[name] = resolve_action(name, self.actions)
+        return action
+
+    def compile(self, config, staged=None):
+        '''
+        Compile config, a dictionary as described for this module, into
+        staged (a new dictionary if None) and return it.
+        '''
+
+        if staged is None:
+            staged = {}
+
+        with PausedCollection():
+            for index, entry in enumerate(config.get('registrations', [])):
+                try:
+                    observables = [self.observables[name] for name in as_list(entry['observable'])]
+                    actions = set(self.action(name) for name in as_list(entry['action']))
+                    initial = self.codes(entry['initial'])
+                    final = self.codes(entry['final'])
+                except (KeyError, ValueError), e:
+                    msg = 'Invalid registration %d in config: %s' % (index, e)
+                    log.error(msg)
+                    raise ValueError(msg)
+
+                for observable in observables:
+                    for i_code in initial:
+                        for f_code in final:
+                            key = (observable, i_code, f_code)
+                            if key in staged:
+                                staged[key].update(actions)
+                            else:
+                                staged[key] = set(actions)
+        return staged
+
+
+def compile_registrations(config, observables, actions=None):
+    '''
+    Compile config into a staged mapping for install_mapping().
+    '''
+    return RegistrationCompiler(observables, actions).compile(config)
+
+def load_registrations(source, observables, actions=None, manager=None):
+    '''
+    Load a config from source, a path or file object, and install it into
+    manager, which defaults to the action manager singleton. Nothing is
+    installed if any registration is invalid. Returns the number of
+    (observable, state, state) transitions registered.
+    '''
+
+    if isinstance(source, basestring):
+        with open(source) as config_file:
+            config = json.load(config_file)
+    else:
+        config = json.load(source)
+
+    staged = compile_registrations(config, observables, actions)
+    count = len(staged)
+    (manager or action_manager).install_mapping(staged)
+    return count
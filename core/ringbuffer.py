@@ -0,0 +1,326 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains a shared memory ring buffer which carries state
+changes from observers running in other processes to the process running the
+action manager, without pickling or pipes. Each RingBuffer has a single
+producer and a single consumer and needs no lock: the producer only ever
+writes the tail index and the consumer only ever writes the head index.
+Several producers each get their own RingBuffer of a RingBufferGroup, which
+a single RingConsumer drains from the action manager's dispatcher thread.
+
+Records have a fixed layout: observable id, the codes of the initial and
+final states (see State), a timestamp, and an optional payload of up to
+payload_size bytes, which is passed to actions as the 'payload' secondary
+attribute.
+
+The shared memory is an anonymous mapping inherited by forked processes, or a
+file (for example under /dev/shm) which unrelated processes attach to.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import os
+import mmap
+import time
+import struct
+import logging
+import threading
+
+from gdci.core.state import encode
+from gdci.core.state import decode
+from gdci.core.observable import CoreObservable
+from gdci.core.transport import ReceivedObservable
+from gdci.core.actionmanager import action_manager
+
+log = logging.getLogger('RingBuffer')
+
+MAGIC = 'GDCIRB02'
+# magic, capacity, slot size, payload size
+HEADER = struct.Struct('<8sQQQ')
+# The indexes sit on their own cache lines so that the producer and consumer
+# do not contend for one.
+INDEX = struct.Struct('<Q')
+TAIL_OFFSET = 64
+HEAD_OFFSET = 128
+SLOTS_OFFSET = 192
+# observable id, codes of the initial and final states, timestamp, payload
+# length
+RECORD = struct.Struct('<IQQdI')
+# Secondary attribute carrying the payload.
+PAYLOAD_ATTRIBUTE = 'payload'
+
+
+class RingBuffer(object):
+    '''
+    RingBuffer is a fixed-capacity queue of state change records in shared
+    memory, for exactly one producer and one consumer.
+    put() never blocks: if the ring is full, the record is dropped and
+    counted. get() and drain() return what has been put.
+    '''
+
+    def __init__(self, capacity=4096, payload_size=0, path=None):
+        '''
+        Create a ring of capacity records with payload_size bytes of payload
+        each. Without a path the ring is an anonymous mapping shared with
+        processes forked after this point; with one, the ring is a file
+        other processes can attach() to.
+        '''
+
+        if capacity < 1:
+            raise ValueError('RingBuffer capacity must be positive; got %s.' % capacity)
+        self.capacity = capacity
+        self.payload_size = payload_size
+        # Round slots up to 8 bytes to keep timestamps aligned.
+        self.slot_size = (RECORD.size + payload_size + 7) // 8 * 8
+        self.size = SLOTS_OFFSET + capacity * self.slot_size
+        self.path = path
+        self.dropped = 0
+
+        if path is None:
+            self.map = mmap.mmap(-1, self.size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                os.ftruncate(fd, self.size)
+                self.map = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+
+        HEADER.pack_into(self.map, 0, MAGIC, capacity, self.slot_size, payload_size)
+        INDEX.pack_into(self.map, TAIL_OFFSET, 0)
+        INDEX.pack_into(self.map, HEAD_OFFSET, 0)
+
+    @classmethod
+    def attach(cls, path):
+        '''
+        Attach to a ring created by another process with a path.
+        '''
+
+        ring = cls.__new__(cls)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            ring.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+
+        magic, capacity, slot_size, payload_size = HEADER.unpack_from(ring.map, 0)
+        if magic != MAGIC:
+            ring.map.close()
+            raise ValueError('%s is not a ring buffer.' % path)
+        ring.capacity = capacity
+        ring.slot_size = slot_size
+        ring.payload_size = payload_size
+        ring.size = len(ring.map)
+        ring.path = path
+        ring.dropped = 0
+        return ring
+
+    def __len__(self):
+        '''
+        Return the number of records awaiting the consumer.
+        '''
+        return INDEX.unpack_from(self.map, TAIL_OFFSET)[0] - INDEX.unpack_from(self.map, HEAD_OFFSET)[0]
+
+    def put(self, observable_id, initial_primary, final_primary, timestamp=None, payload=''):
+        '''
+        Append a record. Returns False, counting the record in dropped, if
+        the ring is full. Must only be called by the producer.
+        '''
+
+        if len(payload) > self.payload_size:
+            raise ValueError('Payload of %d bytes exceeds the slot size of %d bytes.' % (len(payload), self.payload_size))
+        if timestamp is None:
+            timestamp = time.time()
+
+        tail = INDEX.unpack_from(self.map, TAIL_OFFSET)[0]
+        head = INDEX.unpack_from(self.map, HEAD_OFFSET)[0]
+        if tail - head >= self.capacity:
+            self.dropped = self.dropped + 1
+            return False
+
+        offset = SLOTS_OFFSET + (tail % self.capacity) * self.slot_size
+        RECORD.pack_into(self.map, offset, observable_id,
+                         encode(initial_primary), encode(final_primary),
+                         timestamp, len(payload))
+        if payload:
+            start = offset + RECORD.size
+            self.map[start:start + len(payload)] = payload
+
+        # Publish the record only once it is completely written.
+        INDEX.pack_into(self.map, TAIL_OFFSET, tail + 1)
+        return True
+
+    def get(self):
+        '''
+        Remove and return the oldest record as a tuple of (observable id,
+        initial primary, final primary, timestamp, payload), or None if the
+        ring is empty. Must only be called by the consumer.
+        '''
+
+        head = INDEX.unpack_from(self.map, HEAD_OFFSET)[0]
+        tail = INDEX.unpack_from(self.map, TAIL_OFFSET)[0]
+        if head == tail:
+            return None
+
+        offset = SLOTS_OFFSET + (head % self.capacity) * self.slot_size
+        observable_id, initial_code, final_code, timestamp, length = RECORD.unpack_from(self.map, offset)
+        start = offset + RECORD.size
+        payload = self.map[start:start + length]
+
+        # Release the slot only once it has been completely read.
+        INDEX.pack_into(self.map, HEAD_OFFSET, head + 1)
+        return (observable_id, decode(initial_code), decode(final_code), timestamp, payload)
+
+    def drain(self, limit=None):
+        '''
+        Remove and return up to limit records (all, if None) in order.
+        '''
+
+        records = []
+        while limit is None or len(records) < limit:
+            record = self.get()
+            if record is None:
+                break
+            records.append(record)
+        return records
+
+    def close(self):
+        '''
+        Unmap the ring. The file of a ring with a path is left for others.
+        '''
+        self.map.close()
+
+
+class RingBufferGroup(object):
+    '''
+    RingBufferGroup gives each of several producers its own RingBuffer, so
+    that many producers can feed one consumer without locking.
+    '''
+
+    def __init__(self, producers, capacity=4096, payload_size=0, path=None):
+        '''
+        Create one ring per producer. With a path, the rings are the files
+        path.0, path.1, and so on.
+        '''
+
+        self.rings = []
+        for index in range(producers):
+            ring_path = None
+            if path is not None:
+                ring_path = '%s.%d' % (path, index)
+            self.rings.append(RingBuffer(capacity, payload_size, ring_path))
+
+    def ring(self, producer):
+        '''
+        Return the ring of the given producer index.
+        '''
+        return self.rings[producer]
+
+    def __len__(self):
+        return sum(len(ring) for ring in self.rings)
+
+    def drain(self, limit=None):
+        '''
+        Drain up to limit records from each ring in turn.
+        '''
+
+        records = []
+        for ring in self.rings:
+            records.extend(ring.drain(limit))
+        return records
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+
+
+class RingObservable(CoreObservable):
+    '''
+    RingObservable is meant to be extended like CoreObservable. Its state
+    changes are put into a ring for a RingConsumer in another process, where
+    they are known as observable_id. If the final state has a 'payload'
+    secondary attribute, which must be a string, it is carried along.
+    '''
+
+    def __init__(self, ring, observable_id, *args, **kwargs):
+        '''
+        ring is the RingBuffer this process produces into. observable_id is an
+        unsigned 32 bit integer unique among the consumer's producers.
+        '''
+
+        self.ring = ring
+        self.observable_id = observable_id
+        CoreObservable.__init__(self, *args, **kwargs)
+
+    def report_state_change(self, initial_state, final_state):
+        '''
+        Put the state change into the ring.
+        '''
+
+        with final_state.lock:
+            payload = final_state.secondary_attributes.get(PAYLOAD_ATTRIBUTE, '')
+        if not self.ring.put(self.observable_id, initial_state.get_primary(),
+                             final_state.get_primary(), payload=payload):
+            log.warning('Ring buffer is full; dropped a state change of %s.', self.observable_id)
+
+
+class RingConsumer(object):
+    '''
+    RingConsumer reports the records of a RingBuffer or RingBufferGroup
+    through ReceivedObservables. Add it to the action manager with
+    add_source() and it is drained by the dispatcher thread on every loop,
+    with no thread of its own.
+
+    consumer = RingConsumer(group)
+    consumer.observable(7).register_action(...)
+    action_manager.add_source(consumer)
+    '''
+
+    def __init__(self, ring, manager=None, batch_size=1000):
+        '''
+        ring is a RingBuffer or RingBufferGroup. manager defaults to the
+        action manager singleton. At most batch_size records are taken from
+        each ring per poll, so that a busy producer cannot stall dispatch.
+        '''
+
+        self.ring = ring
+        self.manager = manager or action_manager
+        self.batch_size = batch_size
+        self.observables = {}
+        self.observables_lock = threading.Lock()
+        self.received = 0
+
+    def observable(self, observable_id, state_class=None):
+        '''
+        Return the ReceivedObservable for observable_id, creating it if
+        needed so that actions can be registered before anything arrives.
+        state_class is that of the producing observable, State by default,
+        and is used only when the ReceivedObservable is created.
+        '''
+
+        with self.observables_lock:
+            observable = self.observables.get(observable_id)
+            if observable is None:
+                observable = ReceivedObservable(observable_id, self.manager, state_class)
+                self.observables[observable_id] = observable
+        return observable
+
+    def poll(self):
+        '''
+        Report the records waiting in the ring. Returns how many there were.
+        '''
+
+        records = self.ring.drain(self.batch_size)
+        for observable_id, initial_primary, final_primary, timestamp, payload in records:
+            attribs = {}
+            if payload:
+                attribs[PAYLOAD_ATTRIBUTE] = payload
+            try:
+                self.observable(observable_id).receive(initial_primary, final_primary, timestamp, attribs)
+            except Exception, e:
+                log.error('Failed to report a state change of %s.', observable_id, exc_info=True)
+        self.received = self.received + len(records)
+        return len(records)
@@ -1,14 +1,215 @@
 '''
-The following is a wrapper around ReadWriteMutex of Dogpile to enable Python's
-with command to be used.
+The following is a lock allowing either many readers or a single writer,
+usable with Python's with command.
+
+Waiting writers take precedence over arriving readers, so a stream of
+readers cannot starve writers; with fair=True, readers and writers are
+instead served in order of arrival. A thread acquiring the lock again before
+releasing it would deadlock, so it raises LockError instead. Acquisitions
+may wait without limit, not at all, or up to a timeout.
+
+Profiling can be switched on for a lock to find which call sites wait for it
+and hold it, and for how long:
+
+profile = rwlock.enable_profiling()
+...
+print rwlock.contention_report()
 '''
 
-from dogpile.readwrite_lock import (
-    ReadWriteMutex,
-    LockError,
-    )
+# The standard thread module rather than gdci.core.thread.
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import weakref
+import threading
+from collections import deque
+
+from thread import get_ident
+
+
+# Upper bounds in seconds of the wait and hold time histogram buckets; the
+# last bucket is unbounded.
+PROFILE_BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+
+class LockError(Exception):
+    pass
+
+
+def bucket_index(seconds):
+    '''
+    Return the index of the histogram bucket counting seconds.
+    '''
+
+    for index, bound in enumerate(PROFILE_BUCKETS):
+        if seconds <= bound:
+            return index
+    return len(PROFILE_BUCKETS)
+
+def thread_label(thread):
+    '''
+    Return how a thread is identified in profiles: by class for subclasses
+    such as observers and actions, of which there are many short lived
+    instances, otherwise by name.
+    '''
+
+    if type(thread).__module__ == 'threading':
+        return thread.name
+    return thread.__class__.__name__
+
+def call_site(frame):
+    '''
+    Return the line a frame is executing as "function (file:line)".
+    '''
+
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+
+class LockProfile(object):
+    '''
+    LockProfile accumulates the time spent waiting for and holding a
+    ReadWriteLock, by call site, mode, and thread, and tracks the threads
+    currently waiting and holding. It is filled in by the lock's
+    ReadWriteStates while profiling is enabled on the lock.
+    '''
+
+    def __init__(self):
+        # Guards the dictionaries below. It is never held while acquiring
+        # or releasing the profiled lock.
+        self.lock = threading.Lock()
+        # (site, mode, thread) to [acquisitions, failures, wait buckets,
+        # wait seconds, longest wait, hold buckets, hold seconds,
+        # longest hold]
+        self.stats = {}
+        # Thread ident to (site, mode, thread, since)
+        self.waiters = {}
+        self.holders = {}
+
+    def reset(self):
+        '''
+        Discard the recorded statistics. Current waiters and holders are
+        kept.
+        '''
+        with self.lock:
+            self.stats = {}
+
+    def entry(self, key):
+        '''
+        Return the statistics of key, creating them. The lock must be held.
+        '''
+
+        stats = self.stats.get(key)
+        if stats is None:
+            buckets = len(PROFILE_BUCKETS) + 1
+            stats = self.stats[key] = [0, 0, [0] * buckets, 0.0, 0.0, [0] * buckets, 0.0, 0.0]
+        return stats
+
+    def acquire(self, acquire, mode, site, wait, timeout):
+        '''
+        Call acquire(wait, timeout), recording the wait.
+        '''
+
+        ident = get_ident()
+        label = thread_label(threading.current_thread())
+        begin = time.time()
+        with self.lock:
+            self.waiters[ident] = (site, mode, label, begin)
+
+        acquired = False
+        try:
+            acquired = acquire(wait, timeout)
+        finally:
+            now = time.time()
+            waited = now - begin
+            with self.lock:
+                self.waiters.pop(ident, None)
+                stats = self.entry((site, mode, label))
+                if acquired:
+                    stats[0] += 1
+                    self.holders[ident] = (site, mode, label, now)
+                else:
+                    stats[1] += 1
+                stats[2][bucket_index(waited)] += 1
+                stats[3] += waited
+                stats[4] = max(stats[4], waited)
+        return acquired
+
+    def release(self, release):
+        '''
+        Call release(), recording how long the lock was held.
+        '''
+
+        ident = get_ident()
+        release()
+        now = time.time()
+        with self.lock:
+            holder = self.holders.pop(ident, None)
+            # Acquired before profiling was enabled.
+            if holder is None:
+                return
+            site, mode, label, since = holder
+            held = now - since
+            stats = self.entry((site, mode, label))
+            stats[5][bucket_index(held)] += 1
+            stats[6] += held
+            stats[7] = max(stats[7], held)
+
+    def statistics(self):
+        '''
+        Return a copy of the statistics as a dictionary of
+        (site, mode, thread) to a dictionary of acquisitions, failures,
+        wait_buckets, wait_seconds, longest_wait, hold_buckets, hold_seconds,
+        and longest_hold. Bucket counts are per bucket of PROFILE_BUCKETS,
+        not cumulative.
+        '''
+
+        names = ['acquisitions', 'failures', 'wait_buckets', 'wait_seconds', 'longest_wait',
+                 'hold_buckets', 'hold_seconds', 'longest_hold']
+        with self.lock:
+            return dict((key, dict(zip(names, [list(value) if isinstance(value, list) else value
+                                               for value in stats])))
+                        for key, stats in self.stats.iteritems())
+
+    def current(self):
+        '''
+        Return lists of (site, mode, thread, seconds) for the threads
+        waiting for and holding the lock right now.
+        '''
+
+        now = time.time()
+        with self.lock:
+            waiters = [(site, mode, label, now - since) for site, mode, label, since in self.waiters.values()]
+            holders = [(site, mode, label, now - since) for site, mode, label, since in self.holders.values()]
+        return sorted(waiters), sorted(holders)
+
+    def report(self):
+        '''
+        Return the statistics as text, call sites waiting the longest in
+        total first, followed by the current holders and waiters.
+        '''
+
+        statistics = self.statistics()
+        waiters, holders = self.current()
+
+        lines = ['%-50s %-5s %-20s %8s %8s %10s %10s %10s %10s' %
+                 ('call site', 'mode', 'thread', 'acquired', 'failed',
+                  'wait s', 'max wait', 'hold s', 'max hold')]
+        for key in sorted(statistics, key=lambda key: -statistics[key]['wait_seconds']):
+            stats = statistics[key]
+            lines.append('%-50s %-5s %-20s %8d %8d %10.6f %10.6f %10.6f %10.6f' %
+                         (key + (stats['acquisitions'], stats['failures'], stats['wait_seconds'],
+                                 stats['longest_wait'], stats['hold_seconds'], stats['longest_hold'])))
+        for title, entries in [('Holding', holders), ('Waiting', waiters)]:
+            lines.append('%s:' % title)
+            for site, mode, label, seconds in entries:
+                lines.append('  %s %s in %s for %.6f s' % (label, mode, site, seconds))
+        return '\n'.join(lines)
 
-class ReadWriteLock(ReadWriteMutex):
+
+class ReadWriteLock(object):
     '''
     The intended use is as follows:
 
@@ -17,6 +218,11 @@ class ReadWriteLock(ReadWriteMutex):
         do some reading of the shared resource after potentially waiting
     with rwlock.Write:
         do some writing on the shared resource after potentially waiting
+    try:
+        with rwlock.ReadWithin(seconds):
+            do some reading after waiting at most seconds
+    except LockError:
+        do something else as the lock stayed busy
     try:
         with rwlock.ReadOrNot:
             do some reading without waiting
@@ -26,50 +232,300 @@ class ReadWriteLock(ReadWriteMutex):
         do something else without waiting as the lock was busy
     '''
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, fair=False):
         '''
-        All positional arguments and key word arguments will be passed through
-        to ReadWriteMutex.
+        fair serves readers and writers in order of arrival rather than
+        giving waiting writers precedence.
         '''
-        ReadWriteMutex.__init__(self, *args, **kwargs)
+
+        self.fair = fair
+        # Entering the mutex itself is cheaper than entering the condition.
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        # Threads holding a read lock, and the thread holding the write lock.
+        self.readers = set()
+        self.writer = None
+        # Writers waiting; in fair mode, the tickets of all waiters and of
+        # waiting writers, in order of arrival.
+        self.writers_waiting = 0
+        self.next_ticket = 0
+        self.waiting = deque()
+        self.waiting_writers = deque()
+
+        # The LockProfile while profiling is enabled, and every
+        # ReadWriteState of this lock, which are rebound when it is.
+        self.profile = None
+        self.states = weakref.WeakSet()
+
         self.Read = ReadWriteState(self, 'read')
         self.Write = ReadWriteState(self, 'write')
         self.ReadOrNot = ReadWriteState(self, 'read', wait=False)
         self.WriteOrNot = ReadWriteState(self, 'write', wait=False)
 
+    def ReadWithin(self, seconds):
+        '''
+        Return a read state waiting at most seconds for the lock before
+        raising LockError:
+
+        with rwlock.ReadWithin(0.1):
+            do some reading after waiting up to a tenth of a second
+        '''
+        return ReadWriteState(self, 'read', timeout=seconds)
+
+    def WriteWithin(self, seconds):
+        '''
+        Return a write state waiting at most seconds for the lock before
+        raising LockError.
+        '''
+        return ReadWriteState(self, 'write', timeout=seconds)
+
+    def enable_profiling(self, profile=None):
+        '''
+        Begin recording waits and holds through this lock's ReadWriteStates
+        into profile, by default a new LockProfile, which is returned.
+        Acquisitions made by calling the acquire methods directly are not
+        recorded.
+        '''
+
+        if profile is None:
+            profile = LockProfile()
+        self.profile = profile
+        for state in list(self.states):
+            state.bind()
+        return profile
+
+    def disable_profiling(self):
+        '''
+        Stop recording and return the profile, whose statistics remain
+        readable.
+        '''
+
+        profile = self.profile
+        self.profile = None
+        for state in list(self.states):
+            state.bind()
+        if profile is not None:
+            # Holders releasing from now on are no longer recorded.
+            with profile.lock:
+                profile.holders.clear()
+        return profile
+
+    def contention_report(self):
+        '''
+        Return the report of the profile, or None if profiling is not
+        enabled.
+        '''
+
+        if self.profile is None:
+            return None
+        return self.profile.report()
+
+    def check_reentry(self, ident):
+        '''
+        Raise LockError if the thread ident already holds the lock. The
+        mutex must be held.
+        '''
+
+        if ident == self.writer:
+            raise LockError('Thread %s already holds the write lock.' % ident)
+        if ident in self.readers:
+            raise LockError('Thread %s already holds a read lock.' % ident)
+
+    def wait_for(self, ready, wait, timeout):
+        '''
+        Wait on the condition, whose mutex must be held, until ready() returns
+        True. Returns False without waiting if wait is False, or once timeout
+        seconds have passed if it is not None.
+        '''
+
+        if ready():
+            return True
+        if not wait:
+            return False
+        if timeout is None:
+            while not ready():
+                self.condition.wait()
+            return True
+
+        deadline = time.time() + timeout
+        while not ready():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.condition.wait(remaining)
+        return True
+
+    def acquire_read_lock(self, wait=True, timeout=None):
+        '''
+        Acquire the read lock. Returns False if it could not be acquired
+        without waiting, when wait is False, or within timeout seconds.
+        '''
+
+        ident = get_ident()
+        with self.mutex:
+            self.check_reentry(ident)
+
+            # Uncontended: no writer holds or awaits the lock.
+            if self.writer is None and not self.writers_waiting and not self.waiting:
+                self.readers.add(ident)
+                return True
+
+            if self.fair:
+                ticket = self.take_ticket(False)
+                ready = lambda: self.writer is None and \
+                        (not self.waiting_writers or ticket < self.waiting_writers[0])
+                acquired = self.wait_for(ready, wait, timeout)
+                self.waiting.remove(ticket)
+            else:
+                ready = lambda: self.writer is None and not self.writers_waiting
+                acquired = self.wait_for(ready, wait, timeout)
+
+            if acquired:
+                self.readers.add(ident)
+            elif self.fair:
+                # A reader giving up may unblock the writer behind it.
+                self.condition.notify_all()
+            return acquired
+
+    def release_read_lock(self):
+        '''
+        Release the read lock held by this thread.
+        '''
+
+        ident = get_ident()
+        with self.mutex:
+            try:
+                self.readers.remove(ident)
+            except KeyError:
+                raise LockError('Thread %s does not hold a read lock.' % ident)
+            # Only writers wait for readers to finish.
+            if not self.readers and self.writers_waiting:
+                self.condition.notify_all()
+
+    def acquire_write_lock(self, wait=True, timeout=None):
+        '''
+        Acquire the write lock. Returns False if it could not be acquired
+        without waiting, when wait is False, or within timeout seconds.
+        '''
+
+        ident = get_ident()
+        with self.mutex:
+            self.check_reentry(ident)
+
+            # Uncontended: nobody holds or awaits the lock.
+            if self.writer is None and not self.readers and not self.writers_waiting and not self.waiting:
+                self.writer = ident
+                return True
+            if not wait:
+                return False
+
+            self.writers_waiting += 1
+            if self.fair:
+                ticket = self.take_ticket(True)
+                ready = lambda: self.writer is None and not self.readers and self.waiting[0] == ticket
+            else:
+                ready = lambda: self.writer is None and not self.readers
+            try:
+                acquired = self.wait_for(ready, wait, timeout)
+            finally:
+                self.writers_waiting -= 1
+                if self.fair:
+                    self.waiting.remove(ticket)
+                    self.waiting_writers.remove(ticket)
+
+            if acquired:
+                self.writer = ident
+            else:
+                # Readers held back by this writer may now proceed.
+                self.condition.notify_all()
+            return acquired
+
+    def release_write_lock(self):
+        '''
+        Release the write lock held by this thread.
+        '''
+
+        ident = get_ident()
+        with self.mutex:
+            if self.writer != ident:
+                raise LockError('Thread %s does not hold the write lock.' % ident)
+            self.writer = None
+            self.condition.notify_all()
+
+    def take_ticket(self, writer):
+        '''
+        Join the queue of waiters in fair mode. The mutex must be held.
+        '''
+
+        ticket = self.next_ticket
+        self.next_ticket = ticket + 1
+        self.waiting.append(ticket)
+        if writer:
+            self.waiting_writers.append(ticket)
+        return ticket
+
+
 class ReadWriteState(object):
     '''
     A proxy object for the ReadWriteLock that saves the Read or Write choice.
     '''
 
-    def __init__(self, parent_lock, state, wait=True, *args, **kwargs):
+    def __init__(self, parent_lock, state, wait=True, timeout=None, *args, **kwargs):
         object.__init__(self, *args, **kwargs)
 
         if state == 'read':
             self.reader = True
+            self.lock_acquire = parent_lock.acquire_read_lock
+            self.lock_release = parent_lock.release_read_lock
         elif state == 'write':
             self.reader = False
+            self.lock_acquire = parent_lock.acquire_write_lock
+            self.lock_release = parent_lock.release_write_lock
         else:
             raise TypeError("Provided state must be either 'read' or 'write'.")
 
         self.parent_lock = parent_lock
+        self.mode = state
         self.do_wait = wait
+        self.timeout = timeout
 
-    def __enter__(self, *args, **kwargs):
-        # Determine state, then call appropriate parent acquire function.
-        if self.reader:
-            got_lock = self.parent_lock.acquire_read_lock(wait=self.do_wait)
+        parent_lock.states.add(self)
+        self.bind()
+
+    def bind(self):
+        '''
+        Look up the acquire and release methods once rather than on every
+        use: the lock's own, or the profiled ones while profiling.
+        '''
+
+        if self.parent_lock.profile is None:
+            self.acquire = self.lock_acquire
+            self.release = self.lock_release
         else:
-            got_lock = self.parent_lock.acquire_write_lock(wait=self.do_wait)
+            self.acquire = self.profiled_acquire
+            self.release = self.profiled_release
+
+    def profiled_acquire(self, wait, timeout):
+        profile = self.parent_lock.profile
+        if profile is None:
+            return self.lock_acquire(wait, timeout)
+        # The caller of __enter__.
+        site = call_site(sys._getframe(2))
+        return profile.acquire(self.lock_acquire, self.mode, site, wait, timeout)
+
+    def profiled_release(self):
+        profile = self.parent_lock.profile
+        if profile is None:
+            return self.lock_release()
+        profile.release(self.lock_release)
+
+    def __enter__(self, *args, **kwargs):
         # Make sure to raise an exception if the lock could not be acquired.
-        if not self.do_wait and got_lock is False:
+        if not self.acquire(self.do_wait, self.timeout):
+            if self.do_wait:
+                raise LockError('Could not acquire lock within %s seconds.' % self.timeout)
             raise LockError('Could not acquire lock without waiting.')
-        if not self.do_wait and got_lock:
-            return got_lock
+        return True
 
     def __exit__(self, *args, **kwargs):
-        # Determine state, then call appropriate parent acquire function.
-        if self.reader:
-            self.parent_lock.release_read_lock()
-        else:
-            self.parent_lock.release_write_lock()
+        self.release()
@@ -0,0 +1,196 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains checkpointing of the current State of each
+observable and the actions registered with it. Without a checkpoint, every
+observable starts out in State() after a restart, so the first observation
+of each looks like a state change and fires actions, and every registration
+must be made again. Restoring a snapshot sets the states without reporting
+changes and installs all registrations at once:
+
+save_snapshot('collectors.snapshot', observables)
+...
+restore_snapshot('collectors.snapshot', observables)
+
+Observables are named by the caller, as in registration configs; actions are
+saved by name or dotted import path. A snapshot is compact JSON:
+
+{"version": 1,
+ "actions": ["package.module.Capture", "Upload"],
+ "observables": {"pump1": {"schema": ["is_operating", "result"],
+                           "state": 9,
+                           "registrations": [[9, 10, [0, 1]]]}}}
+
+States are written as their codes, and each registration as the codes of
+its initial and final states and the positions of its actions in "actions".
+Secondary attributes are not saved.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import os
+import json
+import logging
+import tempfile
+
+from gdci.core.state import BIT_VALUES
+from gdci.core.actionmanager import action_manager
+from gdci.core.registration import resolve_action
+
+log = logging.getLogger('Snapshots')
+
+SNAPSHOT_VERSION = 1
+
+
+def action_name(action, names):
+    '''
+    Return the name an action class is saved under: its name in names, a
+    dictionary of action class to name, or else its dotted import path.
+    '''
+
+    name = names.get(action)
+    if name is None:
+        name = '%s.%s' % (action.__module__, action.__name__)
+    return name
+
+def valid_code(state_class, code):
+    '''
+    Return True if code is the code of a State of state_class.
+    '''
+
+    schema = state_class.schema
+    if not isinstance(code, (int, long)) or code & ~schema.full_mask:
+        return False
+    return all(field in BIT_VALUES for field in schema.fields(code))
+
+def write_atomically(path, text):
+    '''
+    Replace the file at path with text, so that it is never found partly
+    written.
+    '''
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary = tempfile.mkstemp(prefix='.snapshot', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'w') as output:
+            output.write(text)
+            output.flush()
+            os.fsync(output.fileno())
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            # Windows(R) will not rename over an existing file.
+            os.remove(path)
+            os.rename(temporary, path)
+    except:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def take_snapshot(observables, actions=None, manager=None):
+    '''
+    Return the snapshot of observables, a dictionary of name to observable,
+    as a dictionary ready to be written as JSON. actions optionally maps
+    names to action classes, as for restore_snapshot(). manager defaults to
+    the action manager singleton.
+    '''
+
+    manager = manager or action_manager
+    names = dict((action, name) for name, action in (actions or {}).iteritems())
+    action_names = []
+    positions = {}
+
+    entries = {}
+    for name, observable in observables.iteritems():
+        registrations = []
+        for (i_code, f_code), action_set in sorted(manager.registrations_of(observable).iteritems()):
+            indexes = []
+            for action in action_set:
+                position = positions.get(action)
+                if position is None:
+                    position = positions[action] = len(action_names)
+                    action_names.append(action_name(action, names))
+                indexes.append(position)
+            registrations.append([i_code, f_code, sorted(indexes)])
+
+        entries[name] = {'schema': list(observable.state_class.schema.attributes),
+                         'state': observable.get_state().get_code(),
+                         'registrations': registrations}
+
+    return {'version': SNAPSHOT_VERSION, 'actions': action_names, 'observables': entries}
+
+def save_snapshot(destination, observables, actions=None, manager=None):
+    '''
+    Write the snapshot of observables to destination, a path, which is
+    replaced atomically, or a file object. Returns the snapshot.
+    '''
+
+    snapshot = take_snapshot(observables, actions, manager)
+    text = json.dumps(snapshot, separators=(',', ':'), sort_keys=True)
+    if isinstance(destination, basestring):
+        write_atomically(destination, text)
+    else:
+        destination.write(text)
+    return snapshot
+
+def restore_snapshot(source, observables, actions=None, manager=None,
+                     states=True, registrations=True):
+    '''
+    Restore the snapshot read from source, a path or file object, into
+    observables, a dictionary of name to observable, and manager, which
+    defaults to the action manager singleton. actions optionally maps names
+    to action classes. states and registrations choose what is restored.
+    Observables of the snapshot missing from observables are skipped.
+    Nothing is restored if the snapshot is invalid. Returns the number of
+    states restored and of (observable, state, state) transitions
+    registered.
+    '''
+
+    if isinstance(source, basestring):
+        with open(source) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    else:
+        snapshot = json.load(source)
+
+    try:
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('unsupported version %r' % (snapshot.get('version'),))
+        action_classes = [resolve_action(name, actions or {}) for name in snapshot['actions']]
+
+        restored = []
+        staged = {}
+        skipped = 0
+        for name, entry in snapshot['observables'].iteritems():
+            observable = observables.get(name)
+            if observable is None:
+                skipped += 1
+                continue
+            state_class = observable.state_class
+            if list(state_class.schema.attributes) != entry['schema']:
+                raise ValueError('%s has primary attributes %s, not %s' %
+                                 (name, list(state_class.schema.attributes), entry['schema']))
+            if not valid_code(state_class, entry['state']):
+                raise ValueError('invalid state %r of %s' % (entry['state'], name))
+            restored.append((observable, state_class.from_code(entry['state'])))
+
+            for i_code, f_code, indexes in entry['registrations']:
+                if not (valid_code(state_class, i_code) and valid_code(state_class, f_code)):
+                    raise ValueError('invalid registration %r of %s' % ([i_code, f_code], name))
+                staged[(observable, i_code, f_code)] = set(action_classes[index] for index in indexes)
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError), e:
+        msg = 'Invalid snapshot: %s' % (e,)
+        log.error(msg)
+        raise ValueError(msg)
+
+    if skipped:
+        log.warning('Skipped %d observables of the snapshot which were not given.', skipped)
+    if states:
+        for observable, state in restored:
+            observable.set_state(state)
+    if not registrations:
+        staged = {}
+    count = len(staged)
+    (manager or action_manager).install_mapping(staged)
+    return len(restored) if states else 0, count
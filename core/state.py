@@ -11,6 +11,13 @@ that the state is coming from. is_operating can be False in cases where
 something has gone wrong, invalidating the result (for example, the network
 dropped, so an observable cannot be obtain a result across the network).
 
+The primary attributes of a class of State are named by its StateSchema;
+subclasses may define more of them, for example a quality flag. Their values
+are packed into an integer code with one bit per possible value, three bits
+per attribute, so that comparing States and matching them against patterns
+such as '*' or '[TF]' are single integer operations however many attributes
+there are.
+
 As a piece of core code, it is not recommended that this class be modified.
 
 To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States. 
@@ -20,74 +27,356 @@ https://github.com/btbonval/Generic-Data-Collection-Infrastructure
 import copy
 import threading
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The letters by which patterns name the values of primary attributes, and
+# the bit of each value within its attribute's field of a code.
+VALUE_LETTERS = {'T': True, 'F': False, 'N': None}
+VALUE_BITS = {True: 1, False: 2, None: 4}
+BIT_VALUES = {1: True, 2: False, 4: None}
+FIELD_WIDTH = 3
+FIELD_MASK = 7
+# A pattern allowing any value of an attribute.
+WILDCARD = '*'
+
+
+def encode(values):
+    '''
+    Return the code of a sequence of primary attribute values.
+    '''
+
+    code = 0
+    shift = 0
+    for value in values:
+        code |= VALUE_BITS[value] << shift
+        shift += FIELD_WIDTH
+    return code
+
+def decode(code):
+    '''
+    Return the tuple of primary attribute values of a code. Every field has a
+    bit set, so the number of attributes is implied.
+    '''
+
+    values = []
+    while code:
+        values.append(BIT_VALUES[code & FIELD_MASK])
+        code >>= FIELD_WIDTH
+    return tuple(values)
+
+def shares_writable_data(array):
+    '''
+    Return True if a NumPy array, or any array or buffer it views, can be
+    written, so that its data may change under a reader.
+    '''
+
+    base = array
+    while isinstance(base, numpy.ndarray):
+        if base.flags.writeable:
+            return True
+        base = base.base
+    if base is None or isinstance(base, str):
+        return False
+    if isinstance(base, memoryview):
+        return not base.readonly
+    # Some other buffer, such as a bytearray or mmap, which may be written.
+    return True
+
+def freeze_payload(value):
+    '''
+    Return a buffer payload which cannot be written: strings, read-only
+    memoryviews and NumPy arrays whose data nothing can write as they are,
+    and any other bytearray, memoryview or NumPy array as a read-only copy,
+    so that refilling the original never changes the payload. Anything
+    else is returned unchanged.
+    '''
+
+    if isinstance(value, memoryview):
+        if value.readonly:
+            return value
+        return memoryview(value.tobytes())
+    if isinstance(value, bytearray):
+        return str(value)
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if not shares_writable_data(value):
+            return value
+        frozen = value.copy()
+        frozen.flags.writeable = False
+        return frozen
+    return value
+
+def is_frozen(value):
+    '''
+    Return True if value is a read-only buffer payload, which copies of a
+    State share rather than copy. Strings need no help, as deepcopy() never
+    copies them.
+    '''
+
+    if isinstance(value, memoryview):
+        return value.readonly
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        # Arrays of objects refer to objects which may still be written.
+        return not shares_writable_data(value) and value.dtype != object
+    return False
+
+def field_bits(value):
+    '''
+    Return the bits of an attribute's field allowed by value: True, False,
+    None, '*', a string of letters such as '[TF]', or a collection of values.
+    '''
+
+    try:
+        return VALUE_BITS[value]
+    except (KeyError, TypeError):
+        pass
+
+    bits = 0
+    if isinstance(value, basestring):
+        if value == WILDCARD:
+            return FIELD_MASK
+        if len(value) > 2 and value[0] == '[' and value[-1] == ']':
+            for letter in value[1:-1].upper():
+                if letter not in VALUE_LETTERS:
+                    raise TypeError('Invalid value for State attribute: %r' % (value,))
+                bits |= VALUE_BITS[VALUE_LETTERS[letter]]
+            return bits
+        raise TypeError('Invalid value for State attribute: %r' % (value,))
+
+    try:
+        items = list(value)
+    except TypeError:
+        raise TypeError('Invalid type for State attribute: %s' % value.__class__)
+    for item in items:
+        if isinstance(item, basestring):
+            raise TypeError('Invalid value for State attribute: %r' % (value,))
+        bits |= field_bits(item)
+    if not bits:
+        raise TypeError('Invalid value for State attribute: %r' % (value,))
+    return bits
+
+
+class StateSchema(object):
+    '''
+    StateSchema names the primary attributes of a class of State, in order,
+    and compiles values and patterns of them into codes and masks.
+    '''
+
+    def __init__(self, attributes):
+        '''
+        attributes is a sequence of distinct attribute names.
+        '''
+
+        self.attributes = tuple(attributes)
+        if not self.attributes or len(set(self.attributes)) != len(self.attributes):
+            raise ValueError('A StateSchema needs distinct attribute names; got %s.' % (self.attributes,))
+        self.positions = dict((name, index) for index, name in enumerate(self.attributes))
+        self.full_mask = (1 << FIELD_WIDTH * len(self.attributes)) - 1
+        # Codes of exact values seen so far, and values of codes; there are
+        # at most 3 ** len(attributes) of them.
+        self.codes = {}
+        self.values = {}
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def allowed(self, values, named=None):
+        '''
+        Return the bits allowed by a pattern, given as a sequence of values
+        in attribute order followed by a dictionary of values by name.
+        Attributes not given may only be None.
+        '''
+
+        if len(values) > len(self.attributes):
+            raise TypeError('A State has %d primary attributes; got %d values.' % (len(self.attributes), len(values)))
+        values = list(values) + [None] * (len(self.attributes) - len(values))
+        if named:
+            for name, value in named.iteritems():
+                if name not in self.positions:
+                    raise TypeError('A State has no primary attribute %r.' % name)
+                values[self.positions[name]] = value
+
+        allowed = 0
+        shift = 0
+        for value in values:
+            allowed |= field_bits(value) << shift
+            shift += FIELD_WIDTH
+        return allowed
+
+    def code(self, values, named=None):
+        '''
+        Return the code of exact values, or None if they are a pattern
+        matching several codes.
+        '''
+
+        if not named:
+            try:
+                return self.codes[values]
+            except (KeyError, TypeError):
+                pass
+
+        allowed = self.allowed(values, named)
+        for field in self.fields(allowed):
+            if field not in BIT_VALUES:
+                return None
+        if not named:
+            try:
+                self.codes[tuple(values)] = allowed
+            except TypeError:
+                pass
+        return allowed
+
+    def fields(self, allowed):
+        '''
+        Return the field of each attribute within allowed bits.
+        '''
+        return [(allowed >> FIELD_WIDTH * index) & FIELD_MASK for index in range(len(self.attributes))]
+
+    def decode(self, code):
+        '''
+        Return the tuple of attribute values of a code.
+        '''
+
+        values = self.values.get(code)
+        if values is None:
+            values = self.values[code] = decode(code)
+        return values
+
+    def expand(self, allowed):
+        '''
+        Return the codes of every State matching allowed bits.
+        '''
+
+        codes = [0]
+        for index, field in enumerate(self.fields(allowed)):
+            shift = FIELD_WIDTH * index
+            codes = [code | (bit << shift) for code in codes
+                     for bit in (1, 2, 4) if field & bit]
+        return codes
+
+
+class StatePattern(object):
+    '''
+    StatePattern matches States whose primary attributes have any of the
+    values allowed for each. With one bit per value, a State matches if its
+    code has none of the bits the pattern forbids: one AND, whatever the
+    number of attributes.
+
+    pattern = StatePattern(State, '*', '[TF]')
+    State(None, True) in pattern
+    '''
+
+    def __init__(self, state_class, *values, **named):
+        '''
+        Compile values, as given to state_class, into a pattern.
+        '''
+
+        self.state_class = state_class
+        self.allowed = state_class.schema.allowed(values, named)
+        # The mask of forbidden bits; matching codes have none of them.
+        self.mask = state_class.schema.full_mask & ~self.allowed
+
+    def matches(self, code):
+        '''
+        Return True if a code matches.
+        '''
+        return not code & self.mask
+
+    def __contains__(self, state):
+        try:
+            code = state.code
+        except AttributeError:
+            return False
+        return code <= self.state_class.schema.full_mask and not code & self.mask
+
+    def codes(self):
+        '''
+        Return the code of every matching State.
+        '''
+        return self.state_class.schema.expand(self.allowed)
+
+    def states(self):
+        '''
+        Return a StateCollection of every matching State.
+        '''
+        return StateCollection(self.state_class.from_code(code) for code in self.codes())
+
+
 class State(object):
     '''
     State contains important attributes whose change could cause actions
     to be fired in response.
     All other attributes assigned to a State object will be copied and sent
-    along to fired actions for further processing.
+    along to fired actions for further processing, except buffer payloads
+    such as image frames, which are frozen read-only and shared instead.
+
+    The primary attributes are fixed at construction. Subclasses may name
+    others with a schema of their own:
+
+    class QualityState(State):
+        schema = StateSchema(['is_operating', 'result', 'quality'])
     '''
 
-    def __new__(cls, is_operating=None, result=None, *args, **kwargs):
+    # The primary attributes of this class of State.
+    schema = StateSchema(['is_operating', 'result'])
+
+    def __new__(cls, *values, **named):
         '''
-        is_operating and result can be set to True, False, None, or '*'.
-        In the case where the special value '*' is used for either or both
-        parameters, a collection (set) of States will be returned instead.
+        Each primary attribute, given in schema order or by name, can be set
+        to True, False, None, '*', a string of letters such as '[TF]', or a
+        collection of values. Attributes not given are None.
+        In the case where any attribute is given several values, a
+        collection (set) of States will be returned instead.
         The collection will represent a cross product of all combinations.
         '''
 
-        # TODO support more special combinations than just '*', such as [TF]
-        
-        # If both attributes are passed without anything fancy, we do
+        # If all attributes are passed without anything fancy, we do
         # nothing special.
-        if is_operating in [True, False, None] and \
-           result in [True, False, None]:
-               return object.__new__(cls, is_operating, result, *args, **kwargs)
-
-        # Prepare variables for consistent parsing
-        if is_operating == '*':
-            op_list = [True, False, None]
-        else:
-            op_list = [is_operating]
-        if result == '*':
-            res_list = [True, False, None]
-        else:
-            res_list = [result]
-
-        # Create a series of objects expanding all possibilties in case of '*'
-        return_objects = StateCollection()
-        for op_item in op_list:
-            # Ensure each element for is_operating is valid
-            if op_item not in [True, False, None]:
-                raise TypeError('Invalid type for State attribute: %s',
-                                op_item.__class__)
-
-            for res_item in res_list:
-                # Ensure each element of result is valid.
-                if res_item not in [True, False, None]:
-                    raise TypeError('Invalid type for State attribute: %s',
-                                    res_item.__class__)
-
-                # Create a new State object
-                state_object = object.__new__(cls, op_item, res_item, *args, **kwargs)
-                # Python will not automagically  call __init__ at this point.
-                state_object.__init__(op_item, res_item, *args, **kwargs)
-                return_objects.add(state_object)
-
-        # Each State object has been created and initialized.
-        # Return the set of State objects instead of a State object.
-        return return_objects
-
-    def __init__(self, is_operating=None, result=None, *args, **kwargs):
-        '''
-        Construct a State object with is_operating and result primary
-        attributes, which each must be one of True, False, or None.
-        '''
-
-        # Primary Attributes
-        # TODO make this fancier rather than hard coding the two attributes.
-        self.is_operating = is_operating
-        self.result = result
+        code = cls.schema.code(values, named)
+        if code is not None:
+            return cls.new_from_code(code)
+
+        # Create a series of objects expanding all possibilities.
+        return StatePattern(cls, *values, **named).states()
+
+    @classmethod
+    def new_from_code(cls, code):
+        '''
+        Create a State with the primary attributes of code, without calling
+        __init__().
+        '''
+
+        state = object.__new__(cls)
+        state.code = code
+        state.__dict__.update(zip(cls.schema.attributes, cls.schema.decode(code)))
+        return state
+
+    @classmethod
+    def from_code(cls, code):
+        '''
+        Return the State with the primary attributes of code.
+        '''
+
+        state = cls.new_from_code(code)
+        state.__init__()
+        return state
+
+    @classmethod
+    def pattern(cls, *values, **named):
+        '''
+        Return a StatePattern of this class of State.
+        '''
+        return StatePattern(cls, *values, **named)
+
+    def __init__(self, *values, **named):
+        '''
+        Construct a State object. Its primary attributes, which each must be
+        one of True, False, or None, have been set from values and named by
+        __new__().
+        '''
+
         # Secondary Attributes stored in a dictionary.
         # TODO allow secondary attributes to be set on construction
         # TODO enable creation of secondary attributes outside of construction
@@ -99,7 +388,7 @@ class State(object):
         State is sort of a collection, and in that sense, it makes sense to
         represent the objects contained within it.
         '''
-        return self.__repr__() + "(" + str(self.is_operating) + "," + str(self.result) + ")" + str(self.secondary_attributes)
+        return self.__repr__() + "(" + ",".join(str(value) for value in self.get_primary()) + ")" + str(self.secondary_attributes)
 
     def __eq__(self, other):
         '''
@@ -109,13 +398,22 @@ class State(object):
         '''
 
         try:
-            return self.is_operating == other.is_operating and \
-                   self.result == other.result
+            return self.code == other.code
         except AttributeError:
             # The other object clearly does not follow the same format
             # so these two objects cannot be the same.
             return False
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        '''
+        States hash by their primary attributes, which are fixed, so that
+        sets and dictionaries of them find equal States.
+        '''
+        return hash(self.code)
+
     def __or__(self, other):
         '''
         Union this State with the other thing into a StateCollection.
@@ -144,6 +442,10 @@ class State(object):
 
         # Mark the RLock as having been copied already
         memo[id(self.lock)] = None
+        # Share read-only payloads rather than copying them.
+        for value in self.secondary_attributes.itervalues():
+            if is_frozen(value):
+                memo[id(value)] = value
 
         # Can no longer call deepcopy(self) or it will result in an infinite
         # loop. The following calls are made by deepcopy if no __deepcopy__
@@ -165,7 +467,7 @@ class State(object):
         Return a new State object containing data copies, not references, to
         the internal data of this object. References to the data might change
         as the Observable modifies itself; it is not safe in a concurrent
-        context.
+        context. Read-only payloads cannot change, so they are shared.
         '''
 
         # Perform a deep copy only after no data can be written.
@@ -178,11 +480,14 @@ class State(object):
         Returns primary attributes within a tuple for hashing purposes.
         '''
 
-        # Access primary attributes in a thread-safe manner.
-        with self.lock:
-            is_operating = self.is_operating
-            result = self.result
-        return tuple([is_operating, result])
+        # Primary attributes are fixed, so no lock is needed.
+        return self.schema.decode(self.code)
+
+    def get_code(self):
+        '''
+        Returns primary attributes packed into an integer.
+        '''
+        return self.code
 
     def set_secondary(self, key, value):
         '''
@@ -194,6 +499,31 @@ class State(object):
         with self.lock:
             self.secondary_attributes[key] = value
 
+    def set_payload(self, key, value):
+        '''
+        Store a buffer payload (a string, bytearray, memoryview or NumPy
+        array) as a secondary attribute, frozen by freeze_payload() so that
+        copies of this State share it instead of copying it. A NumPy array
+        which nothing can write is shared without a copy. Returns the frozen
+        payload.
+        '''
+
+        value = freeze_payload(value)
+        with self.lock:
+            self.secondary_attributes[key] = value
+        return value
+
+    def update_secondary(self, attribs):
+        '''
+        Merge a dictionary into the secondary attributes, freezing any
+        buffer payloads among its values as set_payload() does.
+        '''
+
+        with self.lock:
+            secondary_attributes = self.secondary_attributes
+            for key, value in attribs.iteritems():
+                secondary_attributes[key] = freeze_payload(value)
+
     def get_secondary(self, key):
         '''
         Access secondary attributes as a dictionary. Supply a key for the
@@ -207,26 +537,17 @@ class State(object):
        
 class StateCollection(set):
     '''
-    StateCollection is a fancy wrapper around set so that a set of States can
-    use the "in" and "not in" using the "eq" operator. By default, set uses
-    the "is" operator. For use with States, it really only matters that the
-    values match rather than performing specific object matching.
+    StateCollection is a set of States. States hash and compare by the
+    values of their primary attributes, so "in" and "not in" match equal
+    States rather than only the same objects, in constant time.
     '''
 
     def __contains__(self, item):
         '''
-        The "in" operator will check for object equality first, followed by
-        value equality. Either condition is sufficient to return True.
+        Anything which is not a State is not in the collection.
         '''
 
-        # TODO determine if there is a faster or more efficient way to
-        # perform this operation than a O(n) search.
-        # (It seems unlikely without immutable and hashable objects...)
-        # Parse each object in the set and see if the given item matches.
-        for other_item in self:
-            # Check identity first (faster), equality second (slower).
-            if other_item is item or other_item == item:
-                return True
-        # If all items in the set have been parsed without returning True,
-        # item is not in this set.
-        return False
+        try:
+            return set.__contains__(self, item)
+        except TypeError:
+            return False
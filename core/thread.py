@@ -11,16 +11,49 @@ To the extent possible under law, Bryan Bonvallet has waived all copyright and r
 https://github.com/btbonval/Generic-Data-Collection-Infrastructure
 '''
 
+import zlib
+import random
 import logging
 import threading
 import time
 
 log = logging.getLogger('Thread')
 
+def phase_from_key(key):
+    '''
+    Map any key, such as the name of a group of observers, onto a phase in
+    [0, 1). The same key always yields the same phase.
+    '''
+    return (zlib.crc32(str(key)) & 0xffffffff) / 4294967296.0
+
+def spread_phases(threads, offset=0.0):
+    '''
+    Assign evenly spaced phases to threads sharing a loop_interval, so that
+    their loops are spread across the interval instead of beginning at once.
+    offset is the phase of the first thread, or a key for phase_from_key()
+    so that different groups begin at different points.
+    Must be called before the threads are started.
+    '''
+
+    if not isinstance(offset, (int, long, float)):
+        offset = phase_from_key(offset)
+    count = len(threads)
+    for index, thread in enumerate(threads):
+        thread.phase = (offset + float(index) / count) % 1.0
+
 class CoreThread(threading.Thread):
     '''
     CoreThread is meant to be extended. The main_loop() method must be
     overridden to define functionality for any given subclass.
+
+    By default the first loop begins as soon as the thread starts, so threads
+    started together stay in step. Setting a phase instead aligns each loop
+    to a grid of loop_interval offset from the epoch by phase*loop_interval;
+    threads with different phases take turns regardless of when they were
+    started. jitter additionally delays each loop from its place in that
+    schedule by a random fraction of loop_interval up to jitter, without
+    lengthening the schedule, drawn from a generator seeded by jitter_seed
+    (or the thread's name) so that runs are reproducible.
     '''
 
     def __init__(self, loop_interval=1, sleep_delay=None, do_loop=True, *args, **kwargs):
@@ -35,8 +68,19 @@ class CoreThread(threading.Thread):
         sleep_delay is the interval to sleep in seconds and represents a
         minimum interval between subsequent calls to main_loop(). If left None,
         it will be calculated based on loop_interval.
+        The key word arguments phase, jitter, and jitter_seed configure
+        scheduling as described for the class. phase is a fraction of
+        loop_interval in [0, 1) or a key for phase_from_key().
         '''
 
+        # Separate the scheduling arguments from threading.Thread's.
+        phase = kwargs.pop('phase', None)
+        if phase is not None and not isinstance(phase, (int, long, float)):
+            phase = phase_from_key(phase)
+        self.phase = phase
+        self.jitter = kwargs.pop('jitter', 0.0)
+        self.jitter_seed = kwargs.pop('jitter_seed', None)
+
         # Call parent constructor
         threading.Thread.__init__(self, *args, **kwargs)
 
@@ -55,6 +99,15 @@ class CoreThread(threading.Thread):
         '''
         raise NotImplementedError("main_loop must be overridden.")
 
+    def phase_time(self, now):
+        '''
+        Return the latest time no later than now at which a loop is due
+        according to phase. Requires phase to be set.
+        '''
+
+        offset = self.phase * self.loop_interval
+        return now - ((now - offset) % self.loop_interval)
+
     def before_loop(self):
         '''
         before_loop is intended to be called prior to running main_loop().
@@ -90,13 +143,30 @@ class CoreThread(threading.Thread):
         if not self.do_loop:
             self.main_loop()
 
-        last_run = time.time() - 2*self.loop_interval
+        # Without a phase, begin the first loop immediately. With one, begin
+        # at the next point on the phase grid.
+        if self.phase is None:
+            last_run = time.time() - 2*self.loop_interval*(1 + self.jitter)
+        else:
+            last_run = self.phase_time(time.time())
+
+        # Draw jitter reproducibly for this thread.
+        if self.jitter:
+            seed = self.jitter_seed
+            if seed is None:
+                seed = phase_from_key(self.name)
+            jitter = random.Random(seed)
+
         while self.do_loop:
 
+            delay = self.loop_interval
+            if self.jitter:
+                delay = delay + self.jitter * self.loop_interval * jitter.random()
+
             # Delay until the next loop interval has begun
             # If do_loop is canceled prior to that, abort wait cycles.
             #while (time.time() - last_run) < self.loop_interval:
-            while self.do_loop and (time.time() - last_run) < self.loop_interval:
+            while self.do_loop and (time.time() - last_run) < delay:
                 time.sleep(self.sleep_delay)
 
             # do_loop might have been canceled during wait. abort execution.
@@ -105,7 +175,20 @@ class CoreThread(threading.Thread):
 
             # mark time before beginning the observation so that its runtime
             # does not count against the next interval's start time.
-            last_run = time.time()
+            # With a phase or jitter, mark the scheduled time instead so that
+            # sleep granularity and jitter do not make the schedule drift; if
+            # main_loop() overran, skip ahead to the current time, or grid
+            # point with a phase.
+            if self.phase is None and not self.jitter:
+                last_run = time.time()
+            else:
+                last_run = last_run + self.loop_interval
+                now = time.time()
+                if now - last_run >= self.loop_interval * (1 + self.jitter):
+                    if self.phase is None:
+                        last_run = now
+                    else:
+                        last_run = self.phase_time(now)
 
             # run custom code
             self.main_loop()
@@ -0,0 +1,364 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains a library of declarative CoreObservables which
+turn a numeric reading into a truth value: thresholds, ranges, hysteresis
+bands and rates of change. Subclasses set the parameters as class attributes
+and override read_value(); the comparison itself is compiled once into a
+closure rather than re-deciding which conditionals apply on every call.
+ThresholdBank evaluates many such observables at once, using NumPy when it
+is available.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import time
+
+from gdci.core.observable import CoreObservable
+
+# NumPy is optional. Without it, ThresholdBank falls back to the compiled
+# closures of each observable.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Encoding of True, False, and None used by ThresholdBank's arrays.
+_ENCODE = {True: 1, False: 0, None: -1}
+_DECODE = {1: True, 0: False, -1: None}
+
+
+def compile_above(limit, deadband=0):
+    '''
+    Return a closure evaluate(value, previous) which becomes True once value
+    rises above limit and only becomes False again once value falls to
+    limit - deadband or below. Between the two, the previous result is kept.
+    '''
+
+    if not deadband:
+        def evaluate(value, previous):
+            return value > limit
+        return evaluate
+
+    release = limit - deadband
+    def evaluate(value, previous):
+        if value > limit:
+            return True
+        if value <= release:
+            return False
+        return previous
+    return evaluate
+
+def compile_below(limit, deadband=0):
+    '''
+    Return a closure evaluate(value, previous) which becomes True once value
+    falls below limit and only becomes False again once value rises to
+    limit + deadband or above. Between the two, the previous result is kept.
+    '''
+
+    if not deadband:
+        def evaluate(value, previous):
+            return value < limit
+        return evaluate
+
+    release = limit + deadband
+    def evaluate(value, previous):
+        if value < limit:
+            return True
+        if value >= release:
+            return False
+        return previous
+    return evaluate
+
+def compile_range(low, high, inside=True):
+    '''
+    Return a closure evaluate(value, previous) which is True when value lies
+    within [low, high] (or outside of it when inside is False).
+    '''
+
+    if inside:
+        def evaluate(value, previous):
+            return low <= value <= high
+    else:
+        def evaluate(value, previous):
+            return not (low <= value <= high)
+    return evaluate
+
+def compile_hysteresis(low, high):
+    '''
+    Return a closure evaluate(value, previous) which becomes True when value
+    reaches high, becomes False when value reaches low, and otherwise keeps
+    the previous result.
+    '''
+
+    if low > high:
+        raise ValueError('Hysteresis band requires low <= high; got %s > %s.' % (low, high))
+
+    def evaluate(value, previous):
+        if value >= high:
+            return True
+        if value <= low:
+            return False
+        return previous
+    return evaluate
+
+
+class LevelObservable(CoreObservable):
+    '''
+    LevelObservable is meant to be extended through one of its subclasses.
+    The read_value() method must be overridden to return a number; the
+    subclass decides how that number maps onto True, False, or None.
+    The reading is passed along to actions as the 'value' secondary attribute.
+
+    The evaluator is compiled on first use. Call compile() again after
+    changing the parameters of an observable.
+    '''
+
+    # The compiled evaluator and the result it last produced.
+    evaluator = None
+    last_result = None
+    # A result already evaluated by a ThresholdBank, awaiting
+    # check_observation().
+    pending_observation = None
+    # Flip the result of the evaluator (e.g. outside a range).
+    invert = False
+
+    def read_value(self):
+        '''
+        read_value should be defined by subclasses to return the current
+        numeric reading.
+        '''
+        raise NotImplementedError("read_value() must be overridden.")
+
+    def compile_evaluator(self):
+        '''
+        Return a closure evaluate(value, previous) for this observable's
+        parameters. Defined by the subclasses of this library.
+        '''
+        raise NotImplementedError("compile_evaluator() must be overridden.")
+
+    def bounds(self):
+        '''
+        Describe the evaluator for ThresholdBank as a tuple of
+        (on_low, on_high, hold_low, hold_high), all inclusive:
+        the result is True within [on_low, on_high], retains the previous
+        result within [hold_low, hold_high], and is False otherwise.
+        Requires NumPy to express strict comparisons.
+        '''
+        raise NotImplementedError("%s cannot be evaluated in a ThresholdBank." % self.__class__.__name__)
+
+    def compile(self):
+        '''
+        Compile and cache the evaluator for the current parameters.
+        '''
+        self.evaluator = self.compile_evaluator()
+        return self.evaluator
+
+    def observe_value(self, value):
+        '''
+        Evaluate value and return it in the (result, dict) form expected by
+        check_observation().
+        '''
+
+        evaluate = self.evaluator
+        if evaluate is None:
+            evaluate = self.compile()
+        self.last_result = evaluate(value, self.last_result)
+        return (self.last_result, {'value': value})
+
+    def get_observation(self):
+        '''
+        Read the current value and evaluate it, unless a ThresholdBank has
+        already done so.
+        '''
+
+        if self.pending_observation is not None:
+            return self.pending_observation
+        return self.observe_value(self.read_value())
+
+
+class ThresholdObservable(LevelObservable):
+    '''
+    True while the reading is above (or below, if above is False) limit.
+    A nonzero deadband keeps the result True until the reading has moved
+    deadband past limit in the other direction.
+    '''
+
+    limit = 0
+    deadband = 0
+    above = True
+
+    def compile_evaluator(self):
+        if self.above:
+            return compile_above(self.limit, self.deadband)
+        return compile_below(self.limit, self.deadband)
+
+    def bounds(self):
+        inf = float('inf')
+        limit = float(self.limit)
+        if self.above:
+            return (numpy.nextafter(limit, inf), inf,
+                    numpy.nextafter(limit - self.deadband, inf), inf)
+        return (-inf, numpy.nextafter(limit, -inf),
+                -inf, numpy.nextafter(limit + self.deadband, -inf))
+
+
+class RangeObservable(LevelObservable):
+    '''
+    True while the reading lies within [low, high], or outside of it if
+    inside is False.
+    '''
+
+    low = 0
+    high = 0
+    inside = True
+
+    def compile_evaluator(self):
+        return compile_range(self.low, self.high, self.inside)
+
+    @property
+    def invert(self):
+        return not self.inside
+
+    def bounds(self):
+        return (self.low, self.high, self.low, self.high)
+
+
+class HysteresisObservable(LevelObservable):
+    '''
+    Becomes True when the reading reaches high and False when it reaches low.
+    Between the two, the result does not change.
+    '''
+
+    low = 0
+    high = 0
+
+    def compile_evaluator(self):
+        return compile_hysteresis(self.low, self.high)
+
+    def bounds(self):
+        inf = float('inf')
+        return (self.high, inf, numpy.nextafter(float(self.low), inf), inf)
+
+
+class RateOfChangeObservable(ThresholdObservable):
+    '''
+    A ThresholdObservable applied to the rate of change of the reading in
+    units per second rather than the reading itself. With absolute set, the
+    magnitude of the rate is compared. The first reading has no rate and so
+    yields None. The rate is passed to actions as the 'rate' secondary
+    attribute.
+    '''
+
+    absolute = False
+    last_value = None
+    last_time = None
+
+    def observe_value(self, value, now=None):
+        '''
+        Compute the rate since the last reading and evaluate it.
+        '''
+
+        if now is None:
+            now = time.time()
+        last_value, last_time = self.last_value, self.last_time
+        self.last_value, self.last_time = value, now
+
+        # Without two readings there is no rate; keep the previous result.
+        if last_time is None or now <= last_time:
+            return (self.last_result, {'value': value, 'rate': None})
+
+        rate = (value - last_value) / float(now - last_time)
+        if self.absolute:
+            rate = abs(rate)
+        result, attribs = LevelObservable.observe_value(self, rate)
+        return (result, {'value': value, 'rate': rate})
+
+    def bounds(self):
+        raise NotImplementedError("%s cannot be evaluated in a ThresholdBank." % self.__class__.__name__)
+
+
+class ThresholdBank(object):
+    '''
+    A ThresholdBank evaluates many LevelObservables against a sequence of
+    readings at once. With NumPy, the parameters of all members are compiled
+    into arrays once and each evaluation is a handful of vector operations;
+    otherwise each member's compiled closure is called in turn. Either way,
+    members remember their last result so they can also be used alone.
+
+    bank = ThresholdBank(observables)
+    results = bank.evaluate(readings)       # [(result, dict), ...]
+    states = bank.check_observations(readings)  # feeds the action manager
+    '''
+
+    def __init__(self, observables, vectorize=True):
+        '''
+        observables is a sequence of LevelObservables. vectorize may be set
+        to False to always use the compiled closures.
+        '''
+
+        self.observables = list(observables)
+        self.vectorized = vectorize and numpy is not None
+        self.compile()
+
+    def compile(self):
+        '''
+        Compile the parameters of every member. Call again after changing
+        the parameters of a member.
+        '''
+
+        for observable in self.observables:
+            observable.compile()
+
+        if not self.vectorized:
+            return
+
+        bounds = numpy.array([observable.bounds() for observable in self.observables], dtype=float).reshape(-1, 4)
+        self.on_low, self.on_high, self.hold_low, self.hold_high = bounds.T
+        self.invert = numpy.array([observable.invert for observable in self.observables], dtype=bool)
+
+    def evaluate(self, values):
+        '''
+        Evaluate the readings in values, given in the order of the members.
+        Returns a list of (result, {'value': value}) tuples.
+        '''
+
+        if len(values) != len(self.observables):
+            raise ValueError('ThresholdBank has %d members but received %d values.' % (len(self.observables), len(values)))
+
+        if not self.vectorized:
+            return [observable.observe_value(value) for observable, value in zip(self.observables, values)]
+
+        array = numpy.asarray(values, dtype=float)
+        # The arrays hold results prior to inversion.
+        previous = numpy.array([_ENCODE[observable.last_result] for observable in self.observables], dtype=numpy.int8)
+        held = previous >= 0
+        previous = numpy.where(held & self.invert, 1 - previous, previous)
+
+        on = (array >= self.on_low) & (array <= self.on_high)
+        hold = (array >= self.hold_low) & (array <= self.hold_high)
+        current = numpy.where(on, 1, numpy.where(hold, previous, 0))
+        current = numpy.where((current >= 0) & self.invert, 1 - current, current)
+
+        results = []
+        for observable, code, value in zip(self.observables, current.tolist(), values):
+            observable.last_result = _DECODE[code]
+            results.append((observable.last_result, {'value': value}))
+        return results
+
+    def check_observations(self, values):
+        '''
+        Evaluate the readings in values and pass each result through the
+        architecture with check_observation(). Returns the list of States.
+        '''
+
+        states = []
+        for observable, result in zip(self.observables, self.evaluate(values)):
+            observable.pending_observation = result
+            try:
+                states.append(observable.check_observation())
+            finally:
+                observable.pending_observation = None
+        return states
@@ -0,0 +1,560 @@
+'''
+Author: Bryan Bonvallet
+Motivated by: B. Bonvallet and J. Barron, "A Software Architecture for Rapid Development and Deployment of Sensor Testbeds," Proceedings of the 2010 IEEE International Conference on Technologies for Homeland Security, pp. 441-445, Waltham, Massachusetts, Nov. 2010.
+
+Purpose: This file contains the transport which lets observables on one
+machine fire actions registered with the action manager of another. On the
+edge, a RemoteObservable reports its state changes to a TransportSender,
+which buffers them and sends them in batches over TCP or a Unix socket. On
+the central machine, a single TransportReceiver thread accepts any number of
+senders and reports each state change through a ReceivedObservable standing
+in for the remote one; actions are registered with those as usual.
+
+Frames are a 4 byte big-endian length followed by a JSON list of records
+of [observable id, initial primary attributes, final primary attributes,
+timestamp, final secondary attributes]. Only primitives are decoded, so a
+frame cannot run code on the receiver. Secondary attributes which JSON
+cannot encode, such as binary payloads, are not sent. Anything able to
+connect can still fire actions, so a receiver should only be reachable by
+trusted senders; it listens on the loopback interface unless told otherwise.
+
+To the extent possible under law, Bryan Bonvallet has waived all copyright and related or neighboring rights to Generic Data Collection Infrastructure. This work is published from: United States.
+https://github.com/btbonval/Generic-Data-Collection-Infrastructure
+'''
+
+import os
+import time
+import json
+import errno
+import select
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+
+from gdci.core.thread import CoreThread
+from gdci.core.observable import CoreObserver
+from gdci.core.observable import CoreObservable
+from gdci.core.actionmanager import action_manager
+
+log = logging.getLogger('Transport')
+
+# Length prefix of each frame.
+FRAME_HEADER = struct.Struct('!I')
+# Refuse frames larger than this many bytes.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Secondary attribute added to received final states.
+TIMESTAMP_ATTRIBUTE = 'transport_timestamp'
+
+
+def encode_record(record):
+    '''
+    Encode a record as JSON. Secondary attributes which cannot be encoded
+    are left out, with a warning.
+    '''
+
+    try:
+        return json.dumps(record, separators=(',', ':'))
+    except (TypeError, ValueError):
+        pass
+
+    attribs = {}
+    for key, value in record[4].iteritems():
+        try:
+            json.dumps({key: value})
+        except (TypeError, ValueError):
+            log.warning('Not sending secondary attribute %r of %s, which JSON cannot encode.', key, record[0])
+            continue
+        attribs[key] = value
+    return json.dumps(record[:4] + (attribs,), separators=(',', ':'))
+
+def pack_frame(encoded):
+    '''
+    Join a list of records encoded by encode_record() into a frame.
+    '''
+
+    body = '[' + ','.join(encoded) + ']'
+    return FRAME_HEADER.pack(len(body)) + body
+
+def encode_frame(records):
+    '''
+    Encode a list of records into a frame.
+    '''
+    return pack_frame([encode_record(tuple(record)) for record in records])
+
+def decode_body(body):
+    '''
+    Decode the records of a frame, checking that each is a list of an id,
+    two lists of primary attributes, a timestamp, and a dictionary.
+    '''
+
+    records = json.loads(body)
+    if not isinstance(records, list):
+        raise ValueError('A frame must hold a list of records.')
+    for record in records:
+        if not (isinstance(record, list) and len(record) == 5 and
+                isinstance(record[1], list) and isinstance(record[2], list) and
+                isinstance(record[3], (int, long, float)) and isinstance(record[4], dict)):
+            raise ValueError('Invalid record %r.' % (record,))
+    return records
+
+def decode_frames(data):
+    '''
+    Decode all complete frames at the beginning of data. Returns a tuple of
+    (list of record lists, remaining data).
+    '''
+
+    frames = []
+    offset = 0
+    while len(data) - offset >= FRAME_HEADER.size:
+        length, = FRAME_HEADER.unpack_from(data, offset)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError('Frame of %d bytes exceeds the limit of %d bytes.' % (length, MAX_FRAME_SIZE))
+        end = offset + FRAME_HEADER.size + length
+        if len(data) < end:
+            break
+        frames.append(decode_body(data[offset + FRAME_HEADER.size:end]))
+        offset = end
+    return frames, data[offset:]
+
+def socket_family(address):
+    '''
+    A (host, port) tuple is a TCP address, a string is a Unix socket path.
+    '''
+
+    if isinstance(address, basestring):
+        return socket.AF_UNIX
+    return socket.AF_INET
+
+
+class TransportSender(CoreThread):
+    '''
+    TransportSender sends the state changes submitted by RemoteObservables to
+    a TransportReceiver. It is a thread and must be start()ed.
+
+    Submitting never blocks: state changes wait in a buffer of at most
+    max_buffer records, and the oldest are dropped (and counted in dropped)
+    when it is full. Every loop_interval the buffer is sent in frames of at
+    most batch_size records. While the receiver cannot be reached, the
+    sender reconnects with exponential backoff and keeps what it buffered.
+    Records count as sent once the socket accepts them; those still in
+    flight when a connection drops are lost, and the receiver counts the
+    frame it was cut off in as truncated.
+    '''
+
+    def __init__(self, address, max_buffer=10000, batch_size=500,
+                 reconnect_delay=0.5, max_reconnect_delay=30.0,
+                 socket_timeout=5.0, *args, **kwargs):
+        '''
+        address is a (host, port) tuple for TCP or a path for a Unix socket.
+        All other arguments will be passed to CoreThread; loop_interval
+        defaults to 0.05 seconds.
+        '''
+
+        kwargs.setdefault('loop_interval', 0.05)
+        CoreThread.__init__(self, *args, **kwargs)
+        self.daemon = True
+
+        self.address = address
+        self.max_buffer = max_buffer
+        self.batch_size = batch_size
+        self.min_reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.socket_timeout = socket_timeout
+
+        # Records awaiting a send, oldest first.
+        self.buffer = deque()
+        self.buffer_lock = threading.Lock()
+        # The connection and when to next attempt one.
+        self.socket = None
+        self.reconnect_delay = reconnect_delay
+        self.next_connect = 0
+        # Counters of records sent and dropped.
+        self.sent = 0
+        self.dropped = 0
+
+    def submit(self, observable_id, initial_state, final_state):
+        '''
+        Buffer a state change of the observable known as observable_id.
+        '''
+
+        with final_state.lock:
+            attribs = dict(final_state.secondary_attributes)
+        # Encoded now, so that a record which cannot be is caught here.
+        record = encode_record((observable_id, initial_state.get_primary(),
+                                final_state.get_primary(), time.time(), attribs))
+
+        with self.buffer_lock:
+            self.buffer.append(record)
+            self.trim_buffer()
+
+    def trim_buffer(self):
+        '''
+        Drop the oldest records beyond max_buffer. Call with buffer_lock held.
+        '''
+
+        while len(self.buffer) > self.max_buffer:
+            self.buffer.popleft()
+            self.dropped = self.dropped + 1
+
+    def pending(self):
+        '''
+        Return the number of records awaiting a send.
+        '''
+        return len(self.buffer)
+
+    def main_loop(self):
+        '''
+        Send whatever has been buffered.
+        '''
+        self.flush()
+
+    def flush(self):
+        '''
+        Send buffered records until the buffer is empty or a send fails.
+        Returns True if the buffer was emptied.
+        '''
+
+        while True:
+            with self.buffer_lock:
+                count = min(self.batch_size, len(self.buffer))
+                batch = [self.buffer.popleft() for i in xrange(count)]
+            if not batch:
+                return True
+
+            if not self.send_batch(batch):
+                # Return the batch to the front of the buffer in order. New
+                # records may have arrived meanwhile; the oldest go first.
+                with self.buffer_lock:
+                    self.buffer.extendleft(reversed(batch))
+                    self.trim_buffer()
+                return False
+
+    def send_batch(self, batch):
+        '''
+        Send a list of records as one frame. Returns True on success.
+        '''
+
+        if self.socket is None and not self.connect():
+            return False
+
+        try:
+            self.socket.sendall(pack_frame(batch))
+        except socket.error, e:
+            log.warning('Lost connection to %s: %s', self.address, e)
+            self.disconnect()
+            self.schedule_reconnect()
+            return False
+
+        self.sent = self.sent + len(batch)
+        return True
+
+    def connect(self):
+        '''
+        Connect to the receiver unless waiting out a reconnect delay.
+        Returns True if connected.
+        '''
+
+        if time.time() < self.next_connect:
+            return False
+
+        sock = socket.socket(socket_family(self.address), socket.SOCK_STREAM)
+        sock.settimeout(self.socket_timeout)
+        try:
+            sock.connect(self.address)
+        except socket.error, e:
+            sock.close()
+            log.debug('Failed to connect to %s: %s', self.address, e)
+            self.schedule_reconnect()
+            return False
+
+        self.socket = sock
+        self.reconnect_delay = self.min_reconnect_delay
+        log.info('Connected to %s.', self.address)
+        return True
+
+    def schedule_reconnect(self):
+        '''
+        Wait before the next connection attempt, twice as long each time.
+        '''
+
+        self.next_connect = time.time() + self.reconnect_delay
+        self.reconnect_delay = min(2 * self.reconnect_delay, self.max_reconnect_delay)
+
+    def disconnect(self):
+        '''
+        Close the connection, if any.
+        '''
+
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+
+    def after_loop(self):
+        '''
+        Make a last attempt to send what remains, then disconnect.
+        '''
+
+        self.flush()
+        self.disconnect()
+
+
+class RemoteObservable(CoreObservable):
+    '''
+    RemoteObservable is meant to be extended like CoreObservable. Instead of
+    the local action manager, its state changes are reported through sender
+    to the receiver, where they are known as observable_id.
+    '''
+
+    def __init__(self, sender, observable_id, *args, **kwargs):
+        '''
+        sender is a TransportSender. observable_id names this observable to
+        the receiver and must be unique among its senders.
+        '''
+
+        self.sender = sender
+        self.observable_id = observable_id
+        CoreObservable.__init__(self, *args, **kwargs)
+
+    def report_state_change(self, initial_state, final_state):
+        '''
+        Buffer the state change with the sender.
+        '''
+        self.sender.submit(self.observable_id, initial_state, final_state)
+
+class RemoteObserver(RemoteObservable, CoreObserver):
+    '''
+    The threaded variant of RemoteObservable; see CoreObserver.
+    '''
+
+    def __init__(self, sender, observable_id, *args, **kwargs):
+        '''
+        sender and observable_id are as for RemoteObservable. All other
+        arguments will be passed to CoreObserver.
+        '''
+
+        self.sender = sender
+        self.observable_id = observable_id
+        CoreObserver.__init__(self, *args, **kwargs)
+
+
+class ReceivedObservable(CoreObservable):
+    '''
+    ReceivedObservable stands in for an observable in another process or on
+    another machine. Its state is whatever was last received, and actions
+    registered with it fire on received state changes. It does not observe
+    anything itself. Its state_class must be that of the remote observable,
+    as states are rebuilt from their primary attributes in order.
+    '''
+
+    def __init__(self, observable_id, manager=None, state_class=None, *args, **kwargs):
+        '''
+        observable_id is the id the remote observable reports under.
+        manager is the action manager to report to and defaults to the
+        action manager singleton. state_class defaults to that of the class.
+        '''
+
+        if state_class is not None:
+            self.state_class = state_class
+        CoreObservable.__init__(self, *args, **kwargs)
+        self.observable_id = observable_id
+        self.manager = manager or action_manager
+
+    def get_observation(self):
+        '''
+        The observation is the last received result.
+        '''
+        return self.get_state().get_primary()[1]
+
+    def receive(self, initial_primary, final_primary, timestamp, attribs):
+        '''
+        Report a received state change to the action manager.
+        '''
+
+        # The initial state carries the attributes received last time. The
+        # remote observable must observe the same state_class.
+        previous = self.get_state()
+        initial_state = self.state_class(*initial_primary)
+        with previous.lock:
+            initial_state.secondary_attributes.update(previous.secondary_attributes)
+        final_state = self.state_class(*final_primary)
+        final_state.secondary_attributes.update(attribs)
+        final_state.secondary_attributes[TIMESTAMP_ATTRIBUTE] = timestamp
+
+        self.set_state(final_state)
+        futures = self.manager.check_state_change(self, initial_state.copy(), final_state.copy())
+        if self.dependents:
+            self.notify_dependents()
+        return futures
+
+    def __str__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.observable_id)
+
+
+class TransportReceiver(CoreThread):
+    '''
+    TransportReceiver accepts connections from TransportSenders and reports
+    the state changes they send through ReceivedObservables. A single thread
+    serves every connection. It is a thread and must be start()ed.
+
+    receiver = TransportReceiver(('127.0.0.1', 7070))
+    receiver.observable('edge1/pump').register_action(...)
+    receiver.start()
+    '''
+
+    def __init__(self, address, manager=None, poll_timeout=0.1, *args, **kwargs):
+        '''
+        Listen on address, a (host, port) tuple for TCP or a path for a
+        Unix socket. A port of 0 picks a free port; see the address
+        attribute. manager defaults to the action manager singleton.
+        poll_timeout bounds how long stop() may take to be noticed. All other
+        arguments will be passed to CoreThread.
+        '''
+
+        kwargs.setdefault('loop_interval', 0)
+        CoreThread.__init__(self, *args, **kwargs)
+        self.daemon = True
+
+        self.manager = manager or action_manager
+        self.poll_timeout = poll_timeout
+        # Observable id to ReceivedObservable.
+        self.observables = {}
+        self.observables_lock = threading.Lock()
+        # Connected socket to the data received but not yet decoded.
+        self.connections = {}
+        self.received = 0
+        # Connections closed part way through a frame, losing its records.
+        self.truncated = 0
+
+        family = socket_family(address)
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            # Replace a socket left behind by an earlier receiver.
+            try:
+                os.unlink(address)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        else:
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+
+    def observable(self, observable_id, state_class=None):
+        '''
+        Return the ReceivedObservable for observable_id, creating it if
+        needed so that actions can be registered before anything arrives.
+        state_class is that of the remote observable, State by default, and
+        is used only when the ReceivedObservable is created.
+        '''
+
+        with self.observables_lock:
+            observable = self.observables.get(observable_id)
+            if observable is None:
+                observable = ReceivedObservable(observable_id, self.manager, state_class)
+                self.observables[observable_id] = observable
+        return observable
+
+    def main_loop(self):
+        '''
+        Wait up to poll_timeout for connections or data and handle them.
+        '''
+
+        sockets = [self.listener] + self.connections.keys()
+        try:
+            readable, writable, failed = select.select(sockets, [], [], self.poll_timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        for sock in readable:
+            if sock is self.listener:
+                self.accept()
+            else:
+                self.read(sock)
+
+    def accept(self):
+        '''
+        Accept a pending connection.
+        '''
+
+        try:
+            sock, peer = self.listener.accept()
+        except socket.error, e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            raise
+        sock.setblocking(False)
+        self.connections[sock] = ''
+        log.info('Accepted a transport connection from %s.', peer or 'a Unix socket')
+
+    def read(self, sock):
+        '''
+        Read from a connection and dispatch every complete frame.
+        '''
+
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            if e.args[0] in [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]:
+                return
+            data = ''
+        if not data:
+            # The sender counted a partial frame as sent when its send
+            # returned, and will not resend it, so its records are lost.
+            if self.connections[sock]:
+                self.truncated = self.truncated + 1
+                log.warning('A transport connection closed part way through a frame; its records are lost.')
+            self.close(sock)
+            return
+
+        try:
+            frames, remaining = decode_frames(self.connections[sock] + data)
+        except Exception, e:
+            log.error('Closing a transport connection which sent an invalid frame.', exc_info=True)
+            self.close(sock)
+            return
+        self.connections[sock] = remaining
+
+        for records in frames:
+            self.dispatch(records)
+
+    def dispatch(self, records):
+        '''
+        Report each received record through its ReceivedObservable.
+        '''
+
+        for observable_id, initial_primary, final_primary, timestamp, attribs in records:
+            try:
+                self.observable(observable_id).receive(initial_primary, final_primary, timestamp, attribs)
+            except Exception, e:
+                log.error('Failed to report a state change of %s.', observable_id, exc_info=True)
+        self.received = self.received + len(records)
+
+    def close(self, sock):
+        '''
+        Close and forget a connection.
+        '''
+
+        del self.connections[sock]
+        sock.close()
+
+    def after_loop(self):
+        '''
+        Close every connection and the listening socket.
+        '''
+
+        for sock in self.connections.keys():
+            self.close(sock)
+        self.listener.close()
+        if socket_family(self.address) == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass